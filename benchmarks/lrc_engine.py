@@ -0,0 +1,120 @@
+"""Time parse_lrc + merge_lyrics over a corpus of lyric files, old vs new engine.
+
+    python benchmarks/lrc_engine.py                  # 2000 synthetic songs
+    python benchmarks/lrc_engine.py -n 10000
+    python benchmarks/lrc_engine.py --corpus ~/Music  # every *.lrc below a directory
+
+Synthetic songs look like what get_track_lyrics returns: an original with
+~60 timed lines (some with several timestamps) and a translation whose
+timestamps occasionally drift by 10 ms. `legacy` is the engine this repo
+used before: re.match per line, dict lookup on exact float timestamps and a
+final sort of the merged list.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_parse_lrc(lrc_content):
+    if not lrc_content:
+        return []
+    pattern = '\\[(\\d{2}):(\\d{2})\\.(\\d{2,3})\\](.*)'
+    lyrics = []
+    for line in lrc_content.split('\n'):
+        match = re.match(pattern, line)
+        if match:
+            minutes, seconds, milliseconds, text = match.groups()
+            time_seconds = int(minutes) * 60 + int(seconds) + int(milliseconds.ljust(3, '0')) / 1000
+            lyrics.append((time_seconds, text))
+    return sorted(lyrics, key=lambda x: x[0])
+
+
+def legacy_merge_lyrics(original_lyrics, translated_lyrics, song_duration=None, gap=0.01):
+    if not translated_lyrics:
+        return original_lyrics
+    trans_dict = {time: text for time, text in translated_lyrics}
+    merged = []
+    for i, (time, text) in enumerate(original_lyrics):
+        merged.append((time, text))
+        if time in trans_dict and trans_dict[time].strip():
+            trans_time = time + gap
+            if i + 1 < len(original_lyrics):
+                latest_before_next = original_lyrics[i + 1][0] - gap
+                trans_time = latest_before_next if latest_before_next >= trans_time else max(time, latest_before_next)
+            else:
+                trans_time = max(trans_time, (song_duration + 0.5) if song_duration else (time + 0.5))
+            merged.append((trans_time, trans_dict[time]))
+    return sorted(merged, key=lambda x: x[0])
+
+
+def stamp(seconds):
+    return f'[{int(seconds // 60):02d}:{int(seconds % 60):02d}.{int(seconds % 1 * 100):02d}]'
+
+
+def synthetic_song(rng):
+    """(original, translation, duration) in NCM's lrc/tlyric format."""
+    header = '[by:someone]\n[ti:title]\n'
+    original, translation = [header], [header]
+    t = rng.uniform(5, 15)
+    while t < 200:
+        line = ' '.join(rng.choice(('love', 'night', 'stay', 'light', 'heart', 'rain')) for _ in range(rng.randint(3, 8)))
+        if rng.random() < 0.1:
+            # 副歌重复：一行多个时间标签（旧引擎只认第一个）
+            original.append(f'{stamp(t)}{stamp(t + 60)}{line}\n')
+        else:
+            original.append(f'{stamp(t)}{line}\n')
+        drift = 0.01 if rng.random() < 0.1 else 0.0
+        translation.append(f'{stamp(t + drift)}译：{line[::-1]}\n')
+        t += rng.uniform(2.5, 5)
+    return ''.join(original), ''.join(translation), t + 10
+
+
+def load_corpus(args):
+    if not args.corpus:
+        rng = random.Random(0)
+        return [synthetic_song(rng) for _ in range(args.songs)]
+    songs = []
+    for root, _, files in os.walk(os.path.expanduser(args.corpus)):
+        for name in files:
+            if name.lower().endswith('.lrc'):
+                with open(os.path.join(root, name), 'r', encoding='utf-8', errors='replace') as f:
+                    songs.append((f.read(), '', None))
+    return songs
+
+
+def bench(parse, merge, corpus, rounds):
+    best, lines = None, 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        lines = 0
+        for original, translation, duration in corpus:
+            lines += len(merge(parse(original), parse(translation), duration))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--songs', type=int, default=2000)
+    parser.add_argument('--corpus', help='directory of .lrc files instead of the synthetic corpus')
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    import script
+    corpus = load_corpus(args)
+    print(f'{len(corpus)} songs, best of {args.rounds}')
+    print(f'{"engine":<8}{"seconds":>10}{"songs/s":>10}{"lines out":>11}')
+    for name, parse, merge in (('legacy', legacy_parse_lrc, legacy_merge_lyrics),
+                               ('current', script.parse_lrc, script.merge_lyrics)):
+        seconds, lines = bench(parse, merge, corpus, args.rounds)
+        print(f'{name:<8}{seconds:>10.3f}{len(corpus) / seconds:>10.0f}{lines:>11}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Peak memory of holding a 10k-track playlist as raw API dicts vs TrackRecord.
+
+Each mode runs in its own interpreter so the peak RSS numbers do not leak
+into each other:
+
+    python benchmarks/track_memory.py            # both modes, 10000 tracks
+    python benchmarks/track_memory.py -n 5000
+
+`raw` keeps every parsed song dict alive for the whole run (the old
+`tracks['songs']` list); `record` parses the payload page by page and keeps
+only TrackRecord objects, the way get_track_detail/iter_playlist_tracks do.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_SIZE = 500
+
+
+def synthetic_song(i):
+    """A song dict shaped like a GetTrackDetail/GetPlaylistAllTracks entry."""
+    quality = lambda br: {'br': br, 'fid': 0, 'size': 3000000 + i, 'vd': -20000.0, 'sr': 44100}
+    return {
+        'name': f'Track {i} (Live Version)', 'id': 1900000000 + i, 'pst': 0, 't': 0,
+        'ar': [{'id': 10000 + i % 300, 'name': f'Artist {i % 300}', 'tns': [], 'alias': []},
+               {'id': 20000 + i % 50, 'name': f'Featured {i % 50}', 'tns': [], 'alias': []}],
+        'alia': [f'alias {i}'], 'pop': 100.0, 'st': 0, 'rt': '', 'fee': 8, 'v': 12, 'crbt': None, 'cf': '',
+        'al': {'id': 150000000 + i // 12, 'name': f'Album {i // 12}', 'tns': [],
+               'picUrl': f'https://p2.music.126.net/{i // 12:024d}/{109951168000000000 + i // 12}.jpg',
+               'pic_str': str(109951168000000000 + i // 12), 'pic': 109951168000000000 + i // 12},
+        'dt': 215000 + i, 'h': quality(320000), 'm': quality(192000), 'l': quality(128000),
+        'sq': quality(900000), 'hr': None, 'a': None, 'cd': '01', 'no': i % 12 + 1, 'rtUrl': None,
+        'ftype': 0, 'rtUrls': [], 'djId': 0, 'copyright': 1, 's_id': 0, 'mark': 17716748288,
+        'originCoverType': 1, 'originSongSimpleData': None, 'tagPicList': None, 'resourceState': True,
+        'version': 7, 'songJumpInfo': None, 'entertainmentTags': None, 'awardTags': None, 'single': 0,
+        'noCopyrightRcmd': None, 'rtype': 0, 'rurl': None, 'mst': 9, 'cp': 7002, 'mv': 0,
+        'publishTime': 1672531200000 + i * 1000,
+        'privilege': {'id': 1900000000 + i, 'fee': 8, 'payed': 0, 'st': 0, 'pl': 320000, 'dl': 999000,
+                      'sp': 7, 'cp': 1, 'subp': 1, 'cs': False, 'maxbr': 999000, 'fl': 320000,
+                      'toast': False, 'flag': 260, 'preSell': False, 'playMaxbr': 999000,
+                      'downloadMaxbr': 999000, 'maxBrLevel': 'lossless', 'playMaxBrLevel': 'lossless',
+                      'downloadMaxBrLevel': 'lossless', 'plLevel': 'exhigh', 'dlLevel': 'lossless',
+                      'flLevel': 'exhigh', 'rscl': None, 'freeTrialPrivilege': {'resConsumable': False,
+                      'userConsumable': False, 'listenType': None}, 'chargeInfoList': [
+                          {'rate': br, 'chargeUrl': None, 'chargeMessage': None, 'chargeType': 0}
+                          for br in (128000, 192000, 320000, 999000)]},
+    }
+
+
+def pages(count):
+    """JSON pages as they would come off the wire, PAGE_SIZE songs each."""
+    for start in range(0, count, PAGE_SIZE):
+        yield json.dumps({'code': 200, 'songs': [synthetic_song(i) for i in range(start, min(count, start + PAGE_SIZE))]})
+
+
+def peak_rss_kib():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run(mode, count):
+    sys.path.insert(0, ROOT)
+    import script
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = []
+    for payload in pages(count):
+        songs = json.loads(payload)['songs']
+        if mode == 'raw':
+            kept.extend(songs)
+        else:
+            kept.extend(script.TrackRecord.from_song(song) for song in songs)
+        del songs, payload
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(json.dumps({'mode': mode, 'tracks': len(kept), 'held_kib': current // 1024, 'peak_traced_kib': peak // 1024,
+                      'peak_rss_kib': peak_rss_kib(), 'seconds': round(elapsed, 3)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--tracks', type=int, default=10000)
+    parser.add_argument('--mode', choices=('raw', 'record'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        run(args.mode, args.tracks)
+        return
+    print(f'{"mode":<8}{"tracks":>8}{"held KiB":>12}{"peak KiB":>12}{"peak RSS KiB":>14}{"seconds":>9}')
+    for mode in ('raw', 'record'):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '-n', str(args.tracks)],
+                             check=True, capture_output=True, text=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        rss = r['peak_rss_kib'] if r['peak_rss_kib'] is not None else '-'
+        print(f'{r["mode"]:<8}{r["tracks"]:>8}{r["held_kib"]:>12}{r["peak_traced_kib"]:>12}{rss:>14}{r["seconds"]:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,148 @@
-"""Small CLI wrapper that runs the top-level `script` module.
+"""Small CLI wrapper around the top-level `script` module.
 
-We avoid modifying the original `script.py` by executing it as a module.
-This lets us provide a console_scripts entry point that runs the existing script.
+Without arguments `ncmdl` runs `script.py` as __main__ (the interactive menu).
+With a subcommand it runs headless: no banner, prompts or sleeps, suitable for
+cron/CI use:
+
+    ncmdl download 12345 https://music.163.com/#/playlist?id=67890 -o music
+    ncmdl download -f jobs.txt --level lossless
+    ncmdl sync -f jobs.txt --prune
+    ncmdl retry-failed -o music
+
+Bare numeric IDs are playlists unless `--tracks` is given; URLs carry their own
+type, and `track:<id>` / `playlist:<id>` prefixes work on the command line and
+in job files (one or more targets per line, `#` starts a comment).
 """
 from __future__ import annotations
 
+import argparse
+import os
+import re
 import runpy
 import sys
 
+EXIT_OK = 0
+EXIT_PARTIAL = 1   # some tracks ended up in !#_FAILED_LIST.txt
+EXIT_USAGE = 2     # bad arguments or unreadable job file (argparse uses 2 too)
+EXIT_AUTH = 3      # no saved session to log in with
+EXIT_FAILED = 4    # nothing could be downloaded
+EXIT_INTERRUPTED = 130
+
+LEVELS = ('standard', 'higher', 'exhigh', 'lossless', 'hires', 'jyeffect', 'sky', 'jymaster')
+LYRICS_OPTIONS = ('both', 'metadata', 'lrc', 'none')
+
+
+class UsageError(Exception):
+    pass
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='ncmdl', description='网易云歌单下载器（不带参数运行时进入交互菜单）')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-o', '--output', default=os.path.join(os.getcwd(), 'downloads'), help='下载目录（默认 ./downloads）')
+    common.add_argument('-l', '--level', choices=LEVELS, default='exhigh', help='音质（默认 exhigh）')
+    common.add_argument('--lyrics', choices=LYRICS_OPTIONS, default='both', help='歌词处理方式（默认 both）')
+    common.add_argument('-w', '--workers', type=int, default=None, help='同时下载的曲目数')
+    common.add_argument('--session', default='session.json', help='已保存的会话文件（默认 ./session.json）')
+    targets = argparse.ArgumentParser(add_help=False)
+    targets.add_argument('targets', nargs='*', help='歌单/单曲 ID 或分享链接')
+    targets.add_argument('-f', '--job-file', action='append', default=[], help='任务文件，每行一个或多个 ID/链接，可重复指定')
+    targets.add_argument('-t', '--tracks', action='store_true', help='把不带类型的纯数字 ID 视为单曲而不是歌单')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('download', parents=[common, targets], help='下载歌单与单曲')
+    sync = sub.add_parser('sync', parents=[common, targets], help='增量同步：只下载新增或需升级音质的曲目')
+    sync.add_argument('--prune', action='store_true', help='删除已从歌单移除的曲目')
+    sub.add_parser('retry-failed', parents=[common], help='重新下载下载目录中 !#_FAILED_LIST.txt 记录的曲目')
+    return parser
+
+
+def parse_targets(tokens, default_type, extract):
+    """Split tokens into (playlist_ids, track_ids); `extract` is script.extract_id_and_type."""
+    playlists, tracks = [], []
+    for token in tokens:
+        forced = None
+        prefix, sep, rest = token.partition(':')
+        if sep and prefix.lower() in ('track', 'song', 'playlist'):
+            forced, token = ('playlist' if prefix.lower() == 'playlist' else 'track'), rest
+        found_id, found_type = extract(token)
+        if not found_id:
+            raise UsageError(f'无法解析的 ID 或链接: {token}')
+        (playlists if (forced or found_type or default_type) == 'playlist' else tracks).append(found_id)
+    return playlists, tracks
+
+
+def read_job_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        raise UsageError(f'无法读取任务文件 {path}: {e}')
+    tokens = []
+    for line in lines:
+        # 注释须以 # 开头或前面有空白，分享链接中的 /#/ 不受影响
+        line = re.split(r'(?:^|\s)#', line, maxsplit=1)[0]
+        tokens.extend(t for t in re.split(r'[\s,，;；]+', line) if t)
+    return tokens
+
+
+def run_headless(args) -> int:
+    import script
+    download_path = os.path.normpath(os.path.expanduser(args.output))
+    if args.command == 'retry-failed':
+        playlist_ids, track_ids = [], script.read_failed_list(download_path)
+        if not track_ids:
+            print(f'! {download_path} 中没有需要重试的曲目')
+            return EXIT_OK
+    else:
+        tokens = list(args.targets)
+        for path in args.job_file:
+            tokens.extend(read_job_file(path))
+        if not tokens:
+            raise UsageError('未指定任何歌单/单曲 ID、链接或任务文件')
+        playlist_ids, track_ids = parse_targets(tokens, 'track' if args.tracks else 'playlist', script.extract_id_and_type)
+    if args.workers is not None and not 1 <= args.workers <= 16:
+        raise UsageError('--workers 需在 1-16 之间')
+    if not script.load_session_from_file(args.session):
+        print(f'× 未找到会话文件 {args.session}，请先不带参数运行 ncmdl 登录', file=sys.stderr)
+        return EXIT_AUTH
+    script.lyrics_option = args.lyrics
+    try:
+        os.makedirs(download_path, exist_ok=True)
+    except OSError as e:
+        raise UsageError(f'无法创建下载目录 {download_path}: {e}')
+    if args.command == 'retry-failed':
+        # 旧列表改名备份，本次仍失败的曲目会写入新的列表
+        failed_list = os.path.join(download_path, '!#_FAILED_LIST.txt')
+        os.replace(failed_list, failed_list + '.bak')
+    stats = script.download_batch(playlist_ids, track_ids, args.level, download_path, args.workers,
+                                  sync=args.command == 'sync', prune=getattr(args, 'prune', False))
+    print(f"共 {stats['tracks']} 首：下载 {stats['downloaded']}，跳过 {stats['skipped']}，失败 {stats['failed']}")
+    for error in stats['errors']:
+        print(f'× {error}', file=sys.stderr)
+    if stats['tracks'] == 0 and stats['errors']:
+        return EXIT_FAILED
+    if stats['failed'] or stats['errors']:
+        return EXIT_PARTIAL if stats['downloaded'] or stats['skipped'] else EXIT_FAILED
+    return EXIT_OK
+
 
 def main(argv: list | None = None) -> int:
     """Entry point for console_scripts.
 
-    This will execute the installed `script` module as __main__, so behavior is
-    equivalent to `python -m script` or `python script.py`.
+    Without arguments this executes the installed `script` module as __main__,
+    so behavior is equivalent to `python -m script` or `python script.py`.
     """
+    args_list = sys.argv[1:] if argv is None else list(argv)
+    if args_list:
+        parser = build_parser()
+        args = parser.parse_args(args_list)
+        try:
+            return run_headless(args)
+        except UsageError as e:
+            parser.error(str(e))  # exits with EXIT_USAGE
+        except KeyboardInterrupt:
+            print('\n× 已取消', file=sys.stderr)
+            return EXIT_INTERRUPTED
     if argv is not None:
         # adjust sys.argv for the executed module
         sys.argv[:] = [sys.argv[0]] + list(argv)
@@ -1,9 +1,12 @@
-import sys, os, json, qrcode, time, pyncm, requests, re, platform, subprocess, shutil # pyright: ignore[reportMissingModuleSource, reportMissingImports]
+import sys, os, json, time, pyncm, requests, re, platform, subprocess, shutil # pyright: ignore[reportMissingModuleSource, reportMissingImports]
 from pyncm.apis import playlist, track, login # pyright: ignore[reportMissingImports]
 import functools 
+import bisect
+from operator import itemgetter
 import unicodedata
 import threading
-from contextlib import suppress
+import signal
+from contextlib import suppress, contextmanager
 from requests.exceptions import Timeout, ConnectionError, RequestException # type: ignore
 import time
 DEBUG = False
@@ -14,14 +17,11 @@ try:
 except ImportError as e:
     if DEBUG: print(e)
     COLORAMA_INSTALLED = False
-import mutagen # pyright: ignore[reportMissingImports]
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TRCK, TDRC # pyright: ignore[reportMissingImports]
-from mutagen.flac import FLAC, Picture # pyright: ignore[reportMissingImports]
-from mutagen import File as MutagenFile # pyright: ignore[reportMissingImports]
-from PIL import Image # pyright: ignore[reportMissingImports]
-from io import BytesIO
-MUTAGEN_INSTALLED = True
+# qrcode、mutagen 较重，只在扫码登录、打标签时才导入；封面尺寸直接读取文件头，不需要 PIL
 USER_INFO_CACHE = {'nickname': None, 'user_id': None, 'vip': None}
+# 交互模式启动时按实际窗口更新；作为模块导入（如 ncmdl 子命令）时使用以下默认值
+terminal_width = 80
+lyrics_option = 'both'
 
 
 def send_notification(title: str, message: str, timeout: int = 5):
@@ -138,27 +138,354 @@ def get_terminal_size():
         except:
             return (80, 24)
 
+def human_eta(rem_bytes, spd_bytes):
+    if spd_bytes <= 0 or rem_bytes <= 0:
+        return '--'
+    eta = rem_bytes / spd_bytes
+    if eta < 60:
+        return f'{int(eta)}s'
+    elif eta < 3600:
+        m = int(eta // 60)
+        s = int(eta % 60)
+        return f'{m}m{s:02d}s'
+    else:
+        h = int(eta // 3600)
+        m = int((eta % 3600) // 60)
+        return f'{h}h{m:02d}m'
+
+# 宽度计算工具：考虑中日韩全角字符宽度=2，并修正省略号“…”等特殊字符
+
+def cell_width(ch: str) -> int:
+    if not ch:
+        return 0
+    # 常见零宽字符（组合符号/格式控制）按0宽处理
+    cat = unicodedata.category(ch)
+    if cat in ('Mn', 'Me', 'Cf'):
+        return 0
+    # 单字符省略号在部分终端为宽字符，按2宽处理以避免对齐错位
+    if ch == '…':
+        return 2
+    eaw = unicodedata.east_asian_width(ch)
+    if eaw in ('W', 'F'):
+        return 2
+    if eaw == 'A' and cat.startswith('S'):
+        return 2
+    return 1
+
+@functools.lru_cache(maxsize=4096)
+def display_width(text: str) -> int:
+    return sum(cell_width(c) for c in text)
+
+@functools.lru_cache(maxsize=4096)
+def truncate_filename(fname: str, max_disp: int) -> str:
+    # 保留扩展名
+    name_no_ext, ext = os.path.splitext(fname)
+    ext_w = display_width(ext)
+    ell_w = display_width('…')
+    # 如果本身就适合
+    if display_width(fname) <= max_disp:
+        return fname
+    # 预留扩展名与省略号
+    remain = max_disp - ext_w - ell_w
+    if remain <= 1:
+        # 极端情况下直接截掉
+        return '…' + ext
+    # 截取
+    acc = ''
+    w = 0
+    for ch in name_no_ext:
+        cw = cell_width(ch)
+        if w + cw > remain:
+            break
+        acc += ch
+        w += cw
+    return acc + '…' + ext
+
+# 终端宽度缓存：支持 SIGWINCH 的平台在窗口大小变化时失效，其余平台每秒最多重新测量一次
+_term_size_cache = {'size': None, 'time': 0.0, 'sigwinch': False}
+
+def _on_sigwinch(signum, frame):
+    _term_size_cache['size'] = None
+
+def cached_terminal_size():
+    """返回缓存的 (列数, 行数)，避免在渲染循环中反复调用 ioctl。"""
+    cache = _term_size_cache
+    if not cache['sigwinch'] and hasattr(signal, 'SIGWINCH') and threading.current_thread() is threading.main_thread():
+        with suppress(Exception):
+            signal.signal(signal.SIGWINCH, _on_sigwinch)
+            cache['sigwinch'] = True
+    now = time.time()
+    if cache['size'] is None or (not cache['sigwinch'] and now - cache['time'] >= 1):
+        cache['size'] = get_terminal_size()
+        cache['time'] = now
+    return cache['size']
+
+# 进度刷新频率（次/秒）与多行面板最多显示的下载行数
+PROGRESS_HZ = 10
+PROGRESS_MAX_ROWS = 8
+
+class ProgressRenderer:
+    """下载进度面板：下载线程只累加字节计数，独立的渲染线程按 PROGRESS_HZ 重绘。
+
+    第一行汇总全部任务，其下每个正在下载的文件各占一行（反色部分表示进度）。
+    log() 输出的信息打印在面板上方，面板随后在其下方重绘。
+    """
+
+    def __init__(self, total, hz=None, max_rows=None):
+        self.total = total
+        self.interval = 1.0 / (hz or PROGRESS_HZ)
+        self.max_rows = max_rows or PROGRESS_MAX_ROWS
+        self.lock = threading.Lock()
+        self.active = {}
+        self.finished = 0
+        self.bytes_done = 0
+        self.start_time = time.time()
+        self.samples = [(self.start_time, 0)]
+        self.stop_event = threading.Event()
+        self.thread = None
+        if sys.stdout.isatty():
+            self.thread = threading.Thread(target=self._run, name='progress', daemon=True)
+            self.thread.start()
+
+    def start(self, key, name, size, done=0):
+        """开始（或重新开始）显示一个文件；done 为续传时已有的字节数，不计入速度。"""
+        with self.lock:
+            self.active[key] = {'name': name, 'size': size or 0, 'done': done, 'base': done, 'start': time.time()}
+
+    def update(self, key, nbytes):
+        with self.lock:
+            item = self.active.get(key)
+            if item is not None:
+                item['done'] += nbytes
+            self.bytes_done += nbytes
+
+    def set_total(self, total):
+        """流式输入结束后按实际曲目数校正总数。"""
+        with self.lock:
+            self.total = total
+
+    def finish(self, key, message=None):
+        with self.lock:
+            self.active.pop(key, None)
+            self.finished += 1
+        if message:
+            self.log(message)
+
+    def log(self, message):
+        with self.lock:
+            sys.stdout.write('\r\x1b[J' + message + '\x1b[K\n')
+            sys.stdout.flush()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            with suppress(Exception):
+                self.render()
+
+    def _speed(self, now):
+        # 最近约 3 秒内的平均速度
+        self.samples.append((now, self.bytes_done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > 3:
+            self.samples.pop(0)
+        t0, b0 = self.samples[0]
+        return (self.bytes_done - b0) / (now - t0) if now > t0 else 0.0
+
+    @staticmethod
+    def _bar(line, fraction, term_w):
+        fill_cells = max(0, min(term_w, int(term_w * fraction)))
+        acc_w = 0
+        i = 0
+        while i < len(line) and acc_w < fill_cells:
+            acc_w += cell_width(line[i])
+            i += 1
+        return f'\x1b[7;33m{line[:i]}\x1b[0m\x1b[33m{line[i:]}\x1b[0m'
+
+    @staticmethod
+    def _fit(left, name, right, term_w):
+        max_name_w = term_w - display_width(left) - display_width(right) - 1
+        if max_name_w <= 5:
+            name = ''
+        elif display_width(name) > max_name_w:
+            name = truncate_filename(name, max_name_w)
+        line = left + name
+        return line + ' ' * max(1, term_w - display_width(line) - display_width(right)) + right
+
+    def render(self):
+        now = time.time()
+        with self.lock:
+            term_w, term_h = cached_terminal_size()
+            term_w -= 1
+            speed = self._speed(now)
+            digits = len(str(self.total))
+            header_left = f"[{self.finished:0{digits}d}/{self.total}] 下载中 {len(self.active)} 首"
+            header_right = f" {self.bytes_done / 1024 / 1024:.1f}MB {speed / 1024 / 1024:.2f}MB/s"
+            rows = [self._bar(self._fit(header_left, '', header_right, term_w), self.finished / self.total if self.total else 0, term_w)]
+            for item in list(self.active.values())[:max(0, min(self.max_rows, term_h - 2))]:
+                elapsed = now - item['start']
+                item_speed = (item['done'] - item['base']) / elapsed if elapsed > 0 else 0.0
+                fraction = item['done'] / item['size'] if item['size'] else 0.0
+                size_txt = f"{item['done'] / 1024 / 1024:.2f}MB/{item['size'] / 1024 / 1024:.2f}MB" if item['size'] else f"{item['done'] / 1024 / 1024:.2f}MB/??MB"
+                eta = human_eta(item['size'] - item['done'], item_speed) if item['size'] else '--'
+                right = f" {fraction * 100:5.1f}% {size_txt} {item_speed / 1024:.0f}KB/s {eta}"
+                rows.append(self._bar(self._fit('  ', item['name'], right, term_w), fraction, term_w))
+            # 从面板首行开始重绘，画完后光标回到首行，便于下一次覆盖或被日志顶到下方
+            out = '\r\x1b[J' + '\n'.join(rows)
+            if len(rows) > 1:
+                out += f'\x1b[{len(rows) - 1}A'
+            sys.stdout.write(out + '\r')
+            sys.stdout.flush()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            sys.stdout.write('\r\x1b[J')
+            sys.stdout.flush()
+
+# 重试策略：从 RETRY_BASE_DELAY 秒开始指数退避并加随机抖动，单次等待不超过 RETRY_MAX_DELAY 秒；
+# 每次运行最多重试 RETRY_BUDGET 次，用完后失败的请求不再重试；
+# 连续 CIRCUIT_THRESHOLD 次被限流或超时即暂停全部接口请求 CIRCUIT_COOLDOWN 秒，冷却后仍失败则加倍，最多 CIRCUIT_MAX_COOLDOWN 秒
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_BUDGET = 200
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 30.0
+CIRCUIT_MAX_COOLDOWN = 300.0
+# 接口返回码中可重试的临时错误（限流、服务端错误）；其余非 200 的返回码直接交给调用方处理
+RETRYABLE_API_CODES = {-460, -447, 405, 429, 500, 502, 503, 504}
+
+class ApiError(RequestException):
+    """接口返回了可重试的错误码，且重试后仍未成功。"""
+
+    def __init__(self, code, message=None):
+        super().__init__(f'接口返回错误码 {code}' + (f': {message}' if message else ''))
+        self.code = code
+
+class RetryEngine:
+    """本次运行的重试状态：所有接口请求共用的重试预算与熔断器。"""
+
+    def __init__(self, budget=None, log=None):
+        self.budget = RETRY_BUDGET if budget is None else budget
+        self.log = log or print
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = CIRCUIT_COOLDOWN
+        self.budget_warned = False
+
+    def backoff(self, attempt):
+        """第 attempt 次重试前的等待秒数：指数增长，一半固定一半随机。"""
+        import random
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def take_retry(self):
+        """消耗一次重试预算，预算用完时返回 False。"""
+        with self.lock:
+            if self.budget > 0:
+                self.budget -= 1
+                return True
+            warn, self.budget_warned = not self.budget_warned, True
+        if warn:
+            self.log('\x1b[33m! 本次运行的重试次数已用完，之后失败的请求将不再重试\x1b[0m\x1b[K')
+        return False
+
+    def record(self, ok):
+        """记录一次请求结果；ok 为 False 表示被限流或超时，连续失败达到阈值时断开。"""
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.cooldown = CIRCUIT_COOLDOWN
+                return
+            self.failures += 1
+            now = time.monotonic()
+            if self.failures < CIRCUIT_THRESHOLD or now < self.open_until:
+                return
+            pause = self.cooldown
+            self.open_until = now + pause
+            self.cooldown = min(self.cooldown * 2, CIRCUIT_MAX_COOLDOWN)
+            # 半开：冷却结束后的第一次请求再失败就立即重新断开
+            self.failures = CIRCUIT_THRESHOLD - 1
+        self.log(f'\x1b[33m! 服务器持续拒绝请求，暂停所有请求 {pause:.0f} 秒...\x1b[0m\x1b[K')
+
+    def wait_if_open(self):
+        """熔断期间阻塞调用方，被取消时返回 False。"""
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return True
+            if DOWNLOAD_CANCEL.wait(min(remaining, 1.0)):
+                return False
+
+_retry_engine = None
+_retry_engine_lock = threading.Lock()
+
+def get_retry_engine():
+    global _retry_engine
+    with _retry_engine_lock:
+        if _retry_engine is None:
+            _retry_engine = RetryEngine()
+        return _retry_engine
+
+def reset_retry_engine(log=None):
+    """开始新一轮下载：重置重试预算与熔断状态，提示信息交给 log 输出。"""
+    global _retry_engine
+    with _retry_engine_lock:
+        _retry_engine = RetryEngine(log=log)
+        return _retry_engine
+
+@contextmanager
+def request_timeout(seconds):
+    """在当前线程内为未指定超时的 HTTP 请求（如 pyncm 接口）设置超时。"""
+    previous = getattr(_worker_local, 'timeout', None)
+    _worker_local.timeout = seconds
+    try:
+        yield
+    finally:
+        _worker_local.timeout = previous
+
 def retry_with_timeout(timeout=30, retry_times=2, operation_name='操作'):
-    """通用超时重试装饰器"""
+    """通用重试装饰器，返回 (结果, 错误)。
+
+    每次请求限时 timeout 秒；超时、连接错误与可重试的接口返回码按退避间隔重试，
+    并受本次运行的重试预算与熔断器约束。其他返回码原样交给调用方。
+    """
 
     def decorator(func):
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            retries = 0
+            engine = get_retry_engine()
             last_error = None
-            while retries <= retry_times:
+            for attempt in range(retry_times + 1):
+                if attempt:
+                    if not engine.take_retry():
+                        break
+                    delay = engine.backoff(attempt)
+                    engine.log(f'\x1b[33m! {operation_name}失败（{last_error}），{delay:.1f} 秒后重试 ({attempt}/{retry_times})...\x1b[0m\x1b[K')
+                    if DOWNLOAD_CANCEL.wait(delay):
+                        break
+                if not engine.wait_if_open():
+                    break
                 try:
-                    result = func(*args, **kwargs)
-                    return (result, None)
-                except (Timeout, ConnectionError, RequestException) as e:
-                    retries += 1
+                    with request_timeout(timeout):
+                        result = func(*args, **kwargs)
+                except (Timeout, ConnectionError) as e:
+                    engine.record(False)
                     last_error = e
-                    if retries <= retry_times:
-                        print(f'\x1b[33m! {operation_name}超时，正在重试 ({retries}/{retry_times})...\x1b[0m\x1b[K')
-                    else:
-                        print(f'\x1b[31m× {operation_name}多次超时，放弃尝试。\x1b[0m\x1b[K')
-                        break
+                    continue
+                except RequestException as e:
+                    last_error = e
+                    continue
+                code = result.get('code') if isinstance(result, dict) else None
+                if code in RETRYABLE_API_CODES:
+                    engine.record(False)
+                    last_error = ApiError(code, result.get('message') or result.get('msg'))
+                    continue
+                engine.record(True)
+                return (result, None)
+            engine.log(f'\x1b[31m× {operation_name}多次失败，放弃尝试: {last_error}\x1b[0m\x1b[K')
             return (None, last_error)
         return wrapper
     return decorator
@@ -248,6 +575,7 @@ def get_qrcode():
                     return get_qrcode()
                 # url = f'https://music.163.com/login?codekey={uuid}'
                 url = login.GetLoginQRCodeUrl(uuid)
+                import qrcode # pyright: ignore[reportMissingImports]
                 img = qrcode.make(url)
                 img_path = 'ncm.png'
                 img.save(img_path) # pyright: ignore[reportArgumentType]
@@ -920,47 +1248,102 @@ def open_image(image_path):
         raise Exception('找不到合适的图片查看器')
 
 def save_session_to_file(session, filename='session.json'):
+    global SESSION_FILE
     with open(filename, 'w') as f:
         session_data = pyncm.DumpSessionAsString(session)
         json.dump(session_data, f)
+    SESSION_FILE = filename
     print('\x1b[32m✓ \x1b[0m会话已保存。')
 
+# 登录状态缓存在会话文件旁（session.json → session.status.json），会话文件变化或超过 TTL 后重新获取
+SESSION_FILE = 'session.json'
+LOGIN_STATUS_TTL = 6 * 3600
+
+def _login_status_path(session_file):
+    return os.path.splitext(session_file)[0] + '.status.json'
+
+def get_login_status(refresh=False):
+    """返回 login.GetCurrentLoginStatus() 的结果，优先使用未过期且与当前会话文件对应的缓存。"""
+    path = _login_status_path(SESSION_FILE)
+    try:
+        session_mtime = os.path.getmtime(SESSION_FILE)
+    except OSError:
+        session_mtime = None
+    if not refresh and session_mtime is not None:
+        with suppress(Exception):
+            with open(path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached['session_mtime'] == session_mtime and time.time() - cached['fetched'] < LOGIN_STATUS_TTL:
+                return cached['status']
+    status = login.GetCurrentLoginStatus()
+    if session_mtime is not None and isinstance(status, dict) and status.get('code') == 200:
+        with suppress(Exception):
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'fetched': time.time(), 'session_mtime': session_mtime, 'status': status}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+    return status
+
+# 时间标签：[mm:ss.xx]、[mm:ss.xxx]、[mm:ss:xx]、[mm:ss]
+LRC_TIME_TAG = re.compile('\\[(\\d+):(\\d{1,2})(?:[.:](\\d{1,3}))?\\]')
+# 整段歌词一次扫描：首个时间标签、其后的其余时间标签（多数行为空）、歌词文本
+LRC_LINE = re.compile('^\\[(\\d+):(\\d{1,2})(?:[.:](\\d{1,3}))?\\]((?:\\[\\d+:\\d{1,2}(?:[.:]\\d{1,3})?\\])*)([^\\r\\n]*)', re.M)
+LRC_OFFSET_TAG = re.compile('^\\[offset:\\s*([+-]?\\d+)\\s*\\]', re.I | re.M)
+
 def parse_lrc(lrc_content):
+    """解析 LRC 文本为按时间排序的 [(秒, 文本)]；支持一行多个时间标签和 [offset:毫秒]。"""
     if not lrc_content:
         return []
-    pattern = '\\[(\\d{2}):(\\d{2})\\.(\\d{2,3})\\](.*)'
-    lyrics = []
-    for line in lrc_content.split('\n'):
-        match = re.match(pattern, line)
-        if match:
-            minutes, seconds, milliseconds, text = match.groups()
-            time_seconds = int(minutes) * 60 + int(seconds) + int(milliseconds.ljust(3, '0')) / 1000
-            lyrics.append((time_seconds, text))
-    return sorted(lyrics, key=lambda x: x[0])
+    rows = LRC_LINE.findall(lrc_content)
+    lyrics = [(int(m) * 60 + (float(f'{s}.{f}') if f else int(s)), text) for m, s, f, _, text in rows]
+    for _, _, _, extra, text in rows:
+        if extra:
+            lyrics.extend((int(m) * 60 + (float(f'{s}.{f}') if f else int(s)), text) for m, s, f in LRC_TIME_TAG.findall(extra))
+    # 绝大多数歌词没有 offset，先用子串判断跳过整段正则扫描
+    offset = LRC_OFFSET_TAG.search(lrc_content) if 'ffset:' in lrc_content or 'FFSET:' in lrc_content else None
+    if offset and int(offset.group(1)):
+        # offset 为正表示歌词整体提前
+        shift = int(offset.group(1)) / 1000
+        lyrics = [(max(time - shift, 0.0), text) for time, text in lyrics]
+    # 歌词本身基本有序，Timsort 在这种输入上接近线性
+    lyrics.sort(key=itemgetter(0))
+    return lyrics
 
 LYRIC_TRANSLATION_GAP = 0.01
+# 翻译与原文时间标签相差不超过该值（秒）时视为同一行
+LYRIC_ALIGN_TOLERANCE = 0.1
 
 def merge_lyrics(original_lyrics, translated_lyrics, song_duration=None):
+    """把翻译插到对应原文之后；原文与翻译均须按时间排序（parse_lrc 的输出）。"""
     if not translated_lyrics:
         return original_lyrics
-    trans_dict = {time: text for time, text in translated_lyrics}
+    times = [time for time, _ in original_lyrics]
+    aligned = [None] * len(times)
+    for trans_time, trans_text in translated_lyrics:
+        if not trans_text.strip():
+            continue
+        i = bisect.bisect_left(times, trans_time)
+        if i > 0 and (i == len(times) or trans_time - times[i - 1] <= times[i] - trans_time):
+            # 前一行更近；同一时间的多行原文取第一行
+            i = bisect.bisect_left(times, times[i - 1])
+        if i < len(times) and abs(times[i] - trans_time) <= LYRIC_ALIGN_TOLERANCE and aligned[i] is None:
+            aligned[i] = trans_text
+    # 翻译时间落在 [本行, 下一行) 之间，按原文顺序输出即已有序，无需再排序
     merged = []
+    last = len(times) - 1
     for i, (time, text) in enumerate(original_lyrics):
         merged.append((time, text))
-        if time in trans_dict and trans_dict[time].strip():
-            trans_time = time + LYRIC_TRANSLATION_GAP
-            if i + 1 < len(original_lyrics):
-                next_time = original_lyrics[i + 1][0]
-                latest_before_next = next_time - LYRIC_TRANSLATION_GAP
-                if latest_before_next >= trans_time:
-                    trans_time = latest_before_next
-                else:
-                    trans_time = max(time, latest_before_next)
-            else:
-                tail_time = (song_duration + 0.5) if song_duration else (time + 0.5)
-                trans_time = max(trans_time, tail_time, time + LYRIC_TRANSLATION_GAP)
-            merged.append((trans_time, trans_dict[time]))
-    return sorted(merged, key=lambda x: x[0])
+        if aligned[i] is None:
+            continue
+        trans_time = time + LYRIC_TRANSLATION_GAP
+        if i < last:
+            latest_before_next = times[i + 1] - LYRIC_TRANSLATION_GAP
+            trans_time = latest_before_next if latest_before_next >= trans_time else max(time, latest_before_next)
+        else:
+            tail_time = (song_duration + 0.5) if song_duration else (time + 0.5)
+            trans_time = max(trans_time, tail_time)
+        merged.append((trans_time, aligned[i]))
+    return merged
 
 def format_lrc_line(time_seconds, text):
     minutes = int(time_seconds // 60)
@@ -969,100 +1352,978 @@ def format_lrc_line(time_seconds, text):
     return f'[{minutes:02d}:{seconds:02d}.{milliseconds:02d}]{text}'
 
 def save_lyrics_as_lrc(lyrics, file_path):
+    content = ''.join(format_lrc_line(time, text) + '\n' for time, text in lyrics)
+    with suppress(OSError):
+        # 歌词未变化（缓存命中且版本号相同）时不重写文件
+        with open(file_path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return file_path
     with open(file_path, 'w', encoding='utf-8') as f:
-        for time, text in lyrics:
-            f.write(format_lrc_line(time, text) + '\n')
+        f.write(content)
     return file_path
 
+DOWNLOAD_WORKERS = 3
+TAG_PROCESSES = None  # None 表示按 CPU 核数创建打标签进程，0 表示在线程内完成
+DOWNLOAD_CANCEL = threading.Event()
+_FAILED_LIST_LOCK = threading.Lock()
+_worker_local = threading.local()
+
+def clone_session(session):
+    """复制一份独立的 pyncm 会话（cookie/headers 相同），供下载线程各自使用。"""
+    return pyncm.LoadSessionFromString(pyncm.DumpSessionAsString(session))
+
+def init_worker_session(base_session=None):
+    """线程池 initializer：为当前线程绑定独立会话，失败时退回全局会话。"""
+    try:
+        base = base_session or pyncm.GetCurrentSession()
+        _worker_local.session = clone_session(base) if base is not None else None
+        if _worker_local.session is not None:
+            get_http_transport().attach(_worker_local.session)
+    except Exception as e:
+        if DEBUG: print(e)
+        _worker_local.session = None
+
+HTTP_POOL_HOSTS = 16
+HTTP_PREWARM = True
+
+class HttpTransport:
+    """共享 HTTP 连接池：音频、封面与接口请求复用同一组 keep-alive 连接。
+
+    每个主机最多 pool_size 条连接（pool_block=True，超出时等待而不是另开连接）；
+    prewarm() 在后台预先与新出现的 CDN 主机完成 TCP/TLS 握手。
+    """
+
+    def __init__(self, pool_size):
+        from requests.adapters import HTTPAdapter # type: ignore
+
+        class TimeoutAdapter(HTTPAdapter):
+            # pyncm 发出的请求不带超时，补上当前线程所在操作的超时（见 request_timeout）
+            def send(self, request, timeout=None, **kwargs):
+                if timeout is None:
+                    timeout = getattr(_worker_local, 'timeout', None)
+                return super().send(request, timeout=timeout, **kwargs)
+        self.pool_size = pool_size
+        self.adapter = TimeoutAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.attach(self.session)
+        self.warmed = set()
+        self.lock = threading.Lock()
+
+    def attach(self, session):
+        """让给定会话（如 pyncm 会话）使用共享连接池。"""
+        with suppress(Exception):
+            if session.get_adapter('https://') is not self.adapter:
+                session.mount('https://', self.adapter)
+                session.mount('http://', self.adapter)
+        return session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def prewarm(self, url):
+        from urllib.parse import urlsplit
+        if not HTTP_PREWARM or not url:
+            return
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        with self.lock:
+            if origin in self.warmed:
+                return
+            self.warmed.add(origin)
+
+        def warm():
+            # 响应内容无关紧要，目的是在连接池中留下一条已握手的连接
+            with suppress(Exception):
+                self.session.head(origin + '/', timeout=5, allow_redirects=False).close()
+        threading.Thread(target=warm, name='prewarm', daemon=True).start()
+
+_http_transport = None
+_http_transport_lock = threading.Lock()
+
+def get_http_transport(pool_size=None):
+    """返回共享的 HttpTransport；请求更大的连接池时重建。"""
+    global _http_transport
+    with _http_transport_lock:
+        size = max(pool_size or DOWNLOAD_WORKERS, 2)
+        if _http_transport is None or (pool_size and _http_transport.pool_size < size):
+            _http_transport = HttpTransport(size)
+            with suppress(Exception):
+                _http_transport.attach(pyncm.GetCurrentSession())
+        return _http_transport
+
+def _api_session_kwargs():
+    session = getattr(_worker_local, 'session', None)
+    return {'session': session} if session is not None else {}
+
+def _attach_api_session():
+    """确保接口请求所用的会话走共享连接池，从而应用 request_timeout 设置的超时。"""
+    with suppress(Exception):
+        session = getattr(_worker_local, 'session', None) or pyncm.GetCurrentSession()
+        if session is not None:
+            get_http_transport().attach(session)
+
+CACHE_DIR = '.ncm_cache'
+API_CACHE_ENABLED = True
+API_CACHE_TTL = {'track_detail': 7 * 86400, 'lyrics': 30 * 86400, 'playlist': 600}
+API_CACHE_MEMORY_ITEMS = 4096
+API_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class ApiCache:
+    """接口响应缓存：磁盘上每个键一个 JSON 文件，前面加一层内存 LRU。
+
+    每类接口（endpoint）有独立 TTL；磁盘总大小超过 max_bytes 时按最近使用时间淘汰。
+    """
+
+    def __init__(self, root, ttls=None, memory_items=API_CACHE_MEMORY_ITEMS, max_bytes=API_CACHE_MAX_BYTES):
+        from collections import OrderedDict
+        self.root = root
+        self.ttls = dict(API_CACHE_TTL if ttls is None else ttls)
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_bytes = None
+
+    def _path(self, endpoint, key):
+        safe_key = re.sub('[^0-9A-Za-z_.-]', '_', str(key))
+        return os.path.join(self.root, endpoint, f'{safe_key}.json')
+
+    def _remember(self, mkey, record):
+        self.memory[mkey] = record
+        self.memory.move_to_end(mkey)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, endpoint, key, allow_stale=False):
+        """返回缓存的数据；不存在或已过期（且 allow_stale 为假）时返回 None。"""
+        mkey = (endpoint, str(key))
+        with self.lock:
+            record = self.memory.get(mkey)
+            if record is not None:
+                self.memory.move_to_end(mkey)
+        if record is None:
+            path = self._path(endpoint, key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                return None
+            with suppress(OSError):
+                os.utime(path, None)
+            with self.lock:
+                self._remember(mkey, record)
+        ttl = self.ttls.get(endpoint)
+        if not allow_stale and ttl is not None and time.time() - record.get('t', 0) > ttl:
+            return None
+        return record.get('data')
+
+    def put(self, endpoint, key, data):
+        record = {'t': time.time(), 'data': data}
+        path = self._path(endpoint, key)
+        with self.lock:
+            self._remember((endpoint, str(key)), record)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+            new_size = os.path.getsize(path)
+        except OSError as e:
+            if DEBUG: print(e)
+            return
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = self._scan_size()
+            else:
+                self.disk_bytes += new_size - old_size
+            over = self.disk_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def _scan_size(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                with suppress(OSError):
+                    total += os.path.getsize(os.path.join(dirpath, fn))
+        return total
+
+    def evict(self):
+        """删除最久未使用的文件，直到磁盘占用降到上限的 90%。"""
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                p = os.path.join(dirpath, fn)
+                with suppress(OSError):
+                    st = os.stat(p)
+                    files.append((st.st_mtime, st.st_size, p))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, p in files:
+            if total <= target:
+                break
+            with suppress(OSError):
+                os.remove(p)
+                total -= size
+        with self.lock:
+            self.disk_bytes = total
+            self.memory.clear()
+
+_api_cache = None
+_api_cache_lock = threading.Lock()
+
+def get_api_cache():
+    global _api_cache
+    if not API_CACHE_ENABLED:
+        return None
+    with _api_cache_lock:
+        if _api_cache is None:
+            _api_cache = ApiCache(os.path.join(CACHE_DIR, 'api'))
+        return _api_cache
+
+def lyric_versions(lyric_data):
+    return [(lyric_data.get(k) or {}).get('version') for k in ('lrc', 'tlyric')]
+
+def merge_lyric_sections(stale, rsp):
+    """合并按版本号增量获取的歌词：响应中没有新内容的部分沿用缓存。"""
+    merged = dict(rsp)
+    for key in ('lrc', 'tlyric'):
+        section = rsp.get(key) or {}
+        cached = stale.get(key) or {}
+        if not section.get('lyric') and cached.get('lyric') and section.get('version') in (None, cached.get('version')):
+            merged[key] = stale[key]
+    return merged
+
+# 自适应并发：按 ADAPTIVE_WINDOW 秒的窗口统计成功率、错误码与总吞吐量，
+# 分别调整接口请求与音频下载的并发数（加性增、乘性减）
+ADAPTIVE_CONCURRENCY = True
+ADAPTIVE_WINDOW = 5.0
+ADAPTIVE_API_LIMITS = (1, 4, 16)  # (最小, 初始, 最大)
+# 视为限流的接口返回码；一个窗口内空链接比例超过 ADAPTIVE_EMPTY_URL_RATIO 也按限流处理
+THROTTLE_CODES = {-460, -447, 405, 429, 503}
+ADAPTIVE_EMPTY_URL_RATIO = 0.5
+CONCURRENCY_LOG = os.path.join(CACHE_DIR, 'concurrency.log')
+
+class ResizableLimiter:
+    """上限可在运行中调整的信号量，并记录窗口内是否出现排队与最高占用。"""
+
+    def __init__(self, limit, minimum, maximum):
+        self.minimum, self.maximum = minimum, maximum
+        self.limit = max(minimum, min(maximum, limit))
+        self.active = 0
+        self.contended = 0
+        self.peak = 0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            if self.active >= self.limit:
+                self.contended += 1
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def resize(self, limit):
+        with self.cond:
+            self.limit = max(self.minimum, min(self.maximum, limit))
+            self.cond.notify_all()
+            return self.limit
+
+    def reset_window(self):
+        with self.cond:
+            self.contended = 0
+            self.peak = self.active
+
+class ConcurrencyController:
+    """AIMD 并发控制器。
+
+    接口：出现限流码、失败或大量空链接时并发减半；窗口内无错误且有请求排队时加一。
+    下载：出现 403/429/5xx 或失败率过高时减半；并发已用满且总吞吐量仍在提升时加一，
+    加一后吞吐量反而下降则撤回。每个窗口的统计与决策都写入 CONCURRENCY_LOG。
+    """
+
+    def __init__(self, downloads=None, max_downloads=None, bytes_source=None, log=None):
+        downloads = downloads or DOWNLOAD_WORKERS
+        api_min, api_start, api_max = ADAPTIVE_API_LIMITS
+        self.api = ResizableLimiter(api_start, api_min, api_max)
+        self.downloads = ResizableLimiter(downloads, 1, max_downloads or downloads)
+        self.bytes_source = bytes_source
+        self.log = log
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_bytes = bytes_source() if bytes_source else 0
+        self.prev_bps = None
+        self.last_download_action = None
+        self.stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return {'api_calls': 0, 'api_failed': 0, 'api_throttled': 0, 'url_entries': 0, 'url_empty': 0, 'codes': {}, 'dl_ok': 0, 'dl_failed': 0, 'dl_throttled': 0}
+
+    def record_api(self, code, ok=True):
+        with self.lock:
+            self.stats['api_calls'] += 1
+            if code is not None and code != 200:
+                self.stats['codes'][code] = self.stats['codes'].get(code, 0) + 1
+            if code in THROTTLE_CODES:
+                self.stats['api_throttled'] += 1
+            elif not ok or (code is not None and code != 200):
+                self.stats['api_failed'] += 1
+        self.maybe_adjust()
+
+    def record_urls(self, total, empty):
+        with self.lock:
+            self.stats['url_entries'] += total
+            self.stats['url_empty'] += empty
+
+    def record_download(self, ok, status=None):
+        with self.lock:
+            if status in (403, 429) or (status is not None and status >= 500):
+                self.stats['dl_throttled'] += 1
+            self.stats['dl_ok' if ok else 'dl_failed'] += 1
+        self.maybe_adjust()
+
+    def _write_log(self, line, important):
+        with suppress(Exception):
+            os.makedirs(os.path.dirname(CONCURRENCY_LOG) or '.', exist_ok=True)
+            with open(CONCURRENCY_LOG, 'a', encoding='utf-8') as f:
+                f.write(time.strftime('%Y-%m-%d %H:%M:%S ') + line + '\n')
+        if important and self.log is not None:
+            self.log(f'\x1b[2m* {line}\x1b[0m')
+
+    def maybe_adjust(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            elapsed = now - self.window_start
+            if elapsed < ADAPTIVE_WINDOW:
+                return
+            stats, self.stats = self.stats, self._empty_stats()
+            total_bytes = self.bytes_source() if self.bytes_source else 0
+            bps = (total_bytes - self.window_bytes) / elapsed
+            self.window_start, self.window_bytes = now, total_bytes
+            api, dl = self.api, self.downloads
+            api_old, dl_old = api.limit, dl.limit
+            reasons = []
+            # 接口并发
+            empty_ratio = stats['url_empty'] / stats['url_entries'] if stats['url_entries'] >= 10 else 0.0
+            if stats['api_throttled'] or empty_ratio > ADAPTIVE_EMPTY_URL_RATIO:
+                api.resize(api.limit // 2)
+                reasons.append(f"接口限流(返回码 {stats['codes']}, 空链接 {stats['url_empty']}/{stats['url_entries']})")
+            elif stats['api_failed'] > max(1, stats['api_calls'] // 20):
+                api.resize(api.limit // 2)
+                reasons.append(f"接口失败 {stats['api_failed']}/{stats['api_calls']}")
+            elif stats['api_calls'] and api.contended:
+                api.resize(api.limit + 1)
+            # 下载并发
+            finished = stats['dl_ok'] + stats['dl_failed']
+            if stats['dl_throttled'] or (finished >= 4 and stats['dl_failed'] / finished > 0.2):
+                dl.resize(dl.limit // 2)
+                self.last_download_action = 'decrease'
+                reasons.append(f"下载受限或失败 {stats['dl_failed']}/{finished}")
+            elif self.last_download_action == 'increase' and self.prev_bps and bps < self.prev_bps * 0.9:
+                dl.resize(dl.limit - 1)
+                self.last_download_action = 'revert'
+            elif dl.peak >= dl.limit and bps > 0 and (self.prev_bps is None or bps > self.prev_bps * 1.05):
+                dl.resize(dl.limit + 1)
+                self.last_download_action = 'increase'
+            else:
+                self.last_download_action = None
+            self.prev_bps = bps
+            api.reset_window()
+            dl.reset_window()
+        line = (f"接口并发 {api_old}→{api.limit}, 下载并发 {dl_old}→{dl.limit}, {bps / 1024 / 1024:.2f}MB/s, "
+                f"接口 {stats['api_calls']} 次(失败 {stats['api_failed']}, 限流 {stats['api_throttled']}), 下载完成 {stats['dl_ok']} 失败 {stats['dl_failed']}")
+        if reasons:
+            line += '；' + '；'.join(reasons)
+        self._write_log(line, bool(reasons))
+
+_concurrency = None
+_concurrency_lock = threading.Lock()
+
+def get_concurrency_controller():
+    global _concurrency
+    with _concurrency_lock:
+        if _concurrency is None:
+            _concurrency = ConcurrencyController()
+        return _concurrency
+
+def set_concurrency_controller(controller):
+    global _concurrency
+    with _concurrency_lock:
+        _concurrency = controller
+
+def call_api(func, *args, **kwargs):
+    """在接口并发限制内调用 pyncm 接口，并把结果反馈给并发控制器。"""
+    _attach_api_session()
+    if not ADAPTIVE_CONCURRENCY:
+        return func(*args, **kwargs, **_api_session_kwargs())
+    controller = get_concurrency_controller()
+    with controller.api:
+        try:
+            rsp = func(*args, **kwargs, **_api_session_kwargs())
+        except (Timeout, ConnectionError, RequestException):
+            controller.record_api(None, ok=False)
+            raise
+    controller.record_api(rsp.get('code') if isinstance(rsp, dict) else None)
+    return rsp
+
 @retry_with_timeout(timeout=30, retry_times=2, operation_name='获取歌词')
 def get_track_lyrics(track_id):
-    return track.GetTrackLyrics(track_id)
+    cache = get_api_cache()
+    if cache is None:
+        return call_api(track.GetTrackLyrics, track_id)
+    cached = cache.get('lyrics', track_id)
+    if cached is not None:
+        return cached
+    stale = cache.get('lyrics', track_id, allow_stale=True)
+    if stale is None:
+        rsp = call_api(track.GetTrackLyrics, track_id)
+    else:
+        # 带上已缓存的版本号，服务端只返回有更新的部分
+        lv, tv = (-1 if v is None else v for v in lyric_versions(stale))
+        rsp = call_api(track.GetTrackLyrics, track_id, lv=lv, tv=tv)
+        if isinstance(rsp, dict) and rsp.get('code') == 200:
+            rsp = merge_lyric_sections(stale, rsp)
+    if isinstance(rsp, dict) and rsp.get('code') == 200:
+        cache.put('lyrics', track_id, rsp)
+    return rsp
+
+class TrackRecord:
+    """曲目信息：只保留下载与打标签用到的字段。
+
+    接口返回的歌曲字典带有大量用不到的字段，解析后立即转换为本类，运行期间只持有精简对象。
+    """
+    __slots__ = ('id', 'name', 'artists', 'album_id', 'album', 'pic_url', 'no', 'dt', 'publish_time')
+
+    def __init__(self, id, name='', artists=(), album_id=None, album='', pic_url=None, no=0, dt=0, publish_time=0):
+        self.id = id
+        self.name = name
+        self.artists = tuple(artists)
+        self.album_id = album_id
+        self.album = album
+        self.pic_url = pic_url
+        self.no = no
+        self.dt = dt
+        self.publish_time = publish_time
+
+    @classmethod
+    def from_song(cls, song):
+        """由接口的歌曲字典（或 to_song() 的精简字典）创建。"""
+        al = song.get('al') or {}
+        return cls(song.get('id'), song.get('name') or '', (a.get('name') or '' for a in song.get('ar') or []),
+                   al.get('id'), al.get('name') or '', al.get('picUrl'), song.get('no') or 0, song.get('dt') or 0, song.get('publishTime') or 0)
+
+    def to_song(self):
+        """转回接口格式的精简字典，用于写入缓存。"""
+        return {'id': self.id, 'name': self.name, 'ar': [{'name': name} for name in self.artists],
+                'al': {'id': self.album_id, 'name': self.album, 'picUrl': self.pic_url}, 'no': self.no, 'dt': self.dt, 'publishTime': self.publish_time}
+
+    @property
+    def artist_name(self):
+        return ', '.join(self.artists)
+
+    def __repr__(self):
+        return f'TrackRecord(id={self.id!r}, name={self.name!r})'
+
+    def __reduce__(self):
+        # 打标签时会被发送到进程池，需按可导入的类还原
+        return (_importable(TrackRecord), tuple(getattr(self, name) for name in self.__slots__))
 
 @retry_with_timeout(timeout=30, retry_times=2, operation_name='获取曲目详情')
 def get_track_detail(track_ids):
-    return track.GetTrackDetail(track_ids)
+    """返回 {'code': 200, 'songs': [TrackRecord, ...]}，已缓存的曲目不再请求。"""
+    cache = get_api_cache()
+    songs = {}
+    missing = []
+    for tid in track_ids:
+        cached = cache.get('track_detail', tid) if cache is not None else None
+        if cached is not None:
+            songs[str(tid)] = TrackRecord.from_song(cached)
+        else:
+            missing.append(tid)
+    if missing:
+        rsp = call_api(track.GetTrackDetail, missing)
+        if not isinstance(rsp, dict) or rsp.get('code', 200) != 200:
+            return rsp
+        for song in rsp.get('songs') or []:
+            record = TrackRecord.from_song(song)
+            songs[str(record.id)] = record
+            if cache is not None:
+                cache.put('track_detail', record.id, record.to_song())
+    return {'code': 200, 'songs': [songs[str(tid)] for tid in track_ids if str(tid) in songs]}
 
 @retry_with_timeout(timeout=30, retry_times=2, operation_name='获取歌曲下载链接')
 def get_track_audio(song_ids, level, encode_type):
-    return track.GetTrackAudioV1(song_ids=song_ids, level=level, encodeType=encode_type)
+    return call_api(track.GetTrackAudioV1, song_ids=song_ids, level=level, encodeType=encode_type)
+
+PLAYLIST_META_MAX_AGE = 60  # 秒；预览时取到的歌单元数据在此时间内直接用于校验快照，不再重复请求
+_playlist_meta = {}
+_playlist_meta_lock = threading.Lock()
+
+def playlist_snapshot(info):
+    """歌单快照标识：更新时间 + trackIds 校验值，任一变化即视为歌单已改动。"""
+    import hashlib
+    ids = ','.join(str(t.get('id')) for t in info.get('trackIds') or [])
+    return {'update_time': info.get('updateTime'), 'track_update_time': info.get('trackUpdateTime'),
+            'digest': hashlib.md5(ids.encode('utf-8')).hexdigest()}
+
+@retry_with_timeout(timeout=30, retry_times=2, operation_name='获取歌单信息')
+def get_playlist_meta(playlist_id):
+    """轻量获取歌单元数据（名称、曲目数、第一首、快照标识、全部曲目 ID），不拉取曲目详情。"""
+    rsp = call_api(playlist.GetPlaylistInfo, playlist_id, limit=1)
+    if not isinstance(rsp, dict) or rsp.get('code') != 200 or not rsp.get('playlist'):
+        return rsp
+    info = rsp['playlist']
+    tracks = info.get('tracks') or []
+    track_ids = [t['id'] for t in info.get('trackIds') or []]
+    meta = {'code': 200, 'id': str(playlist_id), 'name': info.get('name'), 'count': info.get('trackCount', len(track_ids)),
+            'first': tracks[0].get('name') if tracks else None, 'snapshot': playlist_snapshot(info), 'track_ids': track_ids}
+    with _playlist_meta_lock:
+        _playlist_meta[str(playlist_id)] = (time.monotonic(), meta)
+    return meta
+
+def recent_playlist_meta(playlist_id):
+    """返回 PLAYLIST_META_MAX_AGE 秒内取到的歌单元数据，没有则返回 None。"""
+    with _playlist_meta_lock:
+        entry = _playlist_meta.get(str(playlist_id))
+    if entry is None or time.monotonic() - entry[0] > PLAYLIST_META_MAX_AGE:
+        return None
+    return entry[1]
+
+PLAYLIST_PAGE_SIZE = 500  # 歌单曲目详情每页请求的数量
+
+def iter_playlist_tracks(meta, errors=None, page_size=PLAYLIST_PAGE_SIZE):
+    """按页（offset + limit）获取歌单曲目详情并逐首产出，下载不必等整张歌单取完。
 
-@retry_with_timeout(timeout=30, retry_times=2, operation_name='获取播放列表')
-def get_playlist_all_tracks(playlist_id):
-    return playlist.GetPlaylistAllTracks(playlist_id)
+    meta 为 get_playlist_meta() 的结果；某页获取失败时，其中的 (曲目 ID, 原因) 追加到 errors 后继续下一页。
+    完整取到的曲目列表按快照标识缓存，歌单未改动时直接复用，不受缓存有效期限制。
+    """
+    cache = get_api_cache() if meta.get('id') else None
+    if cache is not None:
+        cached = cache.get('playlist', meta['id'], allow_stale=True)
+        if cached is not None and cached.get('snapshot') == meta['snapshot']:
+            yield from (TrackRecord.from_song(song) for song in cached['songs'])
+            return
+    records, complete = [], True
+    track_ids = meta['track_ids']
+    for offset in range(0, len(track_ids), page_size):
+        page = track_ids[offset:offset + page_size]
+        detail, error = get_track_detail(page)
+        songs = [] if error or not isinstance(detail, dict) else detail.get('songs') or []
+        found = {song.id for song in songs}
+        missing = [tid for tid in page if tid not in found]
+        if missing:
+            complete = False
+            if errors is not None:
+                errors.extend((tid, error or '获取曲目信息失败') for tid in missing)
+        if cache is not None:
+            records.extend(songs)
+        yield from songs
+    if cache is not None and complete:
+        cache.put('playlist', meta['id'], {'code': 200, 'songs': [record.to_song() for record in records], 'snapshot': meta['snapshot']})
+
+URL_BATCH_SIZE = 200
+URL_EXPIRY_MARGIN = 60
+
+class TrackUrlResolver:
+    """批量解析下载链接：一次 GetTrackAudioV1 请求携带多个 song_ids，结果按曲目 ID 缓存。
+
+    链接到期（响应中的 expi）或被 invalidate() 标记失效时，只重新解析对应条目。
+    """
+
+    def __init__(self, level, encode_type='flac', batch_size=URL_BATCH_SIZE):
+        self.level = level
+        self.encode_type = encode_type
+        self.batch_size = max(1, batch_size)
+        self.entries = {}
+        self.errors = {}
+        self.upcoming = []
+        self.inflight = {}  # 曲目 ID -> 正在请求其所在批次的 Event
+        self.lock = threading.Lock()
+
+    def hint(self, track_ids):
+        """告知即将请求的曲目 ID，后续解析时按顺序凑满一批。"""
+        with self.lock:
+            self.upcoming.extend(track_ids)
+
+    def invalidate(self, track_id):
+        with self.lock:
+            self.entries.pop(track_id, None)
+            self.errors.pop(track_id, None)
+
+    def _valid(self, track_id, now):
+        cached = self.entries.get(track_id)
+        return cached is not None and cached[1] > now
+
+    def _take_batch(self, track_id, now):
+        """从 upcoming 中取出与 track_id 一起请求的曲目（调用时须持有锁）。"""
+        batch = [track_id]
+        seen = {track_id}
+        rest = []
+        for tid in self.upcoming:
+            if tid in seen or tid in self.errors or tid in self.inflight or self._valid(tid, now):
+                continue
+            seen.add(tid)
+            if len(batch) < self.batch_size:
+                batch.append(tid)
+            else:
+                rest.append(tid)
+        self.upcoming = rest
+        return batch
+
+    def _fetch(self, track_ids):
+        # 网络请求（含重试等待）不持有锁，只在写入结果时加锁
+        now = time.time()
+        url_info, error = get_track_audio(list(track_ids), self.level, self.encode_type)
+        if error or not url_info or not url_info.get('data'):
+            reason = error or '获取下载链接返回无效数据'
+            with self.lock:
+                for tid in track_ids:
+                    self.errors[tid] = reason
+            return
+        returned = set()
+        if ADAPTIVE_CONCURRENCY:
+            get_concurrency_controller().record_urls(len(url_info['data']), sum(1 for e in url_info['data'] if not e.get('url')))
+        with self.lock:
+            for entry in url_info['data']:
+                tid = entry.get('id')
+                if tid is None:
+                    continue
+                returned.add(tid)
+                expi = entry.get('expi') or 1200
+                self.entries[tid] = (entry, now + max(expi - URL_EXPIRY_MARGIN, 30))
+                self.errors.pop(tid, None)
+            for tid in track_ids:
+                if tid not in returned:
+                    self.errors[tid] = '获取下载链接返回无效数据'
+        for entry in url_info['data']:
+            if entry.get('id') is not None and entry.get('url'):
+                get_http_transport().prewarm(entry['url'])
 
-def process_lyrics(track_id, track_name, artist_name, output_option, download_path, audio_file_path=None):
+    def _result(self, track_id):
+        with self.lock:
+            if self._valid(track_id, time.time()):
+                return (self.entries[track_id][0], None)
+            return (None, self.errors.get(track_id, '获取下载链接返回无效数据'))
+
+    def get(self, track_id):
+        """返回 (data 条目, 错误)，必要时与后续曲目合并为一批请求。
+
+        已缓存的链接直接返回；所需曲目正由其他线程请求时只等待那一批，不阻塞其他曲目的解析。
+        """
+        while True:
+            with self.lock:
+                if self._valid(track_id, time.time()):
+                    return (self.entries[track_id][0], None)
+                pending = self.inflight.get(track_id)
+                if pending is None:
+                    # 批量请求中失败的条目单独再试一次，避免一首异常拖累整批
+                    retry = track_id in self.errors
+                    batch = [track_id] if retry else self._take_batch(track_id, time.time())
+                    done = threading.Event()
+                    for tid in batch:
+                        self.inflight[tid] = done
+                    break
+            pending.wait()
+        try:
+            self._fetch(batch)
+            if not retry and len(batch) > 1 and self._result(track_id)[0] is None:
+                self._fetch([track_id])
+        finally:
+            with self.lock:
+                for tid in batch:
+                    if self.inflight.get(tid) is done:
+                        del self.inflight[tid]
+            done.set()
+        return self._result(track_id)
+
+def process_lyrics(track_id, track_name, artist_name, output_option, download_path, audio_file_path=None, song_duration=None, progress=None):
+    log = progress.log if progress is not None else print
     try:
         lyric_data, error = get_track_lyrics(track_id)
         if error or not lyric_data or lyric_data.get('code') != 200 or ('lrc' not in lyric_data):
-            print(f'\x1b[33m! 无法获取歌词: {track_name}\x1b[0m\x1b[K')
+            log(f'\x1b[33m! 无法获取歌词: {track_name}\x1b[0m\x1b[K')
             return (False, None)
-        track_detail, error = get_track_detail([track_id])
-        song_duration = None
-        if not error and track_detail and ('songs' in track_detail) and track_detail['songs']:
-            song_duration = track_detail['songs'][0].get('dt', 0) / 1000
+        if song_duration is None:
+            track_detail, error = get_track_detail([track_id])
+            if not error and track_detail and ('songs' in track_detail) and track_detail['songs']:
+                song_duration = track_detail['songs'][0].dt / 1000
         original_lyrics = parse_lrc(lyric_data['lrc']['lyric'])
         translated_lyrics = []
         if 'tlyric' in lyric_data and lyric_data['tlyric']['lyric']:
             translated_lyrics = parse_lrc(lyric_data['tlyric']['lyric'])
         merged_lyrics = merge_lyrics(original_lyrics, translated_lyrics, song_duration)
         if not merged_lyrics:
-            print(f'\x1b[33m! 未找到有效歌词: {track_name}\x1b[0m\x1b[K')
+            log(f'\x1b[33m! 未找到有效歌词: {track_name}\x1b[0m\x1b[K')
             return (False, None)
         if output_option == 'lrc' or (output_option == 'both' and download_path):
             safe_artist_name = re.sub('[\\\\/*?:"<>|]', '-', artist_name)
             safe_track_name = re.sub('[\\\\/*?:"<>|]', '-', track_name)
             lrc_path = os.path.join(download_path, f'{safe_track_name} - {safe_artist_name}.lrc')
             save_lyrics_as_lrc(merged_lyrics, lrc_path)
-            print(f'\x1b[32m✓ \x1b[0m歌词已保存到 {lrc_path}\x1b[K')
+            log(f'\x1b[32m✓ \x1b[0m歌词已保存到 {lrc_path}\x1b[K')
         if (output_option == 'metadata' or output_option == 'both') and audio_file_path:
             lrc_content = '\n'.join([format_lrc_line(time, text) for time, text in merged_lyrics])
             return (True, lrc_content)
         return (True, None)
     except Exception as e:
-        print(f'\x1b[33m! 处理歌词时出错: {e}\x1b[0m\x1b[K')
+        log(f'\x1b[33m! 处理歌词时出错: {e}\x1b[0m\x1b[K')
         write_to_failed_list(track_id, track_name, artist_name, f'处理歌词失败: {e}', download_path)
         return (False, None)
 
-def add_metadata_to_audio(file_path, track_info, lyrics_content=None):
-    if not MUTAGEN_INSTALLED:
-        print('\x1b[33m! 未安装mutagen库，跳过添加元数据\x1b[0m\x1b[K')
-        return
+COVER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+COVER_MEMORY_ITEMS = 64
+
+class CoverCache:
+    """专辑封面缓存：按专辑 ID + picUrl 摘要存放封面字节及其宽高/MIME。
+
+    同一运行中并发请求同一封面时只下载一次；磁盘部分按最近使用时间在字节预算内淘汰。
+    """
+
+    def __init__(self, root, max_bytes=COVER_CACHE_MAX_BYTES, memory_items=COVER_MEMORY_ITEMS):
+        from collections import OrderedDict
+        self.root = root
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.disk_bytes = None
+
+    @staticmethod
+    def key_for(track_info):
+        import hashlib
+        url = track_info.pic_url
+        if not url:
+            return None
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return f"{track_info.album_id or 'url'}_{digest}"
+
+    def _remember(self, key, cover):
+        self.memory[key] = cover
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _load(self, key):
+        base = os.path.join(self.root, key)
+        try:
+            with open(base + '.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(base + '.bin', 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        if len(data) != meta.get('size') or not meta.get('width'):
+            return None
+        with suppress(OSError):
+            os.utime(base + '.bin', None)
+        return dict(meta, data=data)
+
+    def _store(self, key, cover):
+        base = os.path.join(self.root, key)
+        meta = {k: v for k, v in cover.items() if k != 'data'}
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f'{base}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(cover['data'])
+            os.replace(tmp, base + '.bin')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp, base + '.json')
+        except OSError as e:
+            if DEBUG: print(e)
+            return
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(os.path.getsize(os.path.join(self.root, fn)) for fn in os.listdir(self.root) if fn.endswith('.bin'))
+            else:
+                self.disk_bytes += cover['size']
+            over = self.disk_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for fn in os.listdir(self.root):
+            if fn.endswith('.bin'):
+                p = os.path.join(self.root, fn)
+                with suppress(OSError):
+                    st = os.stat(p)
+                    entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            for suffix in ('.bin', '.json'):
+                with suppress(OSError):
+                    os.remove(p[:-4] + suffix)
+            total -= size
+        with self.lock:
+            self.disk_bytes = total
+
+    def _download(self, url):
+        response = get_http_transport().get(url, timeout=30)
+        if response.status_code != 200 or not response.content:
+            return None
+        data = response.content
+        header = read_image_header(data)
+        if header is None:
+            # 无法确认格式与尺寸的封面不嵌入，避免写入错误的 MIME 和 0×0 尺寸
+            if DEBUG: print(f'无法识别的封面格式: {url}')
+            return None
+        mime, width, height = header
+        return {'data': data, 'mime': mime, 'width': width, 'height': height, 'size': len(data), 'url': url}
+
+    def get(self, track_info):
+        """返回封面字典 {'data', 'mime', 'width', 'height', ...}，没有封面时返回 None。"""
+        key = self.key_for(track_info)
+        if key is None:
+            return None
+        while True:
+            with self.lock:
+                cover = self.memory.get(key)
+                if cover is not None:
+                    self.memory.move_to_end(key)
+                    return cover
+                waiter = self.inflight.get(key)
+                if waiter is None:
+                    waiter = self.inflight[key] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                # 其它线程正在获取同一封面，等待其完成后从内存读取
+                waiter.wait()
+                with self.lock:
+                    if key in self.memory:
+                        continue
+                return None
+            try:
+                cover = self._load(key)
+                if cover is None:
+                    cover = self._download(track_info.pic_url)
+                    if cover is not None:
+                        self._store(key, cover)
+                if cover is not None:
+                    with self.lock:
+                        self._remember(key, cover)
+                return cover
+            finally:
+                with self.lock:
+                    self.inflight.pop(key, None)
+                waiter.set()
+
+_cover_cache = None
+
+def get_cover_cache():
+    global _cover_cache
+    with _api_cache_lock:
+        if _cover_cache is None:
+            _cover_cache = CoverCache(os.path.join(CACHE_DIR, 'covers'))
+        return _cover_cache
+
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def read_image_header(data):
+    """从 JPEG/PNG/GIF 文件头读取 (MIME, 宽, 高)，不解码图像；无法识别（WebP 等其他格式或数据损坏）时返回 None。"""
+    import struct
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', data[16:24])
+        return ('image/png', width, height)
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = struct.unpack('<HH', data[6:10])
+        return ('image/gif', width, height)
+    if data[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # 填充字节与不带长度的标记
+                i += 1 if marker == 0xFF else 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                return ('image/jpeg', width, height)
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+def fetch_album_cover(track_info):
+    return get_cover_cache().get(track_info)
+
+def keep_padding(info):
+    """mutagen 的填充策略：已有填充足够时原样保留，标签在原位写入而不移动音频数据。"""
+    return info.padding if info.padding >= 0 else info.get_default_padding()
+
+def add_metadata_to_audio(file_path, track_info, lyrics_content=None, cover=None, audio=None, fileobj=None, log=print):
+    """写入标题、艺术家、专辑、封面与歌词。
+
+    audio、fileobj 为调用方已打开的 mutagen 对象与文件句柄（rb+），传入时直接在该句柄上写入。
+    提示信息交给 log 输出，在工作线程/进程中调用时由调用方收集。
+    """
+    try:
+        from mutagen import File as MutagenFile # pyright: ignore[reportMissingImports]
+        from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TRCK, TDRC # pyright: ignore[reportMissingImports]
+        from mutagen.flac import FLAC, Picture # pyright: ignore[reportMissingImports]
+    except ImportError:
+        log('\x1b[33m! 未安装mutagen库，跳过添加元数据\x1b[0m\x1b[K')
+        return False
     try:
         file_ext = os.path.splitext(file_path)[1].lower()
-        album_pic_url = track_info.get('al', {}).get('picUrl')
-        album_pic_data = None
-        if album_pic_url:
-            response = requests.get(album_pic_url)
-            if response.status_code == 200:
-                album_pic_data = response.content
-        title = track_info.get('name', '')
-        artist = ', '.join((artist['name'] for artist in track_info.get('ar', [])))
-        album = track_info.get('al', {}).get('name', '')
-        track_number = str(track_info.get('no', '0'))
-        release_time = track_info.get('publishTime', 0)
+        if cover is None:
+            cover = fetch_album_cover(track_info)
+        title = track_info.name
+        artist = track_info.artist_name
+        album = track_info.album
+        track_number = str(track_info.no)
+        release_time = track_info.publish_time
         if release_time > 0:
             release_year = time.strftime('%Y', time.localtime(release_time / 1000))
         else:
             release_year = ''
+        target = fileobj if fileobj is not None else file_path
+        if audio is None and fileobj is None:
+            with suppress(Exception):
+                audio = MutagenFile(file_path)
         if file_ext == '.mp3':
-            try:
-                audio = ID3(file_path)
-            except:
-                audio = ID3()
-            audio['TIT2'] = TIT2(encoding=3, text=title)
-            audio['TPE1'] = TPE1(encoding=3, text=artist)
-            audio['TALB'] = TALB(encoding=3, text=album)
-            audio['TRCK'] = TRCK(encoding=3, text=track_number)
+            if audio is None:
+                tags = ID3()  # 无法识别的文件仍写入新的 ID3 标签
+            else:
+                if audio.tags is None:
+                    audio.add_tags()
+                tags = audio.tags
+            tags['TIT2'] = TIT2(encoding=3, text=title)
+            tags['TPE1'] = TPE1(encoding=3, text=artist)
+            tags['TALB'] = TALB(encoding=3, text=album)
+            tags['TRCK'] = TRCK(encoding=3, text=track_number)
             if release_year:
-                audio['TDRC'] = TDRC(encoding=3, text=release_year)
-            if album_pic_data:
-                audio['APIC'] = APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=album_pic_data)
+                tags['TDRC'] = TDRC(encoding=3, text=release_year)
+            if cover:
+                tags['APIC'] = APIC(encoding=3, mime=cover['mime'], type=3, desc='Cover', data=cover['data'])
             if lyrics_content:
                 from mutagen.id3 import USLT # pyright: ignore[reportMissingImports]
-                audio['USLT'] = USLT(encoding=3, lang='eng', desc='', text=lyrics_content)
-            audio.save(file_path)
+                tags['USLT'] = USLT(encoding=3, lang='eng', desc='', text=lyrics_content)
+            tags.save(target, padding=keep_padding)
         elif file_ext == '.flac':
-            audio = FLAC(file_path)
+            if audio is None:
+                audio = FLAC(target)
+            if audio.tags is None:
+                audio.add_tags()
             audio['TITLE'] = title
             audio['ARTIST'] = artist
             audio['ALBUM'] = album
@@ -1071,20 +2332,21 @@ def add_metadata_to_audio(file_path, track_info, lyrics_content=None):
                 audio['DATE'] = release_year
             if lyrics_content:
                 audio['LYRICS'] = lyrics_content
-            if album_pic_data:
+            if cover:
                 image = Picture()
                 image.type = 3
-                image.mime = 'image/jpeg'
+                image.mime = cover['mime']
                 image.desc = 'Cover'
-                image.data = album_pic_data
-                img = Image.open(BytesIO(album_pic_data))
-                image.width, image.height = img.size
+                image.data = cover['data']
+                image.width, image.height = cover['width'], cover['height']
                 image.depth = 24
                 audio.add_picture(image)
-            audio.save()
-        print(f'\x1b[32m✓ \x1b[0m已为 {os.path.basename(file_path)} 添加元数据\x1b[K')
+            audio.save(target, padding=keep_padding)
+        log(f'\x1b[32m✓ \x1b[0m已为 {os.path.basename(file_path)} 添加元数据\x1b[K')
+        return True
     except Exception as e:
-        print(f'\x1b[33m! 添加元数据时出错: {e}\x1b[0m\x1b[K')
+        log(f'\x1b[33m! 添加元数据时出错: {e}\x1b[0m\x1b[K')
+        return False
 
 def normalize_path(path):
     if path:
@@ -1106,408 +2368,1757 @@ def normalize_path(path):
             return default_path
     return normalized_path
 
-def get_playlist_tracks_and_save_info(playlist_id, level, download_path):
-    try:
-        tracks, error = get_playlist_all_tracks(playlist_id)
-        if error:
-            print(f'\x1b[31m× 获取歌单列表时出错: {error}\x1b[0m\x1b[K')
-            return
-        if not tracks or 'songs' not in tracks:
-            print('\x1b[31m× 获取歌单列表返回无效数据\x1b[0m\x1b[K')
-            return
-        if not os.path.exists(download_path):
-            os.makedirs(download_path)
-        playlist_info_filename = os.path.join(download_path, f'!#_playlist_{playlist_id}_info.txt')
-        with open(playlist_info_filename, 'w', encoding='utf-8') as f:
-            for track_info in tracks['songs']:
-                track_id = track_info['id']
-                track_name = track_info['name']
-                artist_name = ', '.join((artist['name'] for artist in track_info['ar']))
-                f.write(f'{track_id} - {track_name} - {artist_name}\n')
-        print(f'\x1b[32m✓ \x1b[0m歌单信息已保存到 {playlist_info_filename}')
-        total_tracks = len(tracks['songs'])
-        for index, track_info in enumerate(tracks['songs'], start=1):
-            track_id = track_info['id']
-            track_name = track_info['name']
-            artist_name = ', '.join((artist['name'] for artist in track_info['ar']))
-            download_and_save_track(track_id, track_name, artist_name, level, download_path, track_info, index, total_tracks)
-        print('=' * terminal_width + '\x1b[K')
-        print(f'\x1b[32m✓ 操作已完成，歌曲已下载并保存到 \x1b[36m{download_path}\x1b[32m 文件夹中。\x1b[0m\x1b[K')
-    except Exception as e:
-        print(f'\x1b[31m× 获取歌单列表或下载歌曲时出错: {e}\x1b[0m\x1b[K')
+MANIFEST_NAME = '!#_manifest.json'
+MANIFEST_SAVE_EVERY = 50  # 每记录这么多首写一次清单，其余在流水线结束时写入
+# 音质高低顺序，用于判断本地文件是否需要升级
+LEVEL_RANK = {'standard': 0, 'higher': 1, 'exhigh': 2, 'lossless': 3, 'hires': 4, 'jyeffect': 5, 'sky': 6, 'jymaster': 7}
 
-def get_track_info(track_id, level, download_path):
-    try:
-        track_info_rsp, error = get_track_detail([track_id])
-        if error:
-            print(f'\x1b[31m× 获取歌曲信息时出错: {error}\x1b[0m\x1b[K')
-            return
-        if not track_info_rsp or 'songs' not in track_info_rsp or (not track_info_rsp['songs']):
-            print(f'\x1b[31m× 获取歌曲信息返回无效数据\x1b[0m\x1b[K')
-            return
-        track_info = track_info_rsp['songs'][0]
-        track_id = track_info['id']
-        track_name = track_info['name']
-        artist_name = ', '.join((artist['name'] for artist in track_info.get('ar', [])))
-        download_and_save_track(track_id, track_name, artist_name, level, download_path, track_info, 1, 1)
-        print(f'\x1b[32m✓ \x1b[0m歌曲 {track_name} 已保存到 {download_path} 文件夹中。\x1b[K')
-    except Exception as e:
-        print(f'\x1b[31m! 获取歌曲信息时出错: {e}\x1b[0m\x1b[K')
+def file_checksum(path):
+    with open(path, 'rb') as f:
+        return stream_checksum(f)
 
-def download_and_save_track(track_id, track_name, artist_name, level, download_path, track_info=None, index=None, total=None):
+def stream_checksum(f):
+    """从文件句柄开头读到结尾计算 md5。"""
+    import hashlib
+    digest = hashlib.md5()
+    f.seek(0)
+    for block in iter(lambda: f.read(1024 * 1024), b''):
+        digest.update(block)
+    return digest.hexdigest()
 
-    def make_safe_filename(filename):
-        return re.sub('[\\\\/*?:"<>|]', '-', filename)
-    try:
-        url_info, error = get_track_audio([track_id], level, 'flac')
-        if error:
-            write_to_failed_list(track_id, track_name, artist_name, f'获取下载链接失败: {error}', download_path)
-            print(f'\x1b[31m! 获取曲目 {track_name} 的下载链接时出错: {error}\x1b[0m\x1b[K')
-            return
-        if not url_info or 'data' not in url_info or (not url_info['data']):
-            write_to_failed_list(track_id, track_name, artist_name, '获取下载链接返回无效数据', download_path)
-            print(f'\x1b[31m! 获取曲目 {track_name} 的下载链接返回无效数据\x1b[0m\x1b[K')
-            return
-        url = url_info['data'][0].get('url')
-        if url:
-            max_retries = 2
-            retry_count = 0
-            while retry_count <= max_retries:
-                try:
-                    response = requests.get(url, stream=True, timeout=30)
-                    if response.status_code != 200:
-                        print(f'\x1b[31m× 获取 URL 时出错: {response.status_code} - {response.text}\x1b[0m\x1b[K')
-                        write_to_failed_list(track_id, track_name, artist_name, f'HTTP错误: {response.status_code}', download_path)
-                        return
-                    content_disposition = response.headers.get('content-disposition')
-                    if content_disposition:
-                        filename = content_disposition.split('filename=')[-1].strip('"')
-                    else:
-                        filename = f'{track_id}.flac'
-                    os.makedirs(download_path, exist_ok=True)
-                    safe_filename = make_safe_filename(f'{track_name} - {artist_name}{os.path.splitext(filename)[1]}')
-                    safe_filepath = os.path.join(download_path, safe_filename)
-                    file_size = int(response.headers.get('content-length', 0))
-                    progress_status = ''
-                    # ===== 新进度条逻辑（单行反色，宽终端才启用） =====
-                    try:
-                        term_w = terminal_width  # 全局在主入口已定义
-                    except NameError:
-                        term_w, _ = get_terminal_size()
-                    digits = len(str(total)) if (index is not None and total is not None) else 0
-                    idx_str = f"[{index:0{digits}d}/{total}] " if (index is not None and total is not None) else ''
-                    # 预估基础行（用于是否采用新样式判断）
-                    base_core = f"100.0% {idx_str}正在下载:...   99.99MB/99.99MB 99999KB/s 9999s"
-                    use_single_line = term_w >= 60 and len(base_core) <= term_w - 2  # 预留一点余量
-                    downloaded = 0
-                    last_downloaded = 0
-                    last_update_time = time.time()
-                    start_time = time.time()
-                    speed = 0.0
-                    used_single_line_style = False
-                    fallback_header_printed = False  # 窄终端备用模式是否已输出首行
-
-                    def human_eta(rem_bytes, spd_bytes):
-                        if spd_bytes <= 0 or rem_bytes <= 0:
-                            return '--'
-                        eta = rem_bytes / spd_bytes
-                        if eta < 60:
-                            return f'{int(eta)}s'
-                        elif eta < 3600:
-                            m = int(eta // 60)
-                            s = int(eta % 60)
-                            return f'{m}m{s:02d}s'
-                        else:
-                            h = int(eta // 3600)
-                            m = int((eta % 3600) // 60)
-                            return f'{h}h{m:02d}m'
-
-                    # 宽度计算工具：考虑中日韩全角字符宽度=2，并修正省略号“…”等特殊字符
-
-                    def cell_width(ch: str) -> int:
-                        if not ch:
-                            return 0
-                        # 常见零宽字符（组合符号/格式控制）按0宽处理
-                        cat = unicodedata.category(ch)
-                        if cat in ('Mn', 'Me', 'Cf'):
-                            return 0
-                        # 单字符省略号在部分终端为宽字符，按2宽处理以避免对齐错位
-                        if ch == '…':
-                            return 2
-                        eaw = unicodedata.east_asian_width(ch)
-                        if eaw in ('W', 'F'):
-                            return 2
-                        if eaw == 'A' and cat.startswith('S'):
-                            return 2
-                        return 1
-
-                    def display_width(text: str) -> int:
-                        return sum(cell_width(c) for c in text)
-
-                    def truncate_filename(fname: str, max_disp: int) -> str:
-                        # 保留扩展名
-                        name_no_ext, ext = os.path.splitext(fname)
-                        ext_w = display_width(ext)
-                        ell_w = display_width('…')
-                        # 如果本身就适合
-                        if display_width(fname) <= max_disp:
-                            return fname
-                        # 预留扩展名与省略号
-                        remain = max_disp - ext_w - ell_w
-                        if remain <= 1:
-                            # 极端情况下直接截掉
-                            return '…' + ext
-                        # 截取
-                        acc = ''
-                        w = 0
-                        for ch in name_no_ext:
-                            cw = cell_width(ch)
-                            if w + cw > remain:
-                                break
-                            acc += ch
-                            w += cw
-                        return acc + '…' + ext
+class SyncManifest:
+    """下载目录中的 !#_manifest.json：记录每首已下载曲目的音质、大小、修改时间与校验值。
 
-                    with open(safe_filepath, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=64 * 1024):
-                            if not chunk:
-                                continue
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            now = time.time()
-                            # 超时 / 停滞检测（10 秒无进展）
-                            if now - last_update_time >= 10:
-                                if downloaded == last_downloaded:
-                                    print(f'\n\x1b[33m! 下载 {safe_filename} 停滞，正在重试...\x1b[0m\x1b[K')
-                                    break
-                                last_downloaded = downloaded
-                                last_update_time = now
-                            # 进度显示
-                            if file_size > 0:
-                                percent = downloaded / file_size
-                            else:
-                                percent = 0.0
-                            elapsed = now - start_time
-                            if elapsed > 0:
-                                speed = downloaded / elapsed  # bytes/s
-                            spd_kb = speed / 1024
-                            if file_size > 0:
-                                remaining = file_size - downloaded
-                            else:
-                                remaining = -1
-                            eta_str = human_eta(remaining, speed) if remaining > 0 else '--'
-                            downloaded_mb = downloaded / 1024 / 1024
-                            total_mb = file_size / 1024 / 1024 if file_size > 0 else 0
-                            if use_single_line:
-                                used_single_line_style = True
-                                # 每次渲染重新测量终端宽度
-                                try:
-                                    term_w, _ = get_terminal_size()
-                                except Exception:
-                                    pass
-                                # 重新判断是否仍适合单行
-                                dynamic_base = f"{idx_str}正在下载:... 100.0%  99.99MB/99.99MB 99999KB/s 9999s"
-                                if not (term_w >= 60 and display_width(dynamic_base) <= term_w - 2):
-                                    # 切换到窄终端备用模式，确保稍后打印首行
-                                    use_single_line = False
-                                    # 立即打印首行（若尚未打印）
-                                    if not fallback_header_printed:
-                                        # 在窄终端打印精简标题行，必要时对文件名进行截断
-                                        progress_status = idx_str
-                                        try:
-                                            term_w, _ = get_terminal_size()
-                                        except Exception:
-                                            pass
-                                        prefix_plain = f"{progress_status}正在下载: "
-                                        max_name_w = max(0, term_w - display_width(prefix_plain) - 1)
-                                        disp_name = truncate_filename(safe_filename, max_name_w) if display_width(safe_filename) > max_name_w else safe_filename
-                                        print(f'\x1b[94m{progress_status}正在下载: {disp_name}\x1b[0m')
-                                        fallback_header_printed = True
-                                    continue
-                                # 百分比文本（不带前导0）
-                                if file_size > 0:
-                                    pct_val = percent * 100
-                                    percent_raw = f"{pct_val:.1f}%"
-                                    if pct_val < 10:
-                                        percent_raw = percent_raw.lstrip('0')  # 5.3%
-                                else:
-                                    percent_raw = '---%'
-                                percent_field_width = 6  # 容纳 100.0% (6字符)
-                                if len(percent_raw) < percent_field_width:
-                                    pad_total = percent_field_width - len(percent_raw)
-                                    left_pad = pad_total // 2
-                                    right_pad = pad_total - left_pad
-                                    percent_txt = ' ' * left_pad + percent_raw + ' ' * right_pad
-                                else:
-                                    percent_txt = percent_raw[:percent_field_width]
-                                size_txt = f"{downloaded_mb:.2f}MB/{total_mb:.2f}MB" if file_size > 0 else f"{downloaded_mb:.2f}MB/??MB"
-                                # 无千分位分隔的速度
-                                spd_txt = (f"{spd_kb:.0f}KB/s" if spd_kb >= 100 else f"{spd_kb:.1f}KB/s") if spd_kb > 0 else '0KB/s'
-                                right_part = f"{size_txt} {spd_txt} {eta_str}".strip()
-                                base_left_prefix = f"{idx_str}正在下载:"
-                                percent_part = f" {percent_txt}"  # 前置空格分隔
-                                right_w = display_width(right_part)
-                                static_left_w = display_width(base_left_prefix) + display_width(percent_part)
-                                max_name_w = term_w - right_w - static_left_w - 1
-                                disp_name = safe_filename
-                                if max_name_w <= 5:
-                                    use_single_line = False
-                                    continue
-                                if display_width(disp_name) > max_name_w:
-                                    disp_name = truncate_filename(disp_name, max_name_w)
-                                left_part = f"{base_left_prefix}{disp_name}{percent_part}"
-                                left_w = display_width(left_part)
-                                total_w = left_w + 1 + right_w
-                                if total_w > term_w:
-                                    over = total_w - term_w
-                                    adjust_max = max_name_w - over
-                                    if adjust_max > 3:
-                                        disp_name = truncate_filename(disp_name, adjust_max)
-                                        left_part = f"{base_left_prefix}{disp_name}{percent_part}"
-                                        left_w = display_width(left_part)
-                                        total_w = left_w + 1 + right_w
-                                spaces_w = term_w - (left_w + right_w)
-                                if spaces_w < 1:
-                                    spaces_w = 1
-                                line_full = left_part + ' ' * spaces_w + right_part
-                                # 反色填充
-                                fill_cells = int(term_w * percent)
-                                if fill_cells < 0:
-                                    fill_cells = 0
-                                if fill_cells > term_w:
-                                    fill_cells = term_w
-                                acc = ''
-                                acc_w = 0
-                                i = 0
-                                while i < len(line_full) and acc_w < fill_cells:
-                                    ch = line_full[i]
-                                    acc += ch
-                                    acc_w += cell_width(ch)
-                                    i += 1
-                                remainder = line_full[i:]
-                                sys.stdout.write('\r' + (f'\x1b[7;33m{acc}\x1b[0m\x1b[33m' + remainder + '\x1b[0m'))
-                                cur_disp_w = display_width(line_full)
-                                if cur_disp_w < term_w:
-                                    sys.stdout.write(' ' * (term_w - cur_disp_w))
-                                sys.stdout.flush()
-                            else:
-                                # 旧窄终端备用方案：只打印一次标题行
-                                if not fallback_header_printed:
-                                    progress_status = idx_str
-                                    try:
-                                        term_w, _ = get_terminal_size()
-                                    except Exception:
-                                        pass
-                                    prefix_plain = f"{progress_status}正在下载: "
-                                    max_name_w = max(0, term_w - display_width(prefix_plain) - 1)
-                                    disp_name = truncate_filename(safe_filename, max_name_w) if display_width(safe_filename) > max_name_w else safe_filename
-                                    print(f'\x1b[94m{progress_status}正在下载: {disp_name}\x1b[0m')
-                                    fallback_header_printed = True
-                                # 不再实时输出进度，完成后输出成功信息
-                        else:
-                            # for-else：正常完成循环（未 break）
-                            pass
-                    if downloaded < file_size and file_size > 0:
-                        retry_count += 1
-                        if retry_count <= max_retries:
-                            print(f'\x1b[33m! 下载不完整，正在重试 ({retry_count}/{max_retries})...\x1b[0m\x1b[K')
-                            continue
-                        else:
-                            write_to_failed_list(track_id, track_name, artist_name, '下载不完整', download_path)
-                            print(f'\x1b[31m× 多次尝试下载失败: {safe_filename}\x1b[0m\x1b[K')
-                            return
-                    break
-                except (Timeout, ConnectionError, RequestException) as e:
-                    retry_count += 1
-                    if retry_count <= max_retries:
-                        print(f'\x1b[33m! 下载超时，正在重试 ({retry_count}/{max_retries})...\x1b[0m\x1b[K')
-                    else:
-                        write_to_failed_list(track_id, track_name, artist_name, f'下载失败: {e}', download_path)
-                        print(f'\x1b[31m× 多次尝试下载失败: {e}\x1b[0m\x1b[K')
-                        return
-            if 'used_single_line_style' in locals() and used_single_line_style:
-                # 清除当前反色行
-                try:
-                    sys.stdout.write('\r' + ' ' * term_w + '\r')
-                except Exception:
-                    pass
-                print(f'\x1b[32m✓ 已下载{progress_status}\x1b[0m{safe_filename}\x1b[K')
-                # try:
-                #     term_w, _ = get_terminal_size()
-                # except Exception:
-                #     pass
-                # prefix_plain = '✓ 已下载: '
-                # max_name_w = max(0, term_w - display_width(prefix_plain) - 1)
-                # disp_name = safe_filename if display_width(safe_filename) <= max_name_w else truncate_filename(safe_filename, max_name_w)
-                # print(f'\x1b[32m✓ 已下载: \x1b[0m{disp_name}\x1b[K')
+    增量同步据此跳过本地已有且音质不低于要求的曲目，并找出已从歌单移除的曲目。
+    """
+
+    def __init__(self, download_path):
+        self.download_path = download_path
+        self.path = os.path.join(download_path, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.dirty = 0
+        with suppress(Exception):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.tracks = json.load(f).get('tracks', {})
+
+    def save(self):
+        """写入清单，调用方需持有 self.lock。"""
+        os.makedirs(self.download_path, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'tracks': self.tracks}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+        self.dirty = 0
+
+    def flush(self):
+        """有未写入的改动时保存清单。"""
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def record(self, track_id, level, filepath, granted_level=None, checksum=None):
+        """下载并打完标签后记录曲目；requested 为请求的音质，level 为实际获得的音质。"""
+        stat = os.stat(filepath)
+        checksum = checksum or file_checksum(filepath)
+        with self.lock:
+            old = self.tracks.get(str(track_id)) or {}
+            self.tracks[str(track_id)] = {
+                'file': os.path.relpath(filepath, self.download_path), 'requested': level, 'level': granted_level or level,
+                'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': checksum, 'playlists': old.get('playlists', []),
+            }
+            self.dirty += 1
+            if self.dirty >= MANIFEST_SAVE_EVERY:
+                self.save()
+
+    def is_current(self, track_id, level):
+        """本地文件存在、未被改动且当时请求的音质不低于 level 时返回 True。"""
+        with self.lock:
+            entry = self.tracks.get(str(track_id))
+        if not entry or LEVEL_RANK.get(entry.get('requested'), -1) < LEVEL_RANK.get(level, 0):
+            return False
+        path = os.path.join(self.download_path, entry['file'])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != entry.get('size'):
+            return False
+        if stat.st_mtime != entry.get('mtime'):
+            # 仅修改时间变化（如复制或同步盘）时用校验值确认内容
+            if file_checksum(path) != entry.get('md5'):
+                return False
+            with self.lock:
+                entry['mtime'] = stat.st_mtime
+                self.dirty += 1
+        return True
+
+    def mark_playlist(self, playlist_id, track_ids):
+        """更新歌单归属，返回不再属于任何歌单的曲目 {track_id: 条目}。"""
+        playlist_id, current = str(playlist_id), {str(t) for t in track_ids}
+        orphans = {}
+        with self.lock:
+            for track_id, entry in self.tracks.items():
+                playlists = set(entry.get('playlists', []))
+                if track_id in current:
+                    playlists.add(playlist_id)
+                elif playlist_id in playlists:
+                    playlists.discard(playlist_id)
+                    if not playlists:
+                        orphans[track_id] = entry
+                entry['playlists'] = sorted(playlists)
+            self.save()
+        return orphans
+
+    def prune(self, track_ids):
+        """删除已移除曲目的音频与 lrc 文件，并从清单中去掉记录。"""
+        removed = []
+        with self.lock:
+            for track_id in track_ids:
+                entry = self.tracks.pop(str(track_id), None)
+                if not entry:
+                    continue
+                path = os.path.join(self.download_path, entry['file'])
+                for target in (path, os.path.splitext(path)[0] + '.lrc'):
+                    with suppress(FileNotFoundError):
+                        os.remove(target)
+                removed.append(entry['file'])
+            self.save()
+        return removed
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get_sync_manifest(download_path):
+    key = os.path.abspath(download_path)
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = SyncManifest(download_path)
+        return _manifests[key]
+
+def flush_sync_manifests():
+    with _manifests_lock:
+        manifests = list(_manifests.values())
+    for manifest in manifests:
+        try:
+            manifest.flush()
+        except OSError as e:
+            print(f'\x1b[33m! 保存下载清单失败: {e}\x1b[0m\x1b[K')
+
+LIBRARY_INDEX_ENABLED = True
+LIBRARY_INDEX_PATH = os.path.join(CACHE_DIR, 'library.db')
+
+class LibraryIndex:
+    """跨歌单、跨下载目录的 SQLite 曲库索引。
+
+    每个音频文件一行（路径、音质、大小、校验值、标签状态、歌词版本、封面 ID），另有歌单归属表；
+    按曲目 ID 建索引，判断“某首歌是否已有某音质的文件”无需遍历文件系统。所有写入都在事务中完成。
+    """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS tracks (
+        path TEXT PRIMARY KEY,
+        track_id INTEGER NOT NULL,
+        level TEXT,
+        level_rank INTEGER,
+        bytes INTEGER,
+        mtime REAL,
+        md5 TEXT,
+        tagged INTEGER NOT NULL DEFAULT 0,
+        lyric_version INTEGER,
+        cover_id TEXT,
+        updated REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_tracks_track ON tracks (track_id, level_rank);
+    CREATE INDEX IF NOT EXISTS idx_tracks_md5 ON tracks (md5);
+    CREATE TABLE IF NOT EXISTS playlist_tracks (
+        playlist_id INTEGER NOT NULL,
+        track_id INTEGER NOT NULL,
+        position INTEGER,
+        PRIMARY KEY (playlist_id, track_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_playlist_tracks_track ON playlist_tracks (track_id);
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(self.SCHEMA)
+
+    def record(self, track_id, path, level, md5=None, tagged=False, lyric_version=None, cover_id=None):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        md5 = md5 or file_checksum(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tracks (path, track_id, level, level_rank, bytes, mtime, md5, tagged, lyric_version, cover_id, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, int(track_id), level, LEVEL_RANK.get(level, -1), stat.st_size, stat.st_mtime, md5, int(bool(tagged)), lyric_version, cover_id, time.time()))
+
+    def find(self, track_id, level=None):
+        """返回该曲目音质不低于 level 的本地文件记录（字典），文件已丢失或大小不符的记录会被清除。"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT * FROM tracks WHERE track_id = ? AND level_rank >= ? ORDER BY level_rank DESC, updated DESC',
+                (int(track_id), LEVEL_RANK.get(level, -1) if level else -1)).fetchall()
+        for row in rows:
+            try:
+                if os.path.getsize(row['path']) == row['bytes']:
+                    return dict(row)
+            except OSError:
+                pass
+            self.remove(row['path'])
+        return None
+
+    def remove(self, path):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM tracks WHERE path = ?', (os.path.abspath(path),))
+
+    def set_playlist(self, playlist_id, track_ids):
+        """以歌单当前的曲目列表整体替换其归属记录。"""
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM playlist_tracks WHERE playlist_id = ?', (int(playlist_id),))
+            self.conn.executemany('INSERT OR IGNORE INTO playlist_tracks (playlist_id, track_id, position) VALUES (?, ?, ?)',
+                                  ((int(playlist_id), int(t), i) for i, t in enumerate(track_ids)))
+
+    def playlists_of(self, track_id):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT playlist_id FROM playlist_tracks WHERE track_id = ? ORDER BY playlist_id', (int(track_id),))]
+
+    def audit(self):
+        """返回索引中已丢失或被改动（大小不符）的文件路径。"""
+        with self.lock:
+            rows = self.conn.execute('SELECT path, bytes FROM tracks').fetchall()
+        broken = []
+        for row in rows:
+            try:
+                if os.path.getsize(row['path']) != row['bytes']:
+                    broken.append(row['path'])
+            except OSError:
+                broken.append(row['path'])
+        return broken
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_library_index = None
+_library_index_lock = threading.Lock()
+
+def get_library_index():
+    global _library_index
+    if not LIBRARY_INDEX_ENABLED:
+        return None
+    with _library_index_lock:
+        if _library_index is None:
+            try:
+                _library_index = LibraryIndex(LIBRARY_INDEX_PATH)
+            except Exception as e:
+                print(f'\x1b[33m! 打开曲库索引失败，本次不使用索引: {e}\x1b[0m\x1b[K')
+                globals()['LIBRARY_INDEX_ENABLED'] = False
+                return None
+        return _library_index
+
+# 共享音频库（可选）：设为目录路径后，每个 (曲目 ID, 音质) 只保存一份文件，
+# 各歌单目录中的文件是指向它的硬链接（不支持时退回符号链接，再退回复制）
+AUDIO_STORE_DIR = None
+
+def link_or_copy(src, dst):
+    """在 dst 创建指向 src 的硬链接，失败时依次尝试符号链接与复制。"""
+    with suppress(FileNotFoundError):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+    except (OSError, NotImplementedError):
+        shutil.copy2(src, dst)
+
+class AudioStore:
+    """按 (曲目 ID, 音质) 存放音频的共享库，布局为 <root>/<track_id>/<level>.<ext>。
+
+    同目录下的 <level>.json 记录歌单视图中使用的文件名，lyrics.lrc 为歌词文件，
+    因此无需联网即可重建任意歌单目录。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def find(self, track_id, level=None):
+        """返回音质不低于 level 的最高音质文件 (路径, 元数据)，没有时返回 None。"""
+        folder = os.path.join(self.root, str(track_id))
+        best = None
+        with suppress(FileNotFoundError):
+            for name in os.listdir(folder):
+                if not name.endswith('.json'):
+                    continue
+                meta = None
+                with suppress(Exception):
+                    with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                        meta = json.load(f)
+                if not meta:
+                    continue
+                path = os.path.join(folder, meta['file'])
+                rank = LEVEL_RANK.get(meta['level'], -1)
+                if rank < (LEVEL_RANK.get(level, -1) if level else -1) or not os.path.exists(path):
+                    continue
+                if best is None or rank > best[0]:
+                    best = (rank, path, meta)
+        return best[1:] if best else None
+
+    def adopt(self, track_id, level, filepath):
+        """把刚下载好的文件（及同名 lrc）移入库中，并在原位置留下链接，返回库中路径。"""
+        folder = os.path.join(self.root, str(track_id))
+        os.makedirs(folder, exist_ok=True)
+        ext = os.path.splitext(filepath)[1].lower()
+        store_path = os.path.join(folder, f'{level}{ext}')
+        meta = {'track_id': track_id, 'level': level, 'file': f'{level}{ext}', 'filename': os.path.basename(filepath)}
+        with self.lock:
+            if not (os.path.exists(store_path) and os.path.samefile(store_path, filepath)):
+                shutil.move(filepath, store_path)
+                link_or_copy(store_path, filepath)
+            lrc_path = os.path.splitext(filepath)[0] + '.lrc'
+            if os.path.isfile(lrc_path) and not os.path.islink(lrc_path):
+                store_lrc = os.path.join(folder, 'lyrics.lrc')
+                if not (os.path.exists(store_lrc) and os.path.samefile(store_lrc, lrc_path)):
+                    shutil.move(lrc_path, store_lrc)
+                    link_or_copy(store_lrc, lrc_path)
+            tmp = os.path.join(folder, f'{level}.json.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, os.path.join(folder, f'{level}.json'))
+        return store_path
+
+    def link_view(self, track_id, download_path, level=None, filename=None):
+        """在歌单目录中链接库中的音频与歌词，返回链接路径；库中没有时返回 None。"""
+        found = self.find(track_id, level)
+        if not found:
+            return None
+        store_path, meta = found
+        filename = filename or meta['filename']
+        os.makedirs(download_path, exist_ok=True)
+        view_path = os.path.join(download_path, filename)
+        if not (os.path.exists(view_path) and os.path.samefile(view_path, store_path)):
+            link_or_copy(store_path, view_path)
+        store_lrc = os.path.join(os.path.dirname(store_path), 'lyrics.lrc')
+        view_lrc = os.path.splitext(view_path)[0] + '.lrc'
+        if os.path.exists(store_lrc) and not (os.path.exists(view_lrc) and os.path.samefile(view_lrc, store_lrc)):
+            link_or_copy(store_lrc, view_lrc)
+        return view_path
+
+_audio_stores = {}
+_audio_stores_lock = threading.Lock()
+
+def get_audio_store():
+    if not AUDIO_STORE_DIR:
+        return None
+    key = os.path.abspath(AUDIO_STORE_DIR)
+    with _audio_stores_lock:
+        if key not in _audio_stores:
+            _audio_stores[key] = AudioStore(key)
+        return _audio_stores[key]
+
+def rebuild_playlist_view(playlist_id, download_path):
+    """根据 !#_playlist_<id>_info.txt 用共享音频库重建歌单目录，不访问网络。
+
+    返回 (已链接数量, 库中缺失的曲目 ID 列表)。
+    """
+    store = get_audio_store()
+    if store is None:
+        raise RuntimeError('未设置 AUDIO_STORE_DIR，无法重建歌单目录')
+    info_path = os.path.join(download_path, f'!#_playlist_{playlist_id}_info.txt')
+    linked, missing = 0, []
+    with open(info_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            track_id = line.split(' - ', 1)[0].strip()
+            if not track_id.isdigit():
+                continue
+            if store.link_view(int(track_id), download_path):
+                linked += 1
             else:
-                # 旧样式成功信息
+                missing.append(int(track_id))
+    return linked, missing
+
+def playlist_info_path(playlist_id, download_path):
+    return os.path.join(download_path, f'!#_playlist_{playlist_id}_info.txt')
+
+def write_playlist_info(playlist_id, songs, download_path):
+    """边产出曲目边写入 !#_playlist_<id>_info.txt（每行一首：ID - 歌名 - 艺术家），曲目原样交给下游。"""
+    os.makedirs(download_path, exist_ok=True)
+    with open(playlist_info_path(playlist_id, download_path), 'w', encoding='utf-8', buffering=1) as f:
+        for track_info in songs:
+            f.write(f'{track_info.id} - {track_info.name} - {track_info.artist_name}\n')
+            yield track_info
+
+def update_playlist_membership(playlist_id, track_ids, download_path, sync=False, prune=False):
+    """下载结束后更新清单与曲库中的歌单归属；同步模式下提示或删除已从歌单移除的曲目。"""
+    manifest = get_sync_manifest(download_path)
+    orphans = manifest.mark_playlist(playlist_id, track_ids)
+    library = get_library_index()
+    if library is not None:
+        library.set_playlist(playlist_id, track_ids)
+    if sync and orphans:
+        if prune:
+            for name in manifest.prune(orphans):
+                print(f'\x1b[33m- 已删除（已从歌单移除）: \x1b[0m{name}\x1b[K')
+        else:
+            print(f'\x1b[33m! 以下 {len(orphans)} 首曲目已从歌单移除（启用清理后将删除）:\x1b[0m\x1b[K')
+            for entry in orphans.values():
+                print(f'  {entry["file"]}\x1b[K')
+
+def download_batch(playlist_ids, track_ids, level, download_path, workers=None, sync=False, prune=False):
+    """无交互批量下载：多个歌单与单曲合并为一个任务，多个歌单共有的曲目只下载一次。
+
+    歌单先只取元数据，曲目详情按页获取并随到随下。
+    返回统计字典 {'tracks', 'downloaded', 'skipped', 'failed', 'errors'}，其中 errors 为无法获取的歌单/曲目说明。
+    """
+    stats = {'tracks': 0, 'downloaded': 0, 'skipped': 0, 'failed': 0, 'errors': []}
+    playlists = []
+    for playlist_id in dict.fromkeys(str(p) for p in playlist_ids):
+        # 刚预览过的歌单直接使用预览时取到的元数据
+        meta, error = recent_playlist_meta(playlist_id), None
+        if meta is None:
+            meta, error = get_playlist_meta(playlist_id)
+        if error or not meta or 'snapshot' not in meta:
+            stats['errors'].append(f'歌单 {playlist_id}: {error or "返回无效数据"}')
+            continue
+        playlists.append((playlist_id, meta))
+    track_ids = list(dict.fromkeys(str(t) for t in track_ids))
+    manifest = get_sync_manifest(download_path)
+    seen, queued = set(), set()
+
+    def tracks():
+        for playlist_id, meta in playlists:
+            missing = []
+            for song in write_playlist_info(playlist_id, iter_playlist_tracks(meta, missing), download_path):
+                if song.id not in seen:
+                    seen.add(song.id)
+                    yield song
+            stats['errors'].extend(f'歌单 {playlist_id} 曲目 {tid}: {reason}' for tid, reason in missing)
+        wanted = [t for t in track_ids if int(t) not in seen]
+        for start in range(0, len(wanted), URL_BATCH_SIZE):
+            chunk = wanted[start:start + URL_BATCH_SIZE]
+            detail, error = get_track_detail(chunk)
+            found = [] if error or not detail else detail.get('songs') or []
+            found_ids = {str(song.id) for song in found}
+            for tid in chunk:
+                if tid not in found_ids:
+                    stats['errors'].append(f'曲目 {tid}: {error or "未找到"}')
+            for song in found:
+                if song.id not in seen:
+                    seen.add(song.id)
+                    yield song
+
+    def pending():
+        for song in tracks():
+            stats['tracks'] += 1
+            if sync and manifest.is_current(song.id, level):
+                stats['skipped'] += 1
+                continue
+            queued.add(song.id)
+            yield song
+        if sync:
+            manifest.flush()  # 保存校验后刷新的修改时间，下次不再重算
+
+    take_failed_track_ids()
+    if playlists or track_ids:
+        os.makedirs(download_path, exist_ok=True)
+        estimate = sum(meta['count'] for _, meta in playlists) + len(track_ids)
+        run_download_pipeline(pending(), level, download_path, max(1, int(workers or DOWNLOAD_WORKERS)), total=estimate)
+    for playlist_id, _ in playlists:
+        print(f'\x1b[32m✓ \x1b[0m歌单信息已保存到 {playlist_info_path(playlist_id, download_path)}')
+    if sync:
+        print(f'\x1b[32m✓ \x1b[0m增量同步：共 {stats["tracks"]} 首，下载 {len(queued)} 首，跳过 {stats["skipped"]} 首')
+    failed = take_failed_track_ids() & queued
+    stats['failed'] = len(failed)
+    stats['downloaded'] = len(queued) - len(failed)
+    for playlist_id, meta in playlists:
+        update_playlist_membership(playlist_id, meta['track_ids'], download_path, sync, prune)
+    return stats
+
+def get_playlist_tracks_and_save_info(playlist_id, level, download_path, workers=None, sync=False, prune=False):
+    """下载歌单。sync 为真时只下载清单中没有或需要升级音质的曲目；prune 为真时删除已从歌单移除的曲目。"""
+    try:
+        stats = download_batch([playlist_id], [], level, download_path, workers, sync, prune)
+        for error in stats['errors']:
+            print(f'\x1b[31m× {error}\x1b[0m\x1b[K')
+        if not stats['tracks']:
+            return
+        print('=' * terminal_width + '\x1b[K')
+        print(f'\x1b[32m✓ 操作已完成，歌曲已下载并保存到 \x1b[36m{download_path}\x1b[32m 文件夹中。\x1b[0m\x1b[K')
+    except Exception as e:
+        print(f'\x1b[31m× 获取歌单列表或下载歌曲时出错: {e}\x1b[0m\x1b[K')
+
+def _make_tag_executor():
+    """打标签使用的进程池，避免 GIL 拖慢下载线程；平台不支持时退回线程池。"""
+    from concurrent.futures import ThreadPoolExecutor
+    processes = TAG_PROCESSES if TAG_PROCESSES is not None else (os.cpu_count() or 1)
+    if processes > 0:
+        try:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        except (ImportError, NotImplementedError, OSError) as e:
+            # 如 Termux/Android 缺少 sem_open
+            if DEBUG: print(e)
+    return ThreadPoolExecutor(max_workers=2)
+
+def _importable(obj):
+    """返回可被进程池按模块名引用的函数或类。
+
+    通过 ncmdl 入口运行时本模块名为 __main__，但 sys.modules['__main__'] 并不是本模块，
+    子进程无法按引用找到本模块的函数和类；此时改用可导入的 script 模块中的同名对象。
+    """
+    if __name__ != '__main__':
+        return obj
+    try:
+        import script
+        return getattr(script, obj.__name__)
+    except (ImportError, AttributeError):
+        return obj
+
+def _tag_task():
+    """返回可被进程池按模块名引用的 tag_and_verify。"""
+    return _importable(tag_and_verify)
+
+def _start_pipeline_stage(name, handler, in_q, out_q, threads, next_threads, on_drop, base_session=None, log=print):
+    """启动一个流水线阶段：threads 个线程从 in_q 取任务，handler 返回 True 时交给 out_q。
+
+    收到 None 表示上游结束；本阶段最后一个线程退出时向下游发送 next_threads 个 None。
+    """
+    remaining = [threads]
+    lock = threading.Lock()
+
+    def loop():
+        init_worker_session(base_session)
+        while True:
+            job = in_q.get()
+            if job is None:
+                break
+            passed = False
+            try:
+                if not DOWNLOAD_CANCEL.is_set():
+                    passed = handler(job)
+            except KeyboardInterrupt:
+                passed = False
+            except Exception as e:
+                write_to_failed_list(job['track_id'], job['track_name'], job['artist_name'], f'未知下载错误: {e}', job['download_path'])
+                log(f'\x1b[31m! 下载歌曲时出错: {e}\x1b[0m\x1b[K')
+            if passed and out_q is not None:
+                out_q.put(job)
+            elif not passed:
+                on_drop(job)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and out_q is not None:
+            for _ in range(next_threads):
+                out_q.put(None)
+    workers = [threading.Thread(target=loop, name=f'{name}-{i}', daemon=True) for i in range(threads)]
+    for t in workers:
+        t.start()
+    return workers
+
+def run_download_pipeline(songs, level, download_path, workers, total=None):
+    """分阶段下载流水线：解析链接 → 下载音频 → 获取歌词/封面 → 打标签/校验。
+
+    阶段之间用有界队列连接，网络阶段各自多线程运行，打标签放在进程池中，
+    使下载带宽与 CPU 可以同时保持忙碌。songs 可以是边获取边产出的生成器，
+    此时 total 为预估总数，输入结束后按实际数量校正。
+    """
+    import queue
+    from itertools import islice
+    total = len(songs) if total is None else total
+    board = ProgressRenderer(total)
+    DOWNLOAD_CANCEL.clear()
+    base_session = pyncm.GetCurrentSession()
+    # 下载、解析、封面线程共用连接池，每个主机的连接数与并发数相当
+    max_downloads = workers * 2 if ADAPTIVE_CONCURRENCY else workers
+    controller = ConcurrencyController(workers, max_downloads, bytes_source=lambda: board.bytes_done, log=board.log)
+    set_concurrency_controller(controller)
+    reset_retry_engine(board.log)
+    get_http_transport(max_downloads * max(1, SEGMENT_CONNECTIONS) + 2)
+    depth = workers * 2
+    q_resolve, q_audio, q_extras, q_tag = (queue.Queue(maxsize=depth) for _ in range(4))
+    resolve_threads = 1  # 链接按批解析，一个线程足以领先下载阶段
+    extras_threads = max(1, workers // 2)
+    resolver = TrackUrlResolver(level)
+
+    def hint(chunk):
+        # 本地已有的曲目不参与批量解析
+        resolver.hint([track_info.id for track_info in chunk if find_local_copy(track_info.id, level) is None])
+
+    def drop(job):
+        board.finish(job['track_id'])
+    stages = []
+    stages += _start_pipeline_stage('resolve', lambda job: resolve_track_url(job, board, resolver), q_resolve, q_audio, resolve_threads, max_downloads, drop, base_session, board.log)
+    def audio_stage(job):
+        # 线程数按上限启动，实际同时下载数由控制器的 downloads 限制决定
+        if job['local']:
+            return True
+        with controller.downloads:
+            ok = fetch_track_audio(job, board)
+        controller.record_download(ok, job['http_status'])
+        return ok
+    stages += _start_pipeline_stage('audio', audio_stage, q_audio, q_extras, max_downloads, extras_threads, drop, base_session, board.log)
+    stages += _start_pipeline_stage('extras', lambda job: fetch_track_extras(job, board), q_extras, q_tag, extras_threads, 1, drop, base_session, board.log)
+    executor = _make_tag_executor()
+    tag_task = _tag_task()
+
+    def tag_finish(job, future):
+        try:
+            try:
+                result = future.result()
+            except Exception as e:
+                # 进程池不可用（如被系统终止）时在当前线程补做
+                if DEBUG: board.log(str(e))
+                result = tag_and_verify(job['filepath'], job['track_info'], job['lyrics'], job['cover'])
+            finish_track_job(job, result, board)
+        finally:
+            board.finish(job['track_id'])
+
+    def tag_loop():
+        # 提交与收尾都在本线程完成，回调线程里不做文件读写
+        from concurrent.futures import FIRST_COMPLETED, Future, wait
+        pending = {}
+        upstream_done = False
+        while not upstream_done or pending:
+            room = not upstream_done and len(pending) < depth
+            if room:
                 try:
-                    # 清除当前行并上移一行后清除上一行
-                    sys.stdout.write('\r\x1b[K\x1b[1A\x1b[K')
-                    sys.stdout.flush()
-                except Exception:
-                    pass
-                progress_status = f'[{index}/{total}] ' if (index is not None and total is not None) else ''
+                    job = q_tag.get(timeout=0.05 if pending else None)
+                except queue.Empty:
+                    job = False
+                if job is None:
+                    upstream_done = True
+                elif job:
+                    try:
+                        future = executor.submit(tag_task, job['filepath'], job['track_info'], job['lyrics'], job['cover'])
+                    except Exception as e:
+                        if DEBUG: board.log(str(e))
+                        future = Future()
+                        future.set_exception(e)
+                    pending[future] = job
+                    continue
+            if pending:
+                done, _ = wait(pending, timeout=0 if room else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tag_finish(pending.pop(future), future)
+    tagger = threading.Thread(target=tag_loop, name='tag', daemon=True)
+    tagger.start()
+    try:
+        index = 0
+        try:
+            source = iter(songs)
+            chunks = iter(lambda: list(islice(source, URL_BATCH_SIZE)), [])
+            chunk = next(chunks, [])
+            hint(chunk)
+            while chunk:
+                # 先取下一批并告知解析器，批量解析不会在批次边界处变小
+                following = next(chunks, [])
+                hint(following)
+                for track_info in chunk:
+                    index += 1
+                    q_resolve.put(new_track_job(track_info.id, track_info.name, track_info.artist_name, level, download_path, track_info, index, total))
+                chunk = following
+        except Exception as e:
+            # 曲目列表获取中途出错时，已加入的曲目照常下载完
+            board.log(f'\x1b[31m× 获取曲目列表时出错: {e}\x1b[0m')
+        board.set_total(index)
+        for _ in range(resolve_threads):
+            q_resolve.put(None)
+        while tagger.is_alive():
+            tagger.join(0.2)
+        executor.shutdown(wait=True)
+    except KeyboardInterrupt:
+        DOWNLOAD_CANCEL.set()
+        for _ in range(resolve_threads):
+            with suppress(Exception):
+                q_resolve.put_nowait(None)
+        executor.shutdown(wait=False)
+        raise
+    finally:
+        board.close()
+        get_retry_engine().log = print
+        flush_sync_manifests()
+
+def get_tracks_info(track_ids, level, download_path, workers=None):
+    """多曲目模式：批量获取曲目详情后走下载流水线，下载链接同样按批解析。"""
+    try:
+        track_info_rsp, error = get_track_detail(list(track_ids))
+        if error:
+            print(f'\x1b[31m× 获取歌曲信息时出错: {error}\x1b[0m\x1b[K')
+            return
+        if not track_info_rsp or 'songs' not in track_info_rsp or (not track_info_rsp['songs']):
+            print(f'\x1b[31m× 获取歌曲信息返回无效数据\x1b[0m\x1b[K')
+            return
+        os.makedirs(download_path, exist_ok=True)
+        workers = max(1, int(workers or DOWNLOAD_WORKERS))
+        run_download_pipeline(track_info_rsp['songs'], level, download_path, workers)
+        print(f'\x1b[32m✓ \x1b[0m{len(track_info_rsp["songs"])} 首歌曲已保存到 {download_path} 文件夹中。\x1b[K')
+    except Exception as e:
+        print(f'\x1b[31m! 获取歌曲信息时出错: {e}\x1b[0m\x1b[K')
+
+def get_track_info(track_id, level, download_path):
+    try:
+        track_info_rsp, error = get_track_detail([track_id])
+        if error:
+            print(f'\x1b[31m× 获取歌曲信息时出错: {error}\x1b[0m\x1b[K')
+            return
+        if not track_info_rsp or 'songs' not in track_info_rsp or (not track_info_rsp['songs']):
+            print(f'\x1b[31m× 获取歌曲信息返回无效数据\x1b[0m\x1b[K')
+            return
+        track_info = track_info_rsp['songs'][0]
+        track_name = track_info.name
+        download_and_save_track(track_info.id, track_name, track_info.artist_name, level, download_path, track_info, 1, 1)
+        print(f'\x1b[32m✓ \x1b[0m歌曲 {track_name} 已保存到 {download_path} 文件夹中。\x1b[K')
+    except Exception as e:
+        print(f'\x1b[31m! 获取歌曲信息时出错: {e}\x1b[0m\x1b[K')
+
+def make_safe_filename(filename):
+    return re.sub('[\\\\/*?:"<>|]', '-', filename)
+
+# 单首曲目的最大请求次数（续传有进展时重试计数会归零，此值防止无限循环）
+MAX_DOWNLOAD_ATTEMPTS = 8
+
+def load_part_state(part_path, url_entry):
+    """读取 .part 文件旁的续传记录，与当前链接的大小或 md5 不一致时丢弃旧的部分文件。"""
+    state = None
+    with suppress(Exception):
+        with open(part_path + '.json', 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    if not isinstance(state, dict) or not os.path.exists(part_path):
+        discard_part_file(part_path)
+        return None
+    size, md5 = (url_entry or {}).get('size'), (url_entry or {}).get('md5')
+    if (size and state.get('size') and size != state['size']) or (md5 and state.get('md5') and md5 != state['md5']):
+        discard_part_file(part_path)
+        return None
+    return state
+
+def save_part_state(part_path, state):
+    tmp = part_path + '.json.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp, part_path + '.json')
+
+def discard_part_file(part_path, keep_data=False):
+    """删除续传记录；keep_data 为 False 时连同部分文件一起删除。"""
+    paths = [part_path + '.json'] if keep_data else [part_path, part_path + '.json']
+    for path in paths:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+# 限速：BANDWIDTH_LIMIT 为全部下载合计的上限（字节/秒，也可写 '2M'、'500K'），0 为不限速；
+# BANDWIDTH_SCHEDULE 按时段覆盖上限，如 [('01:00', '07:00', 0), ('09:00', '18:00', '1M')]；
+# BANDWIDTH_FAIR 为真时在同时进行的下载之间平均分配；
+# 运行中可写入 BANDWIDTH_CONTROL_FILE（内容同上，删除文件即恢复）或调用 get_bandwidth_limiter().set_rate() 调整
+BANDWIDTH_LIMIT = 0
+BANDWIDTH_SCHEDULE = []
+BANDWIDTH_FAIR = True
+BANDWIDTH_CONTROL_FILE = os.path.join(CACHE_DIR, 'bandwidth.txt')
+
+def parse_rate(value):
+    """把 1048576、'1M'、'512K'、'off' 等转换为字节/秒，0 表示不限速。"""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return max(0, int(value))
+    text = str(value).strip().upper().rstrip('B/S').rstrip('B')
+    if text in ('', 'OFF', 'NONE', 'UNLIMITED'):
+        return 0
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    if text[-1] in units:
+        return max(0, int(float(text[:-1]) * units[text[-1]]))
+    return max(0, int(float(text)))
+
+class BandwidthLimiter:
+    """所有下载共享的令牌桶限速器。
+
+    每次接收数据后调用 consume()：先从全局桶扣除，公平模式下再从该传输自己的桶扣除
+    （速率为全局上限除以活动传输数），桶内令牌不足时休眠到欠额补齐为止。
+    """
+
+    def __init__(self, rate=None, schedule=None, fair=None, control_file=None):
+        self.lock = threading.Lock()
+        self.base_rate = BANDWIDTH_LIMIT if rate is None else rate
+        self.schedule = list(BANDWIDTH_SCHEDULE if schedule is None else schedule)
+        self.fair = BANDWIDTH_FAIR if fair is None else fair
+        self.control_file = BANDWIDTH_CONTROL_FILE if control_file is None else control_file
+        self.override = None
+        self.control = {'checked': 0.0, 'mtime': None, 'rate': None}
+        self.bucket = {'tokens': 0.0, 'updated': time.monotonic()}
+        self.transfers = {}
+
+    def set_rate(self, rate):
+        """运行时调整上限；传入 None 恢复配置与时段规则。"""
+        with self.lock:
+            self.override = None if rate is None else parse_rate(rate)
+
+    def _control_rate(self, now):
+        control = self.control
+        if self.control_file and now - control['checked'] >= 1:
+            control['checked'] = now
+            try:
+                mtime = os.path.getmtime(self.control_file)
+                if mtime != control['mtime']:
+                    with open(self.control_file, 'r', encoding='utf-8') as f:
+                        control['rate'] = parse_rate(f.read())
+                    control['mtime'] = mtime
+            except (OSError, ValueError):
+                control['mtime'], control['rate'] = None, None
+        return control['rate']
+
+    def current_rate(self, now=None, clock=None):
+        """当前生效的上限：运行时设置 > 控制文件 > 时段规则 > BANDWIDTH_LIMIT。"""
+        if self.override is not None:
+            return self.override
+        control_rate = self._control_rate(time.monotonic() if now is None else now)
+        if control_rate is not None:
+            return control_rate
+        clock = clock or time.strftime('%H:%M')
+        for begin, end, rate in self.schedule:
+            if (begin <= clock < end) if begin <= end else (clock >= begin or clock < end):
+                return parse_rate(rate)
+        return parse_rate(self.base_rate)
+
+    @staticmethod
+    def _take(bucket, rate, nbytes, now):
+        capacity = max(rate * 0.5, RECV_MAX_CHUNK)
+        bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['updated']) * rate)
+        bucket['updated'] = now
+        bucket['tokens'] -= nbytes
+        return max(0.0, -bucket['tokens'] / rate)
+
+    def consume(self, nbytes, key=None):
+        """记录收到 nbytes 字节，必要时休眠，返回休眠秒数。"""
+        now = time.monotonic()
+        with self.lock:
+            rate = self.current_rate(now)
+            if rate <= 0:
+                return 0.0
+            delay = self._take(self.bucket, rate, nbytes, now)
+            if self.fair and key is not None:
+                # 2 秒内没有数据的传输视为已结束
+                for other in [k for k, b in self.transfers.items() if now - b['updated'] > 2]:
+                    del self.transfers[other]
+                bucket = self.transfers.setdefault(key, {'tokens': 0.0, 'updated': now})
+                delay = max(delay, self._take(bucket, rate / max(1, len(self.transfers)), nbytes, now))
+        waited = 0.0
+        while waited < delay and not DOWNLOAD_CANCEL.is_set():
+            step = min(0.25, delay - waited)
+            time.sleep(step)
+            waited += step
+            if self.current_rate() <= 0:
+                break
+        return waited
+
+_bandwidth_limiter = None
+_bandwidth_limiter_lock = threading.Lock()
+
+def get_bandwidth_limiter():
+    global _bandwidth_limiter
+    with _bandwidth_limiter_lock:
+        if _bandwidth_limiter is None:
+            _bandwidth_limiter = BandwidthLimiter()
+        return _bandwidth_limiter
+
+# 接收缓冲：每个传输预分配 RECV_BUFFERS 块，读取大小在最小/最大块之间按吞吐量调整，
+# 使每次 readinto 约耗时 RECV_TARGET_SECONDS
+RECV_BUFFERS = 4
+RECV_MIN_CHUNK = 16 * 1024
+RECV_MAX_CHUNK = 512 * 1024
+RECV_TARGET_SECONDS = 0.25
+
+class DiskWriter:
+    """后台写盘线程：接收线程把填满的缓冲区放入有界队列，由本线程写入文件后归还。
+
+    缓冲区数量固定，写盘跟不上时 acquire() 阻塞，内存占用不会增长。
+    """
+
+    def __init__(self, f, written=0, buffers=None, buffer_size=None):
+        import queue
+        self.f = f
+        self.written = written
+        self.error = None
+        self.free = queue.Queue()
+        for _ in range(buffers or RECV_BUFFERS):
+            self.free.put(bytearray(buffer_size or RECV_MAX_CHUNK))
+        self.full = queue.Queue(maxsize=buffers or RECV_BUFFERS)
+        self.thread = threading.Thread(target=self._run, name='writer', daemon=True)
+        self.thread.start()
+
+    def acquire(self):
+        """取一个空闲缓冲区，返回 (缓冲区, 等待秒数)。"""
+        import queue
+        begin = time.monotonic()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.free.get(timeout=0.5), time.monotonic() - begin
+            except queue.Empty:
+                continue
+
+    def submit(self, buf, nbytes):
+        self.full.put((buf, nbytes))
+
+    def release(self, buf):
+        self.free.put(buf)
+
+    def _run(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                return
+            buf, nbytes = item
+            if self.error is None:
                 try:
-                    term_w, _ = get_terminal_size()
-                except Exception:
-                    pass
-                prefix_plain = f"✓ 已下载{progress_status}"
-                max_name_w = max(0, term_w - display_width(prefix_plain) - 1)
-                disp_name = safe_filename if display_width(safe_filename) <= max_name_w else truncate_filename(safe_filename, max_name_w)
-                print(f'\x1b[32m✓ 已下载{progress_status}\x1b[0m{disp_name}\x1b[K')
+                    self.f.write(memoryview(buf)[:nbytes])
+                    self.written += nbytes
+                except Exception as e:
+                    self.error = e
+            self.free.put(buf)
+
+    def close(self):
+        """等待已提交的缓冲区全部写完；写盘错误保存在 error 中。"""
+        self.full.put(None)
+        self.thread.join()
+
+def receive_into(response, writer):
+    """把响应体读入 writer 的缓冲区并提交写盘，逐块产出 (字节数, 等待缓冲区的秒数)。
+
+    优先用 response.raw.readinto 直接读入预分配的缓冲区；响应经过压缩编码或没有 raw 时退回 iter_content。
+    """
+    raw = getattr(response, 'raw', None)
+    encoding = (response.headers.get('content-encoding') or 'identity').lower()
+    if raw is None or not hasattr(raw, 'readinto') or encoding != 'identity':
+        for chunk in response.iter_content(chunk_size=RECV_MAX_CHUNK):
+            if not chunk:
+                continue
+            buf, waited = writer.acquire()
+            buf[:len(chunk)] = chunk
+            writer.submit(buf, len(chunk))
+            yield len(chunk), waited
+        return
+    try:
+        from urllib3.exceptions import HTTPError as RawStreamError # pyright: ignore[reportMissingImports]
+    except ImportError:
+        RawStreamError = OSError
+    size = RECV_MIN_CHUNK
+    while True:
+        buf, waited = writer.acquire()
+        begin = time.monotonic()
+        try:
+            nbytes = raw.readinto(memoryview(buf)[:size])
+        except (RawStreamError, OSError) as e:
+            # 直接读 raw 时 requests 不会转换异常，这里转换后交给下载重试/续传逻辑处理
+            writer.release(buf)
+            raise ConnectionError(e) from e
+        elapsed = time.monotonic() - begin
+        if not nbytes:
+            writer.release(buf)
+            return
+        writer.submit(buf, nbytes)
+        yield nbytes, waited
+        if elapsed > 0:
+            size = int(min(RECV_MAX_CHUNK, max(RECV_MIN_CHUNK, nbytes / elapsed * RECV_TARGET_SECONDS)))
+
+# 分段下载：文件不小于 SEGMENTED_MIN_SIZE 时用 SEGMENT_CONNECTIONS 个连接并行下载，设为 0 或 1 则关闭
+SEGMENT_CONNECTIONS = 4
+SEGMENTED_MIN_SIZE = 64 * 1024 * 1024
+# 剩余字节少于该值的分段不再拆分
+SEGMENT_MIN_SPLIT = 4 * 1024 * 1024
+
+# 预留标签空间：不小于 TAG_SPACE_MIN_SIZE 的文件在下载的同一趟写入中就在 ID3 标签或 FLAC 元数据块
+# 后留出 TAG_SPACE 字节的填充，之后写入封面和歌词时直接覆盖填充区，不必重写整个文件；设为 0 关闭
+TAG_SPACE = 1024 * 1024
+TAG_SPACE_MIN_SIZE = 16 * 1024 * 1024
+TAG_PROBE_BYTES = 64 * 1024
+
+def _syncsafe(value):
+    return bytes((value >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+def _syncsafe_int(data):
+    value = 0
+    for b in data:
+        value = value << 7 | b & 0x7F
+    return value
+
+def plan_tag_space(ext, read, padding=None):
+    """根据文件头规划预留的标签空间，返回可写入续传记录的布局字典，格式不支持时返回 None。
+
+    read(start, end) 返回远端文件对应区间的字节。布局中 at 为插入位置（远端偏移），insert 为插入的
+    块头（十六进制），pad 为其后的零字节数，patch 为 at 之前需要改写的 [偏移, 十六进制字节]。
+    """
+    padding = TAG_SPACE if padding is None else padding
+    if padding <= 0:
+        return None
+    if ext == 'mp3':
+        head = read(0, 10)
+        if len(head) == 10 and head[:3] == b'ID3' and not head[5] & 0x10 and not any(b & 0x80 for b in head[6:10]):
+            # 扩大已有 ID3v2 标签的长度，新增部分为填充
+            size = _syncsafe_int(head[6:10])
+            if size + padding >= 1 << 28:
+                return None
+            return {'at': 10 + size, 'insert': '', 'pad': padding, 'patch': [[6, _syncsafe(size + padding).hex()]]}
+        if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+            # 没有 ID3 标签时在开头插入一个只含填充的 ID3v2.4 标签
+            return {'at': 0, 'insert': (b'ID3\x04\x00\x00' + _syncsafe(padding - 10)).hex(), 'pad': padding - 10, 'patch': []}
+        return None
+    if ext == 'flac' and read(0, 4) == b'fLaC':
+        padding = min(padding, (1 << 24) - 1)
+        pos = 4
+        for _ in range(128):
+            header = read(pos, pos + 4)
+            if len(header) < 4:
+                return None
+            if header[0] & 0x80:
+                # 清除原最后一个元数据块的结束标记，在其后追加 PADDING 块
+                return {'at': pos + 4 + int.from_bytes(bytes(header[1:4]), 'big'), 'insert': (bytes([0x81]) + (padding - 4).to_bytes(3, 'big')).hex(),
+                        'pad': padding - 4, 'patch': [[pos, bytes([header[0] & 0x7F]).hex()]]}
+            pos += 4 + int.from_bytes(bytes(header[1:4]), 'big')
+    return None
+
+def probe_tag_space(url, ext):
+    """请求文件头（必要时再按区间读取后续的 FLAC 块头）并规划预留的标签空间。"""
+    def fetch(start, end):
+        with suppress(Exception):
+            response = get_http_transport().get(url, timeout=30, headers={'Range': f'bytes={start}-{end - 1}'})
+            if response.status_code == 206:
+                return response.content[:end - start]
+        return b''
+    head = fetch(0, TAG_PROBE_BYTES)
+    return plan_tag_space(ext, lambda start, end: head[start:end] if end <= len(head) else fetch(start, end))
+
+class TagSpaceFile:
+    """按远端偏移写入本地文件，在 layout['at'] 处插入预留的标签空间。
+
+    at 之前的字节原位写入（套用 patch），之后的字节整体后移 delta；续传记录中的偏移都是远端偏移。
+    """
+
+    def __init__(self, f, layout):
+        self.f = f
+        self.at = layout['at']
+        self.insert = bytes.fromhex(layout['insert'])
+        self.delta = len(self.insert) + layout['pad']
+        self.patches = [(offset, bytes.fromhex(data)) for offset, data in layout['patch']]
+        self.pos = 0
+
+    def local(self, pos):
+        return pos if pos < self.at else pos + self.delta
+
+    def seek(self, pos):
+        self.pos = pos
+        return self.f.seek(self.local(pos))
+
+    def truncate(self, size=None):
+        return self.f.truncate(self.local(self.pos if size is None else size))
+
+    def write(self, data):
+        data = memoryview(data)
+        start, end = self.pos, self.pos + len(data)
+        if not data:
+            return 0
+        if start < self.at:
+            head = bytearray(data[:self.at - start])
+            for offset, patch in self.patches:
+                for i, b in enumerate(patch):
+                    if 0 <= offset + i - start < len(head):
+                        head[offset + i - start] = b
+            self.f.seek(start)
+            self.f.write(head)
+        if start <= self.at <= end:
+            # 填充部分靠文件扩展时补零，只需写入块头
+            self.f.seek(self.at)
+            self.f.write(self.insert)
+        if end > self.at:
+            tail = max(start, self.at)
+            self.f.seek(tail + self.delta)
+            self.f.write(data[tail - start:])
+        self.pos = end
+        return len(data)
+
+def download_segmented(url, path, size, connections=None, on_progress=None, segments=None, on_checkpoint=None, layout=None):
+    """按 Range 分段并行下载到预分配的文件，返回 (成功与否, 错误信息)。
+
+    空闲的连接会把剩余最多的分段从中点拆开接手后半段，慢连接的工作因此会转移给快连接。
+    segments 为上次未完成的 [起点, 终点) 列表，只下载这些区间；on_checkpoint 约每秒及结束时
+    收到剩余区间列表，用于写入续传记录。layout 为 plan_tag_space() 的结果，偏移都按远端计算。
+    """
+    connections = max(1, connections or SEGMENT_CONNECTIONS)
+    resume = segments is not None and os.path.exists(path)
+    with open(path, 'r+b' if resume else 'wb') as f:
+        f.truncate(TagSpaceFile(f, layout).local(size) if layout else size)
+    if resume:
+        ranges = sorted((int(s), int(e)) for s, e in segments if int(s) < int(e) <= size)
+    else:
+        step = -(-size // connections)
+        ranges = [(s, min(s + step, size)) for s in range(0, size, step)]
+    segments = [{'start': s, 'pos': s, 'end': e, 'active': False} for s, e in ranges]
+    lock = threading.Lock()
+    errors = []
+    limiter = get_bandwidth_limiter()
+    last_checkpoint = [time.time()]
+
+    def remaining():
+        return sorted([seg['pos'], seg['end']] for seg in segments if seg['pos'] < seg['end'])
+
+    def checkpoint(force=False):
+        if on_checkpoint is None:
+            return
+        with lock:
+            now = time.time()
+            if not force and now - last_checkpoint[0] < 1:
+                return
+            last_checkpoint[0] = now
+            with suppress(Exception):
+                on_checkpoint(remaining())
+
+    def take_segment():
+        with lock:
+            for seg in segments:
+                if not seg['active'] and seg['pos'] < seg['end']:
+                    seg['active'] = True
+                    return seg
+            busy = [seg for seg in segments if seg['active'] and seg['end'] - seg['pos'] >= 2 * SEGMENT_MIN_SPLIT]
+            if not busy:
+                return None
+            victim = max(busy, key=lambda seg: seg['end'] - seg['pos'])
+            mid = (victim['pos'] + victim['end']) // 2
+            seg = {'start': mid, 'pos': mid, 'end': victim['end'], 'active': True}
+            victim['end'] = mid
+            segments.append(seg)
+            return seg
+
+    def fetch(seg, fh):
+        response = get_http_transport().get(url, stream=True, timeout=30, headers={'Range': f"bytes={seg['pos']}-{seg['end'] - 1}"})
+        try:
+            if response.status_code != 206:
+                raise RequestException(f'服务器不支持分段下载: HTTP {response.status_code}')
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                if DOWNLOAD_CANCEL.is_set() or errors:
+                    return
+                if not chunk:
+                    continue
+                with lock:
+                    # 分段可能已被其他连接拆走后半部分，只写到当前的 end
+                    chunk = chunk[:max(0, seg['end'] - seg['pos'])]
+                    start = seg['pos']
+                if chunk:
+                    fh.seek(start)
+                    fh.write(chunk)
+                # 写入后再推进 pos，续传记录中不会出现尚未落盘的区间
+                with lock:
+                    seg['pos'] = start + len(chunk)
+                    done = seg['pos'] >= seg['end']
+                if chunk:
+                    if on_progress is not None:
+                        on_progress(len(chunk))
+                    limiter.consume(len(chunk), path)
+                    checkpoint()
+                if done:
+                    return
+        finally:
+            response.close()
+
+    def worker():
+        # 不带缓冲地写入，记录的进度即是已交给系统的数据
+        with open(path, 'r+b', buffering=0) as raw:
+            fh = TagSpaceFile(raw, layout) if layout else raw
+            while not DOWNLOAD_CANCEL.is_set() and not errors:
+                seg = take_segment()
+                if seg is None:
+                    return
+                failures = 0
+                while seg['pos'] < seg['end'] and not DOWNLOAD_CANCEL.is_set() and not errors:
+                    before = seg['pos']
+                    try:
+                        fetch(seg, fh)
+                    except (Timeout, ConnectionError, RequestException) as e:
+                        failures = 0 if seg['pos'] > before else failures + 1
+                        if failures > 2:
+                            errors.append(str(e))
+                with lock:
+                    seg['active'] = False
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(connections, len(segments)))]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(0.2)
+    except KeyboardInterrupt:
+        DOWNLOAD_CANCEL.set()
+        for t in threads:
+            t.join()
+    finally:
+        checkpoint(force=True)
+    if DOWNLOAD_CANCEL.is_set():
+        return False, '已取消'
+    if errors:
+        return False, errors[0]
+    missing = sum(seg['end'] - seg['pos'] for seg in segments)
+    if missing:
+        return False, f'分段下载不完整，缺少 {missing} 字节'
+    return True, None
+
+def refresh_track_url(job):
+    """链接过期（403/404/410）时重新解析，成功返回新链接，否则返回 None。"""
+    resolver = job.get('resolver')
+    if resolver is None:
+        return None
+    resolver.invalidate(job['track_id'])
+    entry, error = resolver.get(job['track_id'])
+    if error or not entry or not entry.get('url'):
+        return None
+    job['url_entry'] = entry
+    job['url'] = entry['url']
+    return entry['url']
+
+def new_track_job(track_id, track_name, artist_name, level, download_path, track_info=None, index=None, total=None):
+    """创建在下载流水线各阶段之间传递的任务字典。"""
+    return {'track_id': track_id, 'track_name': track_name, 'artist_name': artist_name, 'level': level, 'download_path': download_path, 'track_info': track_info, 'index': index, 'total': total, 'resolver': None, 'url_entry': None, 'url': None, 'filepath': None, 'filename': None, 'lyrics': None, 'lyric_version': None, 'cover': None, 'http_status': None, 'local': None, 'local_level': None}
+
+# 试听片段：时长短于 TRIAL_MAX_SECONDS 秒的音频视为试听片段（曲目本身不超过该时长的除外）
+TRIAL_MAX_SECONDS = 35
+# 链接条目无法判断时，下载前先读取的文件头字节数，用于从 FLAC STREAMINFO / MP3 帧头估算时长
+TRIAL_PROBE_BYTES = 16 * 1024
+MP3_BITRATES = {1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+                2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+
+def classify_trial(entry, track_info=None):
+    """根据下载链接条目（freeTrialInfo、time、size、br）判断是否只给了试听片段，是则返回原因，否则返回 None。"""
+    full = track_info.dt / 1000 if track_info is not None and track_info.dt else None
+    if full is not None and full <= TRIAL_MAX_SECONDS:
+        return None
+    trial = entry.get('freeTrialInfo')
+    if trial:
+        if isinstance(trial, dict) and trial.get('end'):
+            return f"仅提供试听片段({trial.get('start', 0)}-{trial['end']}s)"
+        return '仅提供试听片段'
+    estimates = []
+    if entry.get('time'):
+        estimates.append(entry['time'] / 1000)
+    if entry.get('size') and entry.get('br'):
+        estimates.append(entry['size'] * 8 / entry['br'])
+    if estimates and min(estimates) < TRIAL_MAX_SECONDS:
+        return f'音频长度过短({min(estimates):.1f}s)，可能为试听片段'
+    return None
+
+def estimate_stream_duration(head, size=0):
+    """由文件开头的字节估算时长（秒）：FLAC 读 STREAMINFO，MP3 读 Xing/Info 帧或按码率估算；无法判断时返回 None。"""
+    if head[:4] == b'fLaC':
+        if len(head) < 42 or head[4] & 0x7F != 0:
+            return None
+        info = head[8:42]
+        rate = info[10] << 12 | info[11] << 4 | info[12] >> 4
+        samples = (info[13] & 0x0F) << 32 | int.from_bytes(bytes(info[14:18]), 'big')
+        return samples / rate if rate and samples else None
+    pos = 0
+    if head[:3] == b'ID3' and len(head) >= 10:
+        pos = 10 + _syncsafe_int(head[6:10]) + (10 if head[5] & 0x10 else 0)
+    while pos < len(head) and head[pos] == 0:
+        pos += 1  # 标签后的填充
+    if len(head) < pos + 4 or head[pos] != 0xFF or head[pos + 1] & 0xE0 != 0xE0:
+        return None  # 首帧必须紧跟在标签之后，避免把任意数据误判为帧头
+    b1, b2, b3 = head[pos + 1], head[pos + 2], head[pos + 3]
+    version, layer, bitrate_index, rate_index = b1 >> 3 & 3, b1 >> 1 & 3, b2 >> 4, b2 >> 2 & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None  # 只处理 Layer III
+    mpeg1 = version == 3
+    rate = (44100, 48000, 32000)[rate_index] // (1 if mpeg1 else 2 if version == 2 else 4)
+    mono = b3 >> 6 == 3
+    xing = pos + 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17))
+    if head[xing:xing + 4] in (b'Xing', b'Info') and len(head) >= xing + 12 and head[xing + 7] & 1:
+        frames = int.from_bytes(bytes(head[xing + 8:xing + 12]), 'big')
+        return frames * (1152 if mpeg1 else 576) / rate
+    if size > pos:
+        return (size - pos) * 8 / (MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000)
+    return None
+
+def read_stream_head(response, nbytes):
+    """从未压缩的响应流中读出开头最多 nbytes 字节，之后仍可继续用 receive_into 读取剩余部分。"""
+    raw = getattr(response, 'raw', None)
+    if raw is None or not hasattr(raw, 'read') or (response.headers.get('content-encoding') or 'identity').lower() != 'identity':
+        return b''
+    head = bytearray()
+    try:
+        while len(head) < nbytes:
+            chunk = raw.read(nbytes - len(head))
+            if not chunk:
+                break
+            head += chunk
+    except Exception as e:
+        raise ConnectionError(e) from e
+    return bytes(head)
+
+def resolve_track_url(job, progress=None, resolver=None):
+    """阶段一：解析下载链接，失败时写入失败列表并返回 False。
+
+    传入 resolver 时从批量解析结果中取链接，否则单独请求。
+    """
+    track_id, track_name, artist_name, download_path = job['track_id'], job['track_name'], job['artist_name'], job['download_path']
+    log = progress.log if progress is not None else print
+    if copy_from_library(job, progress):
+        return True
+    if resolver is None:
+        resolver = TrackUrlResolver(job['level'], batch_size=1)
+    job['resolver'] = resolver
+    entry, error = resolver.get(track_id)
+    if error == '获取下载链接返回无效数据':
+        write_to_failed_list(track_id, track_name, artist_name, '获取下载链接返回无效数据', download_path)
+        log(f'\x1b[31m! 获取曲目 {track_name} 的下载链接返回无效数据\x1b[0m\x1b[K')
+        return False
+    if error:
+        write_to_failed_list(track_id, track_name, artist_name, f'获取下载链接失败: {error}', download_path)
+        log(f'\x1b[31m! 获取曲目 {track_name} 的下载链接时出错: {error}\x1b[0m\x1b[K')
+        return False
+    job['url_entry'] = entry
+    job['url'] = job['url_entry'].get('url')
+    if not job['url']:
+        if terminal_width >= 88 and progress is None:
+            sys.stdout.write('\r\x1b[1A\x1b[K')
+        write_to_failed_list(track_id, track_name, artist_name, '无可用下载链接（可能凭据错误或歌曲已下架）', download_path)
+        log(f'\x1b[31m! 无法下载 {track_name} - {artist_name}, 详情请查看 !#_FAILED_LIST.txt\x1b[0m\x1b[K')
+        return False
+    reason = classify_trial(entry, job['track_info'])
+    if reason:
+        # 试听片段不下载，直接记入失败列表
+        write_to_failed_list(track_id, track_name, artist_name, reason, download_path)
+        log(f'\x1b[33m! 跳过 {track_name} - {artist_name}: {reason}\x1b[0m\x1b[K')
+        return False
+    return True
+
+def find_local_copy(track_id, level):
+    """在共享音频库和曲库索引中查找音质不低于 level 的文件，返回 (来源, 路径, 实际音质) 或 None。"""
+    store = get_audio_store()
+    found = store.find(track_id, level) if store is not None else None
+    if found:
+        return ('store', found[0], found[1]['level'])
+    library = get_library_index()
+    local = library.find(track_id, level) if library is not None else None
+    if local:
+        return ('library', local['path'], local['level'])
+    return None
+
+def copy_from_library(job, progress=None):
+    """本地已有该曲目（音质不低于要求）时直接链接或复制，省去解析链接与下载。"""
+    found = find_local_copy(job['track_id'], job['level'])
+    if not found:
+        return False
+    source, path, found_level = found
+    safe_filename = make_safe_filename(f"{job['track_name']} - {job['artist_name']}{os.path.splitext(path)[1]}")
+    if source == 'store':
+        job['filepath'] = get_audio_store().link_view(job['track_id'], job['download_path'], found_level, safe_filename)
+        message = f'\x1b[32m✓ 已从共享音频库链接\x1b[0m{safe_filename}\x1b[K'
+    else:
+        safe_filepath = os.path.join(job['download_path'], safe_filename)
+        try:
+            if os.path.abspath(safe_filepath) != path:
+                os.makedirs(job['download_path'], exist_ok=True)
+                shutil.copy2(path, safe_filepath)
+        except OSError as e:
+            if DEBUG: print(e)
+            return False
+        job['filepath'] = safe_filepath
+        message = f'\x1b[32m✓ 已有本地文件\x1b[0m{safe_filename}\x1b[K'
+    job['filename'] = safe_filename
+    job['local'], job['local_level'] = source, found_level
+    if progress is not None:
+        progress.log(message)
+    else:
+        print(message)
+    return True
+
+def fetch_track_audio(job, progress=None):
+    """阶段二：流式下载音频到本地，成功后在 job 中记录文件路径。
+
+    只更新 progress 的字节计数，进度由渲染线程按固定频率绘制；未传入时单独创建一个。
+    """
+    if progress is None:
+        progress = ProgressRenderer(1)
+        try:
+            return fetch_track_audio(job, progress)
+        finally:
+            progress.close()
+    track_id, track_name, artist_name, download_path = job['track_id'], job['track_name'], job['artist_name'], job['download_path']
+    index, total, url = job['index'], job['total'], job['url']
+    if job['local']:
+        # 解析阶段已从本地取得文件
+        return True
+    entry = job['url_entry'] or {}
+    from urllib.parse import urlsplit
+    ext = entry.get('type') or os.path.splitext(urlsplit(url).path)[1].lstrip('.') or 'flac'
+    os.makedirs(download_path, exist_ok=True)
+    safe_filename = make_safe_filename(f'{track_name} - {artist_name}.{ext.lower()}')
+    safe_filepath = os.path.join(download_path, safe_filename)
+    part_path = f'{safe_filepath}.{track_id}.part'  # 同名不同 ID 的曲目可能同时下载
+    part_state = load_part_state(part_path, entry)
+    digits = len(str(total)) if (index is not None and total is not None) else 0
+    idx_str = f"[{index:0{digits}d}/{total}] " if (index is not None and total is not None) else ''
+    max_retries = 2
+    retry_count = 0
+    attempts = 0
+    completed = False
+    total_size = entry.get('size') or 0
+    layout = part_state.get('layout') if part_state is not None else None
+    if part_state is None and TAG_SPACE > 0 and total_size >= TAG_SPACE_MIN_SIZE:
+        layout = probe_tag_space(url, ext.lower())
+    if part_state is not None and part_state.get('segments') is not None and part_state.get('size'):
+        total_size = part_state['size']
+    elif part_state is None and SEGMENT_CONNECTIONS > 1 and total_size >= SEGMENTED_MIN_SIZE:
+        part_state = {'url': url, 'size': total_size, 'received': 0, 'md5': entry.get('md5'), 'track_id': track_id, 'level': job['level'], 'segments': None, 'layout': layout}
+    if part_state is not None and 'segments' in part_state:
+        # 分段下载：续传记录保存各分段尚未完成的区间
+        def save_segments(ranges):
+            part_state['segments'] = ranges
+            part_state['received'] = total_size - sum(e - s for s, e in ranges)
+            save_part_state(part_path, part_state)
+        progress.start(track_id, safe_filename, total_size, part_state.get('received') or 0)
+        segments = part_state['segments']
+        completed, error = download_segmented(url, part_path, total_size, on_progress=lambda n: progress.update(track_id, n), segments=segments, on_checkpoint=save_segments, layout=layout)
+        if not completed and not DOWNLOAD_CANCEL.is_set() and part_state.get('received'):
+            # 已有进度时只用单连接补齐剩余区间
+            progress.log(f'\x1b[33m! 分段下载失败（{error}），改用单连接补齐剩余部分\x1b[0m')
+            completed, error = download_segmented(url, part_path, total_size, connections=1, on_progress=lambda n: progress.update(track_id, n), segments=part_state['segments'], on_checkpoint=save_segments, layout=layout)
+        if not completed:
+            if DOWNLOAD_CANCEL.is_set():
+                # 保留部分文件和续传记录，下次从剩余区间继续
+                raise KeyboardInterrupt
+            if part_state.get('received'):
+                write_to_failed_list(track_id, track_name, artist_name, f'下载失败: {error}', download_path)
+                progress.log(f'\x1b[31m× 分段下载失败，已保留进度以便下次续传: {safe_filename}\x1b[0m')
+                return False
+            discard_part_file(part_path)
+            part_state = None
+            progress.log(f'\x1b[33m! 分段下载失败（{error}），改用单连接下载\x1b[0m')
+    while not completed and retry_count <= max_retries and attempts < MAX_DOWNLOAD_ATTEMPTS:
+        attempts += 1
+        downloaded = None
+        response = None
+        try:
+            offset = os.path.getsize(part_path) if part_state is not None and os.path.exists(part_path) else 0
+            if layout and offset:
+                # 本地文件含预留空间，续传位置按已记录的远端字节数计算
+                offset = min(part_state.get('received') or 0, offset)
+            if part_state is not None and part_state.get('size') and offset >= part_state['size']:
+                # 上次已接收完整但未来得及改名
+                completed = True
+                break
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            response = get_http_transport().get(url, stream=True, timeout=30, headers=headers)
+            if response.status_code in (403, 404, 410) and job.get('resolver') is not None and retry_count < max_retries:
+                # 链接可能已过期，重新解析后续传
+                response.close()
+                url = refresh_track_url(job) or url
+                retry_count += 1
+                continue
+            if response.status_code == 416 and offset:
+                response.close()
+                discard_part_file(part_path)
+                part_state = None
+                retry_count += 1
+                continue
+            if response.status_code not in (200, 206):
+                job['http_status'] = response.status_code
+                progress.log(f'\x1b[31m× 获取 URL 时出错: {response.status_code} - {response.text}\x1b[0m')
+                write_to_failed_list(track_id, track_name, artist_name, f'HTTP错误: {response.status_code}', download_path)
+                return False
+            if response.status_code == 200:
+                # 服务器忽略了 Range，从头下载
+                offset = 0
+            file_size = offset + int(response.headers.get('content-length', 0))
+            content_range = response.headers.get('content-range') or ''
+            if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                file_size = int(content_range.rsplit('/', 1)[1])
+            if not file_size:
+                file_size = entry.get('size') or 0
+            head = b''
+            full = job['track_info'].dt / 1000 if job['track_info'] and job['track_info'].dt else None
+            if not offset and TRIAL_PROBE_BYTES and (full is None or full > TRIAL_MAX_SECONDS):
+                # 链接条目未能识别的试听片段：读到文件头就中止，不下载整个文件
+                head = read_stream_head(response, TRIAL_PROBE_BYTES)
+                seconds = estimate_stream_duration(head, file_size)
+                if seconds is not None and seconds < TRIAL_MAX_SECONDS:
+                    response.close()
+                    discard_part_file(part_path)
+                    write_to_failed_list(track_id, track_name, artist_name, f'音频长度过短({seconds:.1f}s)，可能为试听片段', download_path)
+                    progress.log(f'\x1b[33m! 跳过 {safe_filename}: 文件头显示仅 {seconds:.1f} 秒，可能为试听片段\x1b[0m')
+                    return False
+            part_state = {'url': url, 'size': file_size, 'received': offset, 'md5': entry.get('md5'), 'track_id': track_id, 'level': job['level'], 'layout': layout}
+            save_part_state(part_path, part_state)
+            downloaded = offset
+            last_downloaded = offset
+            last_update_time = time.time()
+            last_state_save = last_update_time
+            progress.start(track_id, safe_filename, file_size, offset)
+            with open(part_path, 'r+b' if offset else 'wb') as raw_file:
+                f = TagSpaceFile(raw_file, layout) if layout else raw_file
+                f.seek(offset)
+                f.truncate()
+                writer = DiskWriter(f, offset)
+                limiter = get_bandwidth_limiter()
+                try:
+                    if head:
+                        buf, _ = writer.acquire()
+                        buf[:len(head)] = head
+                        writer.submit(buf, len(head))
+                        downloaded += len(head)
+                        progress.update(track_id, len(head))
+                    for nbytes, waited in receive_into(response, writer):
+                        if DOWNLOAD_CANCEL.is_set():
+                            raise KeyboardInterrupt
+                        downloaded += nbytes
+                        progress.update(track_id, nbytes)
+                        waited += limiter.consume(nbytes, track_id)
+                        # 等待写盘腾出缓冲区和限速休眠的时间不算网络停滞
+                        last_update_time += waited
+                        now = time.time()
+                        if now - last_state_save >= 1:
+                            part_state['received'] = writer.written
+                            save_part_state(part_path, part_state)
+                            last_state_save = now
+                        # 超时 / 停滞检测（10 秒无网络进展）
+                        if now - last_update_time >= 10:
+                            if downloaded == last_downloaded:
+                                progress.log(f'\x1b[33m! 下载 {safe_filename} 停滞，正在重试...\x1b[0m')
+                                break
+                            last_downloaded = downloaded
+                            last_update_time = now
+                finally:
+                    writer.close()
+                    downloaded = writer.written
+            if writer.error is not None:
+                raise writer.error
+            if downloaded < file_size and file_size > 0:
+                if downloaded > offset:
+                    # 本次有进展，重试计数归零，从断点续传
+                    retry_count = 0
+                retry_count += 1
+                if retry_count <= max_retries and attempts < MAX_DOWNLOAD_ATTEMPTS:
+                    progress.log(f'\x1b[33m! 下载不完整，正在从断点续传 ({retry_count}/{max_retries})...\x1b[0m')
+                    continue
+                else:
+                    write_to_failed_list(track_id, track_name, artist_name, '下载不完整', download_path)
+                    progress.log(f'\x1b[31m× 多次尝试下载失败: {safe_filename}\x1b[0m')
+                    return False
+            completed = True
+            break
+        except (Timeout, ConnectionError, RequestException) as e:
+            if downloaded is not None and downloaded > offset:
+                retry_count = 0
+            retry_count += 1
+            if retry_count <= max_retries and attempts < MAX_DOWNLOAD_ATTEMPTS:
+                progress.log(f'\x1b[33m! 下载超时，正在重试 ({retry_count}/{max_retries})...\x1b[0m')
+            else:
+                write_to_failed_list(track_id, track_name, artist_name, f'下载失败: {e}', download_path)
+                progress.log(f'\x1b[31m× 多次尝试下载失败: {e}\x1b[0m')
+                return False
+        finally:
+            # 停滞、取消或出错时也要关闭响应，否则连接一直占用连接池（pool_block=True）的名额
+            if response is not None:
+                with suppress(Exception):
+                    response.close()
+            # 无论成功、异常还是 Ctrl+C，都记录已接收的字节数以便下次续传
+            if downloaded is not None and part_state is not None:
+                part_state['received'] = downloaded
+                with suppress(Exception):
+                    save_part_state(part_path, part_state)
+    if not completed:
+        write_to_failed_list(track_id, track_name, artist_name, '下载失败: 重试次数过多', download_path)
+        progress.log(f'\x1b[31m× 多次尝试下载失败: {safe_filename}\x1b[0m')
+        return False
+    os.replace(part_path, safe_filepath)
+    discard_part_file(part_path, keep_data=True)
+    progress.log(f'\x1b[32m✓ 已下载{idx_str}\x1b[0m{safe_filename}')
+    job['filepath'] = safe_filepath
+    job['filename'] = safe_filename
+    return True
+
+def fetch_track_extras(job, progress=None):
+    """阶段三：补全曲目详情，获取歌词与专辑封面。"""
+    log = progress.log if progress is not None else print
+    track_id, track_name, artist_name, download_path = job['track_id'], job['track_name'], job['artist_name'], job['download_path']
+    url_entry = job['url_entry'] or {}
+    if not job['track_info'] and url_entry.get('id'):
+        try:
+            track_detail, error = get_track_detail([url_entry['id']])
+            if not error and track_detail and ('songs' in track_detail) and track_detail['songs']:
+                job['track_info'] = track_detail['songs'][0]
+            elif error:
+                log(f'\x1b[33m! 获取曲目详情失败: {error}\x1b[0m\x1b[K')
+        except Exception as e:
+            log(f'\x1b[33m! 获取曲目详情失败: {e}\x1b[0m\x1b[K')
+    song_duration = job['track_info'].dt / 1000 if job['track_info'] and job['track_info'].dt else None
+    lyrics_success, lyrics_content = process_lyrics(track_id, track_name, artist_name, lyrics_option, download_path, job['filepath'], song_duration, progress) # type: ignore # globaled
+    job['lyrics'] = lyrics_content if lyrics_success else None
+    cache = get_api_cache()
+    if cache is not None and lyrics_option != 'none': # type: ignore # globaled
+        lyric_data = cache.get('lyrics', track_id, allow_stale=True)
+        if lyric_data:
+            job['lyric_version'] = lyric_versions(lyric_data)[0]
+    if job['track_info']:
+        try:
+            job['cover'] = fetch_album_cover(job['track_info'])
+        except Exception as e:
+            job['cover'] = {}
+            log(f'\x1b[33m! 获取专辑封面失败: {e}\x1b[0m\x1b[K')
+    return True
+
+def tag_and_verify(file_path, track_info, lyrics_content=None, cover=None):
+    """阶段四：检查音频时长并写入元数据。
+
+    文件只打开一次：读取时长、写入标签与计算校验值都在同一句柄上完成。
+    只依赖参数且结果可 pickle，可在进程池中执行；提示信息收集到 output 中交由主进程打印。
+    不重定向 sys.stdout：在线程中打标签时重定向会影响其他线程的输出。
+    """
+    messages = []
+    result = {'duration': None, 'output': '', 'tagged': False}
+    try:
+        with open(file_path, 'rb+') as f:
+            audio = None
             try:
-                audio = MutagenFile(safe_filepath)
+                from mutagen import File as MutagenFile # pyright: ignore[reportMissingImports]
+                audio = MutagenFile(f)
                 if audio is not None and hasattr(audio, 'info') and hasattr(audio.info, 'length'):
-                    duration = audio.info.length
-                    if duration < 35:
-                        print(f'\x1b[33m! 警告: {safe_filename} 音频长度仅为 {duration:.1f} 秒，可能为试听片段。\x1b[0m\x1b[K')
-                        print('\x1b[33m  出现这种问题可能是您没有VIP权限或网易云变更接口所致。\x1b[0m\x1b[K')
-                        write_to_failed_list(track_id, track_name, artist_name, f'音频长度过短({duration:.1f}s)，可能为试听片段', download_path)
+                    result['duration'] = audio.info.length
             except Exception as e:
-                print(f'\x1b[33m! 检查音频长度时出错: {e}\x1b[0m\x1b[K')
-            if not track_info and url_info['data'][0].get('id'):
-                try:
-                    track_detail, error = get_track_detail([url_info['data'][0]['id']])
-                    if not error and track_detail and ('songs' in track_detail) and track_detail['songs']:
-                        track_info = track_detail['songs'][0]
-                    elif error:
-                        print(f'\x1b[33m! 获取曲目详情失败: {error}\x1b[0m\x1b[K')
-                except Exception as e:
-                    print(f'\x1b[33m! 获取曲目详情失败: {e}\x1b[0m\x1b[K')
-            lyrics_success, lyrics_content = process_lyrics(track_id, track_name, artist_name, lyrics_option, download_path, safe_filepath) # type: ignore # globaled
+                messages.append(f'\x1b[33m! 检查音频长度时出错: {e}\x1b[0m\x1b[K')
             if track_info:
-                add_metadata_to_audio(safe_filepath, track_info, lyrics_content if lyrics_success else None)
-            else:
-                write_to_failed_list(track_id, track_name, artist_name, '无法添加元数据: 缺少曲目信息', download_path)
-                print('\x1b[33m! 无法添加元数据: 缺少曲目信息\x1b[0m\x1b[K')
-        else:
-            if terminal_width >= 88:
-                sys.stdout.write('\r\x1b[1A\x1b[K')
-            write_to_failed_list(track_id, track_name, artist_name, '无可用下载链接（可能凭据错误或歌曲已下架）', download_path)
-            print(f'\x1b[31m! 无法下载 {track_name} - {artist_name}, 详情请查看 !#_FAILED_LIST.txt\x1b[0m\x1b[K')
+                result['tagged'] = add_metadata_to_audio(file_path, track_info, lyrics_content, cover, audio, f, log=messages.append)
+            # 打完标签后的校验值在工作进程中计算，供下载清单与曲库使用
+            result['md5'] = stream_checksum(f)
+    except OSError as e:
+        messages.append(f'\x1b[33m! 无法打开音频文件: {e}\x1b[0m\x1b[K')
+    result['output'] = '\n'.join(messages)
+    return result
+
+def finish_track_job(job, result, progress=None):
+    """处理打标签阶段的结果：输出信息并记录试听片段/缺少信息等问题。"""
+    track_id, track_name, artist_name, download_path = job['track_id'], job['track_name'], job['artist_name'], job['download_path']
+    log = progress.log if progress is not None else print
+    for line in result['output'].splitlines():
+        log(line)
+    duration = result['duration']
+    if duration is not None and duration < TRIAL_MAX_SECONDS:
+        log(f'\x1b[33m! 警告: {job["filename"]} 音频长度仅为 {duration:.1f} 秒，可能为试听片段。\x1b[0m\x1b[K')
+        log('\x1b[33m  出现这种问题可能是您没有VIP权限或网易云变更接口所致。\x1b[0m\x1b[K')
+        write_to_failed_list(track_id, track_name, artist_name, f'音频长度过短({duration:.1f}s)，可能为试听片段', download_path)
+    elif job['filepath'] and os.path.exists(job['filepath']):
+        # 试听片段不记入清单，下次同步时会重新尝试
+        try:
+            checksum = result.get('md5') or file_checksum(job['filepath'])
+            # 本地取得的文件按实际音质记录
+            level = job['local_level'] or (job['url_entry'] or {}).get('level') or job['level']
+            get_sync_manifest(download_path).record(track_id, job['level'], job['filepath'], level, checksum)
+            store = get_audio_store()
+            stored_path = job['filepath']
+            if store is not None and job['local'] == 'store':
+                stored_path = (store.find(track_id, level) or (stored_path,))[0]
+            elif store is not None:
+                stored_path = store.adopt(track_id, level, job['filepath'])
+            library = get_library_index()
+            if library is not None:
+                cover_id = get_cover_cache().key_for(job['track_info']) if job['track_info'] else None
+                library.record(track_id, stored_path, level, checksum, result.get('tagged'), job['lyric_version'], cover_id)
+        except Exception as e:
+            log(f'\x1b[33m! 更新下载清单失败: {e}\x1b[0m\x1b[K')
+    if not job['track_info']:
+        write_to_failed_list(track_id, track_name, artist_name, '无法添加元数据: 缺少曲目信息', download_path)
+        log('\x1b[33m! 无法添加元数据: 缺少曲目信息\x1b[0m\x1b[K')
+
+def download_and_save_track(track_id, track_name, artist_name, level, download_path, track_info=None, index=None, total=None, progress=None):
+    job = new_track_job(track_id, track_name, artist_name, level, download_path, track_info, index, total)
+    own_progress = progress is None
+    if own_progress:
+        progress = ProgressRenderer(1)
+    try:
+        if not resolve_track_url(job, progress):
+            return
+        if not fetch_track_audio(job, progress):
+            return
+        fetch_track_extras(job, progress)
+        finish_track_job(job, tag_and_verify(job['filepath'], job['track_info'], job['lyrics'], job['cover']), progress)
+
     except (KeyError, IndexError) as e:
-        if terminal_width >= 88:
-            sys.stdout.write('\r\x1b[1A\x1b[K')
         write_to_failed_list(track_id, track_name, artist_name, f'URL信息错误: {e}', download_path)
-        print(f'\x1b[31m! 访问曲目 {track_name} - {artist_name} 的URL信息时出错: {e}\x1b[0m\x1b[K')
+        progress.log(f'\x1b[31m! 访问曲目 {track_name} - {artist_name} 的URL信息时出错: {e}\x1b[0m')
     except Exception as e:
-        if terminal_width >= 88:
-            sys.stdout.write('\r\x1b[1A\x1b[K')
         write_to_failed_list(track_id, track_name, artist_name, f'未知下载错误: {e}', download_path)
-        print(f'\x1b[31m! 下载歌曲时出错: {e}\x1b[0m\x1b[K')
+        progress.log(f'\x1b[31m! 下载歌曲时出错: {e}\x1b[0m')
+    finally:
+        if own_progress:
+            progress.close()
+            flush_sync_manifests()
+
+_failed_track_ids = set()
+
+def take_failed_track_ids():
+    """返回自上次调用以来写入失败列表的曲目 ID，并清空记录。"""
+    with _FAILED_LIST_LOCK:
+        ids = set(_failed_track_ids)
+        _failed_track_ids.clear()
+    return ids
+
+def read_failed_list(download_path):
+    """读取下载目录中 !#_FAILED_LIST.txt 记录的曲目 ID（去重，保持顺序）。"""
+    ids = []
+    with suppress(FileNotFoundError):
+        with open(os.path.join(download_path, '!#_FAILED_LIST.txt'), 'r', encoding='utf-8') as f:
+            for line in f:
+                m = re.match('ID: (\\d+) - ', line)
+                if m and m.group(1) not in ids:
+                    ids.append(m.group(1))
+    return ids
 
 def write_to_failed_list(track_id, track_name, artist_name, reason, download_path):
     failed_list_path = os.path.join(download_path, '!#_FAILED_LIST.txt')
-    if not os.path.exists(failed_list_path):
-        with open(failed_list_path, 'w', encoding='utf-8') as f:
-            f.write('此处列举了下载失败的歌曲\n可能的原因：\n1.歌曲为单曲付费曲目 \n2.歌曲已下架 \n3.地区限制（如VPN） \n4.网络问题 \n5.VIP曲目但账号无VIP权限\n=== === === === === === === === === === === ===\n\n')
-    with open(failed_list_path, 'a', encoding='utf-8') as f:
-        f.write(f'ID: {track_id} - 歌曲: {track_name} - 艺术家: {artist_name} - 原因: {reason}\n')
+    with _FAILED_LIST_LOCK:
+        with suppress(TypeError, ValueError):
+            _failed_track_ids.add(int(track_id))
+        if not os.path.exists(failed_list_path):
+            with open(failed_list_path, 'w', encoding='utf-8') as f:
+                f.write('此处列举了下载失败的歌曲\n可能的原因：\n1.歌曲为单曲付费曲目 \n2.歌曲已下架 \n3.地区限制（如VPN） \n4.网络问题 \n5.VIP曲目但账号无VIP权限\n=== === === === === === === === === === === ===\n\n')
+        with open(failed_list_path, 'a', encoding='utf-8') as f:
+            f.write(f'ID: {track_id} - 歌曲: {track_name} - 艺术家: {artist_name} - 原因: {reason}\n')
+
+def extract_id_and_type(text: str):
+    """从 ID 或分享链接中提取 (ID, 类型)，类型为 'playlist'、'track' 或无法判断时的 None。"""
+    if not text:
+        return (None, None)
+    s = text.strip().strip('"\'')
+    if re.fullmatch('\\d+', s):
+        return (s, None)
+    m = re.search('[?&]id=(\\d+)', s)
+    found_id = m.group(1) if m else None
+    lower = s.lower()
+    inferred = None
+    if re.search('(?:#|/)(?:.*)playlist', lower) or '/playlist' in lower:
+        inferred = 'playlist'
+    elif re.search('(?:#|/)(?:.*)song', lower) or '/song' in lower or '/track' in lower:
+        inferred = 'track'
+    if found_id:
+        return (found_id, inferred)
+    m2 = re.search('(\\d{5,})', s)
+    if m2:
+        return (m2.group(1), inferred)
+    return (None, None)
 
 def load_session_from_file(filename='session.json'):
+    global SESSION_FILE
     if os.path.exists(filename):
+        SESSION_FILE = filename
         with open(filename, 'r') as f:
             session_data = json.load(f)
         session = pyncm.LoadSessionFromString(session_data)
@@ -1526,7 +4137,7 @@ def load_session_from_file(filename='session.json'):
 def get_current_nickname(default_name: str='未登录用户') -> str:
     """获取当前登录用户昵称，失败则返回默认值。"""
     try:
-        status = login.GetCurrentLoginStatus()
+        status = get_login_status()
         if DEBUG:
             print('当前登录状态：', status)
             input('按回车键继续...')
@@ -1575,7 +4186,7 @@ def display_user_info(session=None, silent=False):
             if not silent:
                 print(f'\x1b[32m✓ 登录用户: \x1b[36m{nick}\x1b[0m (ID: {uid}) VIP: \x1b[33m{vip_str}\x1b[0m' if uid != '-' else f'\x1b[31m× 登录失败！\n  删除session.json后重新登录或反馈给开发者。\x1b[0m')
             return USER_INFO_CACHE
-        status = login.GetCurrentLoginStatus()
+        status = get_login_status()
         info = _parse_user_info_from_status(status if isinstance(status, dict) else {})
         nick = info.get('nickname') or '未知用户'
         uid = info.get('user_id') or '-'
@@ -1621,7 +4232,6 @@ if __name__ == '__main__':
             print('\x1b[33m  如需更换账号，请删除 session.json 文件后重新运行脚本。\x1b[0m')
             with suppress(Exception):
                 display_user_info(session)
-            time.sleep(2)
         else:
             try:
                 session = get_qrcode()
@@ -1633,7 +4243,7 @@ if __name__ == '__main__':
                 input('  按回车退出程序...')
                 sys.exit(1)
         default_path = os.path.join(os.getcwd(), 'downloads')
-        config = {'download_path': default_path, 'mode': 'playlist', 'playlist_id': None, 'track_id': None, 'level': 'exhigh', 'lyrics_option': 'both'}
+        config = {'download_path': default_path, 'mode': 'playlist', 'playlist_id': None, 'track_id': None, 'level': 'exhigh', 'lyrics_option': 'both', 'workers': DOWNLOAD_WORKERS, 'sync': 'off'}
         preview_cache = {'playlist': {'id': None, 'name': None, 'count': None, 'error': None}, 'track': {'id': None, 'name': None, 'artist': None, 'error': None}}
 
         def color_text(text, color_code):
@@ -1658,26 +4268,6 @@ if __name__ == '__main__':
             print('> 配置 ID')
             print('\x1b[94mi 有关于歌单 ID 和单曲 ID 的说明，请参阅 https://github.com/padoru233/NCM-Playlist-Downloader/blob/main/README.md#使用方法\x1b[0m')
 
-            def extract_id_and_type(text: str):
-                if not text:
-                    return (None, None)
-                s = text.strip().strip('"\'')
-                if re.fullmatch('\\d+', s):
-                    return (s, None)
-                m = re.search('[?&]id=(\\d+)', s)
-                found_id = m.group(1) if m else None
-                lower = s.lower()
-                inferred = None
-                if re.search('(?:#|/)(?:.*)playlist', lower) or '/playlist' in lower:
-                    inferred = 'playlist'
-                elif re.search('(?:#|/)(?:.*)song', lower) or '/song' in lower or '/track' in lower:
-                    inferred = 'track'
-                if found_id:
-                    return (found_id, inferred)
-                m2 = re.search('(\\d{5,})', s)
-                if m2:
-                    return (m2.group(1), inferred)
-                return (None, None)
             prompt = '  请输入歌单 ID\x1b[36m > \x1b[0m' if config['mode'] == 'playlist' else '  请输入单曲 ID\x1b[36m > \x1b[0m'
             ipt = input(prompt).strip()
             final_id = None
@@ -1695,12 +4285,19 @@ if __name__ == '__main__':
                 else:
                     print('\x1b[33m! 未输入且剪贴板为空，ID 被视为未指定。\x1b[0m')
             else:
-                extracted_id, extracted_type = extract_id_and_type(ipt)
-                if extracted_id:
-                    final_id = extracted_id
-                    final_type = extracted_type
+                tokens = [t for t in re.split('[\\s,，;；]+', ipt) if t]
+                multi = [extract_id_and_type(t) for t in tokens] if len(tokens) > 1 else []
+                if multi and all(tid and ttype in (None, 'track') for tid, ttype in multi):
+                    # 多个单曲 ID/链接：以逗号拼接，下载时批量解析
+                    final_id = ','.join(tid for tid, _ in multi)
+                    final_type = 'track'
                 else:
-                    print('\x1b[33m! 输入未包含有效ID或可解析链接，视为未指定。\x1b[0m')
+                    extracted_id, extracted_type = extract_id_and_type(ipt)
+                    if extracted_id:
+                        final_id = extracted_id
+                        final_type = extracted_type
+                    else:
+                        print('\x1b[33m! 输入未包含有效ID或可解析链接，视为未指定。\x1b[0m')
             if final_id:
                 if not final_type:
                     final_type = config['mode']
@@ -1757,33 +4354,61 @@ if __name__ == '__main__':
             if sel in mapping:
                 config['lyrics_option'] = mapping[sel]
 
+        def choose_workers():
+            print('\x1b[2m' + '=' * (terminal_width//2) + '\x1b[0m')
+            print('> 并发下载 选项')
+            print('同时下载的曲目数（1 为逐首下载，过大可能触发网易云限流）：')
+            print(f"当前：\x1b[33m{config['workers']}\x1b[0m")
+            print('\n\x1b[36m[0]\x1b[0m 取消')
+            sel = input('  请输入 1-16\x1b[36m > \x1b[0m').strip()
+            if sel.isdigit() and 1 <= int(sel) <= 16:
+                config['workers'] = int(sel)
+
+        def choose_sync():
+            print('\x1b[2m' + '=' * (terminal_width//2) + '\x1b[0m')
+            print('> 增量同步 选项')
+            print('仅对歌单有效，根据下载目录中的 !#_manifest.json 跳过已下载的曲目：')
+            opts = [
+                ('off', '关闭（全部重新下载）'),
+                ('sync', '只下载新增或需升级音质的曲目'),
+                ('prune', '同步并删除已从歌单移除的曲目'),
+            ]
+            for i, (val, zh) in enumerate(opts, 1):
+                flag = '\x1b[44m' if config.get('sync') == val else ''
+                print(f"\x1b[36m[{i}]\x1b[0m {flag}{zh} ({val})\x1b[0m ")
+            print('\n\x1b[36m[0]\x1b[0m 取消')
+            sel = input('\x1b[36m> \x1b[0m').strip()
+            mapping = {str(i): v for i, (v, _) in enumerate(opts, 1)}
+            if sel in mapping:
+                config['sync'] = mapping[sel]
+
         def refresh_preview():
             try:
                 if config['mode'] == 'track' and config['track_id']:
                     if preview_cache['track']['id'] == config['track_id']:
                         return
-                    info, err = get_track_detail([config['track_id']])
+                    info, err = get_track_detail(config['track_id'].split(','))
                     if err or not info or (not info.get('songs')):
                         preview_cache['track'] = {'id': config['track_id'], 'name': None, 'artist': None, 'error': str(err) if err else '无结果'} # pyright: ignore[reportArgumentType]
                     else:
                         song = info['songs'][0]
-                        name = song.get('name', '')
-                        artist = ', '.join((a.get('name', '') for a in song.get('ar', [])))
+                        name = song.name
+                        if len(info['songs']) > 1:
+                            name = f"{name} 等 {len(info['songs'])} 首"
+                        artist = song.artist_name
                         preview_cache['track'] = {'id': config['track_id'], 'name': name, 'artist': artist, 'error': None} # pyright: ignore[reportArgumentType]
                 elif config['mode'] == 'playlist' and config['playlist_id']:
                     if preview_cache['playlist']['id'] == config['playlist_id']:
                         return
-                    lst, err = get_playlist_all_tracks(config['playlist_id'])
+                    # 预览只取元数据；开始下载时复用该元数据，曲目列表未改动时按快照从缓存读取
+                    meta, err = get_playlist_meta(config['playlist_id'])
                     if DEBUG:
-                        print(f'调试信息：\x1b[90m{lst}\x1b[0m')
+                        print(f'调试信息：\x1b[90m{meta}\x1b[0m')
                         input('按回车键继续...')
-                    if err or not lst or 'songs' not in lst:
+                    if err or not meta or 'snapshot' not in meta:
                         preview_cache['playlist'] = {'id': config['playlist_id'], 'name': None, 'count': None, 'error': str(err) if err else '无结果'} # type: ignore
                     else:
-                        songs = lst.get('songs', []) or []
-                        count = len(songs)
-                        first_song_name = songs[0].get('name') if songs else None
-                        preview_cache['playlist'] = {'id': config['playlist_id'], 'name': first_song_name, 'count': count, 'error': None} # type: ignore
+                        preview_cache['playlist'] = {'id': config['playlist_id'], 'name': meta['first'], 'count': meta['count'], 'error': None} # type: ignore
             except Exception as e:
                 if config['mode'] == 'track':
                     preview_cache['track'] = {'id': config.get('track_id'), 'name': None, 'artist': None, 'error': str(e)} # type: ignore # type: ignore
@@ -1855,6 +4480,9 @@ if __name__ == '__main__':
             print(f'\x1b[36m[3]\x1b[0m音质: \x1b[33m{level_zh}\x1b[0m')
             lyrics_zh = {'both': '写入标签和文件', 'metadata': '只写入标签', 'lrc': '只写入lrc文件', 'none': '不处理歌词'}.get(config['lyrics_option'], config['lyrics_option'])
             print(f'\x1b[36m[4]\x1b[0m歌词: \x1b[33m{lyrics_zh}\x1b[0m')
+            print(f"\x1b[36m[5]\x1b[0m并发下载数: \x1b[33m{config['workers']}\x1b[0m")
+            sync_zh = {'off': '关闭', 'sync': '增量同步', 'prune': '同步并清理'}.get(config['sync'], config['sync'])
+            print(f'\x1b[36m[6]\x1b[0m增量同步: \x1b[33m{sync_zh}\x1b[0m')
             print('\x1b[2m' + '-' * terminal_width + '\x1b[0m')
             if not display_only:
                 print('\x1b[42;97;1;5m[9] ▶ 开始任务\x1b[0m\t[Ctrl + C] 退出程序' if ready_to_go else '\x1b[9m[9] ▶ 开始任务\x1b[0m\t[Ctrl + C] 退出程序')
@@ -1873,6 +4501,10 @@ if __name__ == '__main__':
                 choose_level()
             elif choice == '4':
                 choose_lyrics()
+            elif choice == '5':
+                choose_workers()
+            elif choice == '6':
+                choose_sync()
             elif choice == '9':
                 selected_id = config['playlist_id'] if config['mode'] == 'playlist' else config['track_id']
                 if not selected_id:
@@ -1887,7 +4519,9 @@ if __name__ == '__main__':
                 print(f'\x1b[0m\n' + '=' * terminal_width + '\n\x1b[94m  开始下载...\n\x1b[32m✓ 正在使用听歌API，不消耗VIP下载额度\x1b[0m\x1b[?25l')
                 globals()['lyrics_option'] = config['lyrics_option']
                 if config['mode'] == 'playlist':
-                    get_playlist_tracks_and_save_info(selected_id, config['level'], config['download_path'])
+                    get_playlist_tracks_and_save_info(selected_id, config['level'], config['download_path'], config['workers'], sync=config['sync'] != 'off', prune=config['sync'] == 'prune')
+                elif ',' in selected_id:
+                    get_tracks_info(selected_id.split(','), config['level'], config['download_path'], config['workers'])
                 else:
                     get_track_info(selected_id, config['level'], config['download_path'])
                 print('\x1b[?25h', end='')
@@ -1911,7 +4545,7 @@ if __name__ == '__main__':
             resp = input('\x1b[33m  按回车键退出，按\x1b[31m 9 \x1b[33m并回车删除已保存会话文件并退出：\x1b[0m').strip()
             if resp == '9':
                 removed = []
-                for fn in ('session.json', 'session2.json'):
+                for fn in ('session.json', 'session2.json', _login_status_path('session.json')):
                     with suppress(Exception):
                         if os.path.exists(fn):
                             os.remove(fn)
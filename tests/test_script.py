@@ -1,4 +1,5 @@
 import builtins
+import json
 import os
 import sys
 import types
@@ -48,7 +49,25 @@ def dummy_get(*args, **kwargs):
     return Resp()
 req_mod.get = dummy_get
 req_mod.exceptions = req_ex
+class DummySession:
+    def __init__(self):
+        self.adapters = {}
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+    def get_adapter(self, url):
+        return self.adapters.get(url)
+    def get(self, *args, **kwargs):
+        return dummy_get(*args, **kwargs)
+    def head(self, *args, **kwargs):
+        return dummy_get(*args, **kwargs)
+req_mod.Session = DummySession
 sys.modules['requests'] = req_mod
+req_adapters = types.ModuleType('requests.adapters')
+class DummyAdapter:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+req_adapters.HTTPAdapter = DummyAdapter
+sys.modules['requests.adapters'] = req_adapters
 
 # mutagen minimal
 mut = types.ModuleType('mutagen')
@@ -106,6 +125,19 @@ except ModuleNotFoundError:
     spec.loader.exec_module(script)
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache(monkeypatch, tmp_path_factory):
+    # 接口缓存、封面缓存、曲库索引等默认位于工作目录的 .ncm_cache 中，测试时改到临时目录
+    cache_dir = str(tmp_path_factory.mktemp('cache'))
+    monkeypatch.setattr(script, 'CACHE_DIR', cache_dir)
+    monkeypatch.setattr(script, 'LIBRARY_INDEX_PATH', os.path.join(cache_dir, 'library.db'))
+    monkeypatch.setattr(script, 'CONCURRENCY_LOG', os.path.join(cache_dir, 'concurrency.log'))
+    monkeypatch.setattr(script, 'BANDWIDTH_CONTROL_FILE', os.path.join(cache_dir, 'bandwidth.txt'))
+    for singleton in ('_api_cache', '_cover_cache', '_library_index', '_concurrency', '_bandwidth_limiter'):
+        monkeypatch.setattr(script, singleton, None)
+    monkeypatch.setattr(script, '_playlist_meta', {})
+
+
 def test_parse_lrc_empty():
     assert script.parse_lrc('') == []
     assert script.parse_lrc(None) == []
@@ -133,6 +165,22 @@ def test_merge_lyrics_with_translated():
     assert any(t[1] == 'A' for t in merged)
 
 
+def test_parse_lrc_multi_timestamp_offset_and_colon_variant():
+    content = "[ar:someone]\n[offset:500]\n[00:10.00][00:30:50]chorus\n[00:20.5]verse\n[00:40]end\r\n"
+    res = script.parse_lrc(content)
+    assert [text for _, text in res] == ['chorus', 'verse', 'chorus', 'end']
+    assert [t for t, _ in res] == pytest.approx([9.5, 20.0, 30.0, 39.5])
+
+
+def test_merge_lyrics_aligns_nearest_within_tolerance():
+    orig = [(10.0, 'a'), (10.0, 'a2'), (20.0, 'b'), (30.0, 'c')]
+    trans = [(10.02, 'A'), (19.95, 'B'), (25.0, 'far')]
+    merged = script.merge_lyrics(orig, trans, song_duration=40)
+    assert [text for _, text in merged] == ['a', 'A', 'a2', 'b', 'B', 'c']
+    assert [t for t, _ in merged] == sorted(t for t, _ in merged)
+    assert merged[4][0] == pytest.approx(30.0 - script.LYRIC_TRANSLATION_GAP)
+
+
 def test_format_lrc_line():
     line = script.format_lrc_line(65.37, 'hi')
     assert line.startswith('[01:05.') and line.endswith('hi')
@@ -159,3 +207,994 @@ def test_parse_user_info_variants():
 def test_get_terminal_size_returns_tuple():
     cols, lines = script.get_terminal_size()
     assert isinstance(cols, int) and isinstance(lines, int)
+
+
+def test_display_width_and_truncate():
+    assert script.display_width('abc') == 3
+    assert script.display_width('歌曲') == 4
+    out = script.truncate_filename('很长很长很长的歌曲名字.flac', 12)
+    assert out.endswith('….flac')
+    assert script.display_width(out) <= 12
+
+
+def test_write_to_failed_list_threaded(tmp_path):
+    import threading
+    threads = [threading.Thread(target=script.write_to_failed_list, args=(i, f't{i}', 'a', 'r', str(tmp_path))) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    content = (tmp_path / '!#_FAILED_LIST.txt').read_text(encoding='utf-8')
+    assert content.count('此处列举了下载失败的歌曲') == 1
+    assert content.count('原因: r') == 20
+
+
+def test_download_pipeline_runs_all_stages_bounded(monkeypatch, tmp_path):
+    import threading
+    lock = threading.Lock()
+    state = {'running': 0, 'peak': 0, 'tagged': []}
+
+    def fake_fetch(job, progress=None):
+        with lock:
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        script.time.sleep(0.01)
+        with lock:
+            state['running'] -= 1
+        job['filepath'] = str(tmp_path / f"{job['track_id']}.mp3")
+        job['filename'] = f"{job['track_id']}.mp3"
+        return True
+
+    def fake_tag(file_path, track_info, lyrics_content=None, cover=None):
+        with lock:
+            state['tagged'].append(track_info.id)
+        return {'duration': 200.0, 'output': ''}
+    monkeypatch.setattr(script, 'TAG_PROCESSES', 0)
+    monkeypatch.setattr(script, 'resolve_track_url', lambda job, *args: job['track_id'] != 5)
+    monkeypatch.setattr(script, 'fetch_track_audio', fake_fetch)
+    monkeypatch.setattr(script, 'fetch_track_extras', lambda job, progress=None: True)
+    monkeypatch.setattr(script, 'tag_and_verify', fake_tag)
+    songs = [script.TrackRecord(i, f's{i}', ['a']) for i in range(12)]
+    script.run_download_pipeline(songs, 'exhigh', str(tmp_path), 3)
+    assert sorted(state['tagged']) == [i for i in range(12) if i != 5]
+    assert state['peak'] <= 3
+    state['tagged'].clear()
+    script.run_download_pipeline((s for s in songs[:4]), 'exhigh', str(tmp_path), 3, total=100)  # 流式输入
+    assert sorted(state['tagged']) == [0, 1, 2, 3]
+
+
+def test_tag_and_verify_collects_output(tmp_path, capsys):
+    from concurrent.futures import ThreadPoolExecutor
+    p = tmp_path / 'a.mp3'
+    p.write_bytes(b'')
+    info = script.TrackRecord(1, 'n', ['a'], album='al', no=1)
+    stdout = sys.stdout
+    # 线程内并发打标签（无进程池时的回退路径）不能替换进程级的 sys.stdout
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: script.tag_and_verify(str(p), info, None, {}), range(8)))
+    assert sys.stdout is stdout
+    assert capsys.readouterr().out == ''
+    for result in results:
+        assert result['duration'] is None
+        assert '已为 a.mp3 添加元数据' in result['output']
+
+
+def test_track_url_resolver_batches_and_expires(monkeypatch):
+    calls = []
+
+    def fake_audio(song_ids, level, encode_type):
+        calls.append(list(song_ids))
+        return ({'data': [{'id': i, 'url': f'http://x/{i}', 'expi': 1200} for i in song_ids if i != 7]}, None)
+    monkeypatch.setattr(script, 'get_track_audio', fake_audio)
+    resolver = script.TrackUrlResolver('exhigh', batch_size=200)
+    resolver.hint(list(range(450)))
+    for i in range(450):
+        entry, err = resolver.get(i)
+        if i == 7:
+            assert entry is None and err
+        else:
+            assert entry['url'] == f'http://x/{i}' and err is None
+    assert [len(c) for c in calls] == [200, 1, 200, 50]
+    calls.clear()
+    resolver.invalidate(3)
+    assert resolver.get(3)[0]['id'] == 3
+    assert resolver.get(4)[0]['id'] == 4
+    assert calls == [[3]]
+
+
+def test_track_url_resolver_fetches_without_holding_lock(monkeypatch):
+    import threading
+    calls = []
+    release = threading.Event()
+
+    def fake_audio(song_ids, level, encode_type):
+        calls.append(list(song_ids))
+        if 1 in song_ids:
+            release.wait(5)  # 模拟慢请求/重试等待
+        return ({'data': [{'id': i, 'url': f'http://x/{i}'} for i in song_ids]}, None)
+    monkeypatch.setattr(script, 'get_track_audio', fake_audio)
+    resolver = script.TrackUrlResolver('exhigh', batch_size=2)
+    assert resolver.get(9)[0]['id'] == 9
+    resolver.hint([1, 2, 3])
+    results = {}
+    slow = threading.Thread(target=lambda: results.setdefault(1, resolver.get(1)))
+    slow.start()
+    while not resolver.inflight:
+        script.time.sleep(0.001)
+    waiter = threading.Thread(target=lambda: results.setdefault(2, resolver.get(2)))
+    waiter.start()
+    # 慢请求进行中：已缓存的链接和其他批次的曲目不必等待
+    assert resolver.get(9)[0]['id'] == 9
+    assert resolver.get(3)[0]['id'] == 3
+    assert 2 not in results
+    release.set()
+    slow.join(5)
+    waiter.join(5)
+    assert results[1][0]['id'] == 1 and results[2][0]['id'] == 2
+    assert calls == [[9], [1, 2], [3]]  # 曲目 2 等待所在批次，不重复请求
+
+
+def test_api_cache_ttl_lru_and_eviction(tmp_path):
+    cache = script.ApiCache(str(tmp_path), ttls={'lyrics': 100, 'playlist': 0}, memory_items=2, max_bytes=10 ** 6)
+    cache.put('lyrics', 1, {'code': 200, 'x': 1})
+    cache.put('playlist', 9, {'code': 200})
+    assert cache.get('lyrics', 1) == {'code': 200, 'x': 1}
+    script.time.sleep(0.01)
+    assert cache.get('playlist', 9) is None
+    assert cache.get('playlist', 9, allow_stale=True) == {'code': 200}
+    fresh = script.ApiCache(str(tmp_path), ttls={'lyrics': 100})
+    assert fresh.get('lyrics', 1) == {'code': 200, 'x': 1}
+    small = script.ApiCache(str(tmp_path / 'small'), max_bytes=600)
+    for i in range(20):
+        small.put('track_detail', i, {'id': i, 'pad': 'x' * 50})
+    assert small._scan_size() <= 600
+    assert small.get('track_detail', 19) is not None
+
+
+def test_get_track_detail_uses_cache(monkeypatch, tmp_path):
+    cache = script.ApiCache(str(tmp_path))
+    monkeypatch.setattr(script, '_api_cache', cache)
+    calls = []
+
+    def fake_detail(ids, **kw):
+        calls.append(list(ids))
+        return {'code': 200, 'songs': [{'id': int(i), 'dt': 1000, 'al': {'id': 5, 'name': 'A', 'picUrl': 'u'}, 'privilege': {}} for i in ids]}
+    monkeypatch.setattr(script.track, 'GetTrackDetail', fake_detail)
+    res, err = script.get_track_detail([1, 2])
+    assert err is None and [s.id for s in res['songs']] == [1, 2]
+    res, err = script.get_track_detail([2, 3, 1])
+    assert [s.id for s in res['songs']] == [2, 3, 1]
+    assert calls == [[1, 2], [3]]
+    cached = cache.get('track_detail', 2)
+    assert 'privilege' not in cached and cached['al']['picUrl'] == 'u'  # 只缓存用得到的字段
+    record = res['songs'][1]
+    assert not hasattr(record, '__dict__') and (record.dt, record.album_id) == (1000, 5)
+
+
+def test_cover_cache_single_fetch_per_album(monkeypatch, tmp_path):
+    import threading
+    calls = []
+
+    def fake_download(self, url):
+        calls.append(url)
+        script.time.sleep(0.05)
+        return {'data': b'img', 'mime': 'image/jpeg', 'width': 1, 'height': 1, 'size': 3, 'url': url}
+    monkeypatch.setattr(script.CoverCache, '_download', fake_download)
+    cache = script.CoverCache(str(tmp_path))
+    info = script.TrackRecord(1, album_id=7, pic_url='http://p/7.jpg')
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(info))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == ['http://p/7.jpg']
+    assert all(r['data'] == b'img' for r in results)
+    again = script.CoverCache(str(tmp_path)).get(info)
+    assert again['width'] == 1 and calls == ['http://p/7.jpg']
+    assert cache.get(script.TrackRecord(2)) is None
+
+
+def test_http_transport_shares_adapter_and_prewarms_once(monkeypatch):
+    class FakeAdapter:
+        def __init__(self, **kw):
+            self.kw = kw
+
+    class FakeSession:
+        def __init__(self):
+            self.adapters = {}
+            self.heads = []
+
+        def mount(self, prefix, adapter):
+            self.adapters[prefix] = adapter
+
+        def get_adapter(self, url):
+            return self.adapters.get(url)
+
+        def head(self, url, **kw):
+            self.heads.append(url)
+            return types.SimpleNamespace(close=lambda: None)
+    adapters_mod = types.ModuleType('requests.adapters')
+    adapters_mod.HTTPAdapter = FakeAdapter
+    monkeypatch.setitem(sys.modules, 'requests.adapters', adapters_mod)
+    monkeypatch.setattr(script.requests, 'Session', FakeSession, raising=False)
+    transport = script.HttpTransport(4)
+    assert transport.adapter.kw['pool_maxsize'] == 4 and transport.adapter.kw['pool_block']
+    other = FakeSession()
+    transport.attach(other)
+    assert other.adapters['https://'] is transport.adapter
+    for _ in range(3):
+        transport.prewarm('https://m701.music.126.net/a/b.flac?x=1')
+    for _ in range(50):
+        if transport.session.heads:
+            break
+        script.time.sleep(0.01)
+    assert transport.session.heads == ['https://m701.music.126.net/']
+
+
+def test_fetch_track_audio_resumes_from_part_file(monkeypatch, tmp_path):
+    data = b'0123456789'
+    requests_seen = []
+
+    class FakeResponse:
+        def __init__(self, status, headers, chunks, fail=False):
+            self.status_code, self.headers, self.chunks, self.fail = status, headers, chunks, fail
+            self.text = ''
+
+        def iter_content(self, chunk_size=1024):
+            yield from self.chunks
+            if self.fail:
+                raise script.ConnectionError('reset')
+
+        def close(self):
+            pass
+
+    def fake_get(url, **kw):
+        requests_seen.append(kw.get('headers', {}).get('Range'))
+        if len(requests_seen) == 1:
+            return FakeResponse(200, {'content-length': '10'}, [data[:4]], fail=True)
+        return FakeResponse(206, {'content-length': '6', 'content-range': 'bytes 4-9/10'}, [data[4:]])
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=fake_get))
+    job = script.new_track_job(1, 'n', 'a', 'exhigh', str(tmp_path))
+    job['url'] = 'http://x/1.flac'
+    job['url_entry'] = {'id': 1, 'url': job['url'], 'type': 'flac', 'size': 10, 'md5': 'm'}
+    assert script.fetch_track_audio(job)
+    assert requests_seen == [None, 'bytes=4-']
+    with open(job['filepath'], 'rb') as f:
+        assert f.read() == data
+    assert sorted(os.listdir(tmp_path)) == ['n - a.flac']
+
+
+def test_download_segmented_rebalances_slow_segment(monkeypatch, tmp_path):
+    data = bytes(range(200))
+    ranges = []
+
+    class RangeResponse:
+        def __init__(self, start, end):
+            self.status_code, self.start, self.end = 206, start, end
+
+        def iter_content(self, chunk_size=1024):
+            for pos in range(self.start, self.end + 1, 10):
+                if self.start == 0:
+                    script.time.sleep(0.01)  # 第一段是慢连接
+                yield data[pos:min(pos + 10, self.end + 1)]
+
+        def close(self):
+            pass
+
+    def fake_get(url, **kw):
+        start, end = kw['headers']['Range'][len('bytes='):].split('-')
+        ranges.append((int(start), int(end)))
+        return RangeResponse(int(start), int(end))
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=fake_get))
+    monkeypatch.setattr(script, 'SEGMENT_MIN_SPLIT', 10)
+    path = str(tmp_path / 'big.part')
+    received = []
+    ok, error = script.download_segmented('http://x/big.flac', path, len(data), connections=2, on_progress=received.append)
+    assert ok and error is None
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert sum(received) == len(data)
+    assert len(ranges) > 2  # 快连接接手了慢分段的后半部分
+
+
+def test_sync_manifest_skips_current_and_prunes_removed(monkeypatch, tmp_path):
+    for name in ('a.flac', 'b.flac', 'b.lrc'):
+        (tmp_path / name).write_bytes(b'audio-' + name.encode())
+    manifest = script.SyncManifest(str(tmp_path))
+    manifest.record(1, 'lossless', str(tmp_path / 'a.flac'))
+    manifest.record(2, 'exhigh', str(tmp_path / 'b.flac'))
+    assert manifest.is_current(1, 'exhigh') and manifest.is_current(1, 'lossless')
+    assert not manifest.is_current(1, 'hires')  # 要求更高音质时重新下载
+    assert not manifest.is_current(3, 'exhigh')
+    assert not os.path.exists(manifest.path)  # 记录攒批写入
+    manifest.flush()
+    os.utime(tmp_path / 'a.flac', (1, 1))
+    reloaded = script.SyncManifest(str(tmp_path))
+    assert reloaded.is_current(1, 'lossless')  # 仅 mtime 变化，校验值一致
+    reloaded.flush()
+    with monkeypatch.context() as m:
+        m.setattr(script, 'file_checksum', lambda path: pytest.fail('修改时间已保存，不应重算校验值'))
+        assert script.SyncManifest(str(tmp_path)).is_current(1, 'lossless')
+    (tmp_path / 'a.flac').write_bytes(b'changed')
+    assert not manifest.is_current(1, 'lossless')
+
+    monkeypatch.setattr(script, 'terminal_width', 80, raising=False)
+    monkeypatch.setattr(script, '_manifests', {os.path.abspath(str(tmp_path)): manifest})
+    ids = [1, 2, 3]
+    monkeypatch.setattr(script, 'get_playlist_meta', lambda pid: ({'count': len(ids), 'snapshot': {}, 'track_ids': list(ids)}, None))
+    monkeypatch.setattr(script, 'get_track_detail', lambda page: ({'songs': [script.TrackRecord(i, f's{i}', ['x']) for i in page]}, None))
+    queued = []
+    monkeypatch.setattr(script, 'run_download_pipeline', lambda songs, *a, **kw: queued.extend(s.id for s in songs))
+    script.get_playlist_tracks_and_save_info(9, 'exhigh', str(tmp_path), sync=True)
+    assert queued == [1, 3]
+    ids[:] = [1]
+    queued.clear()
+    script.get_playlist_tracks_and_save_info(9, 'exhigh', str(tmp_path), sync=True, prune=True)
+    assert queued == [1]
+    assert not (tmp_path / 'b.flac').exists() and not (tmp_path / 'b.lrc').exists()
+    assert '2' not in script.SyncManifest(str(tmp_path)).tracks
+
+
+def test_library_index_lookup_and_dedupe(tmp_path):
+    lib_dir, dl_dir = tmp_path / 'a', tmp_path / 'b'
+    lib_dir.mkdir()
+    (lib_dir / 'old - x.flac').write_bytes(b'lossless-audio')
+    index = script.get_library_index()
+    index.record(7, str(lib_dir / 'old - x.flac'), 'lossless', tagged=True, lyric_version=3, cover_id='9_ab')
+    index.set_playlist(100, [7, 8])
+    index.set_playlist(200, [7])
+    assert index.find(7, 'exhigh')['md5'] == script.file_checksum(str(lib_dir / 'old - x.flac'))
+    assert index.find(7, 'hires') is None
+    assert index.playlists_of(7) == [100, 200]
+    job = script.new_track_job(7, 'new', 'x', 'exhigh', str(dl_dir))
+    offline = types.SimpleNamespace(get=lambda tid: pytest.fail('不应解析链接'))
+    assert script.resolve_track_url(job, resolver=offline)  # 不发起网络请求，直接复制
+    assert job['local'] == 'library' and job['local_level'] == 'lossless'
+    assert script.fetch_track_audio(job)
+    with open(job['filepath'], 'rb') as f:
+        assert f.read() == b'lossless-audio'
+    assert job['filename'] == 'new - x.flac'
+    os.remove(lib_dir / 'old - x.flac')
+    assert index.audit() == [str(lib_dir / 'old - x.flac')]
+    assert index.find(7) is None and index.audit() == []
+
+
+def test_audio_store_links_views_and_rebuilds_offline(monkeypatch, tmp_path):
+    monkeypatch.setattr(script, 'AUDIO_STORE_DIR', str(tmp_path / 'store'))
+    first, second = tmp_path / 'p1', tmp_path / 'p2'
+    first.mkdir()
+    (first / 'song - x.flac').write_bytes(b'flac-data')
+    (first / 'song - x.lrc').write_text('[00:01.00]hi', encoding='utf-8')
+    store = script.get_audio_store()
+    store_path = store.adopt(5, 'lossless', str(first / 'song - x.flac'))
+    assert os.path.samefile(store_path, first / 'song - x.flac')
+    assert os.path.samefile(tmp_path / 'store' / '5' / 'lyrics.lrc', first / 'song - x.lrc')
+    # 另一个歌单中的同一首歌直接链接，不再下载
+    job = script.new_track_job(5, 'song', 'x', 'exhigh', str(second))
+    offline = types.SimpleNamespace(get=lambda tid: pytest.fail('不应解析链接'))
+    assert script.resolve_track_url(job, resolver=offline)
+    assert os.path.samefile(job['filepath'], store_path)
+    script.finish_track_job(job, {'duration': 200.0, 'output': '', 'tagged': True})
+    assert sorted(os.listdir(tmp_path / 'store' / '5')) == ['lossless.flac', 'lossless.json', 'lyrics.lrc']
+    assert store.find(5, 'hires') is None
+    # 删除歌单目录后可离线重建
+    (second / '!#_playlist_42_info.txt').write_text('5 - song - x\n6 - other - y\n', encoding='utf-8')
+    os.remove(job['filepath'])
+    assert script.rebuild_playlist_view(42, str(second)) == (1, [6])
+    assert os.path.samefile(second / 'song - x.flac', store_path)
+    assert (second / 'song - x.lrc').read_text(encoding='utf-8') == '[00:01.00]hi'
+
+
+def test_progress_renderer_dashboard_rows(monkeypatch, capsys):
+    calls = []
+    monkeypatch.setattr(script, 'get_terminal_size', lambda: calls.append(1) or (60, 20))
+    monkeypatch.setattr(script, '_term_size_cache', {'size': None, 'time': 0.0, 'sigwinch': False})
+    renderer = script.ProgressRenderer(3)
+    assert renderer.thread is None  # 非终端输出时不启动渲染线程
+    renderer.start(1, '第一首歌.flac', 1000)
+    renderer.start(2, 'second.mp3', 0, done=10)
+    for _ in range(50):
+        renderer.update(1, 10)  # 只累加计数，不输出
+    assert capsys.readouterr().out == ''
+    renderer.render()
+    renderer.render()
+    out = capsys.readouterr().out
+    plain = script.re.sub('\x1b\\[[0-9;]*[A-Za-z]', '', out)
+    assert '下载中 2 首' in plain and '第一首歌.flac' in plain and ' 50.0%' in plain and '??MB' in plain
+    assert out.endswith('\x1b[2A\r')  # 三行面板，光标回到首行
+    assert len(calls) == 1  # 终端宽度被缓存
+    script._on_sigwinch(None, None)
+    renderer.finish(1, 'done')
+    renderer.render()
+    assert len(calls) == 2
+    assert 'done' in capsys.readouterr().out
+
+
+def test_receive_into_uses_readinto_and_bounded_writer(tmp_path):
+    import io
+    data = os.urandom(300 * 1024)
+    requested = []
+
+    class FakeRaw(io.BytesIO):
+        def readinto(self, b):
+            requested.append(len(b))
+            script.time.sleep(0.001)
+            return super().readinto(b)
+
+    class SlowFile(io.BytesIO):
+        def write(self, b):
+            script.time.sleep(0.002)  # 慢速存储
+            return super().write(b)
+    response = types.SimpleNamespace(raw=FakeRaw(data), headers={})
+    out = SlowFile()
+    writer = script.DiskWriter(out, buffers=2)
+    received = sum(n for n, _ in script.receive_into(response, writer))
+    writer.close()
+    assert received == len(data) and writer.written == len(data)
+    assert out.getvalue() == data
+    assert writer.free.qsize() == 2  # 缓冲区全部归还，没有额外分配
+    assert requested[0] == script.RECV_MIN_CHUNK and max(requested) > script.RECV_MIN_CHUNK
+
+
+def test_bandwidth_limiter_schedule_override_and_fairness(monkeypatch, tmp_path):
+    control = tmp_path / 'bandwidth.txt'
+    limiter = script.BandwidthLimiter(rate='1M', schedule=[('23:00', '07:00', 0), ('09:00', '18:00', '256K')], control_file=str(control))
+    assert limiter.current_rate(clock='02:30') == 0  # 跨午夜的不限速时段
+    assert limiter.current_rate(clock='10:00') == 256 * 1024
+    assert limiter.current_rate(clock='20:00') == 1024 * 1024
+    control.write_text('2M', encoding='utf-8')
+    assert limiter.current_rate(now=10**9, clock='20:00') == 2 * 1024 * 1024
+    limiter.set_rate('4M')
+    assert limiter.current_rate(clock='02:30') == 4 * 1024 * 1024
+    limiter.set_rate(0)
+    assert limiter.consume(10 ** 9, 'a') == 0.0
+
+    slept = []
+    monkeypatch.setattr(script.time, 'sleep', slept.append)
+    limiter = script.BandwidthLimiter(rate=1000 * 1024, control_file='')
+    limiter.bucket['tokens'] = 0.0
+    waited = limiter.consume(script.RECV_MAX_CHUNK, 'a')
+    assert abs(waited - script.RECV_MAX_CHUNK / (1000 * 1024)) < 0.01
+    assert max(slept) <= 0.25  # 分段休眠，可及时响应取消与调速
+    # 第二个传输加入后，每个传输只能得到一半带宽
+    limiter.consume(1, 'b')
+    limiter.transfers['a'] = {'tokens': 0.0, 'updated': script.time.monotonic()}
+    limiter.bucket['tokens'] = 10 ** 9
+    waited = limiter.consume(100 * 1024, 'a')
+    assert abs(waited - 100 * 1024 / (500 * 1024)) < 0.02
+
+
+def test_concurrency_controller_aimd(monkeypatch, tmp_path):
+    monkeypatch.setattr(script, 'CONCURRENCY_LOG', str(tmp_path / 'concurrency.log'))
+    total = {'bytes': 0}
+    logged = []
+    controller = script.ConcurrencyController(4, 8, bytes_source=lambda: total['bytes'], log=logged.append)
+    start = controller.window_start
+    # 限流码：接口并发减半
+    controller.record_api(-460)
+    controller.maybe_adjust(start + 5)
+    assert controller.api.limit == 2 and logged
+    # 空链接比例过高同样视为限流
+    controller.record_urls(20, 15)
+    controller.maybe_adjust(start + 10)
+    assert controller.api.limit == 1
+    # 下载并发已用满且吞吐量提升：加一
+    with controller.downloads:
+        pass
+    controller.downloads.peak = controller.downloads.limit
+    total['bytes'] = 50 * 1024 * 1024
+    controller.maybe_adjust(start + 15)
+    assert controller.downloads.limit == 5
+    # 加一后吞吐量下降：撤回
+    total['bytes'] += 10 * 1024 * 1024
+    controller.maybe_adjust(start + 20)
+    assert controller.downloads.limit == 4
+    # 下载返回 429：减半
+    controller.record_download(False, 429)
+    controller.maybe_adjust(start + 25)
+    assert controller.downloads.limit == 2
+    assert len((tmp_path / 'concurrency.log').read_text(encoding='utf-8').splitlines()) == 5
+
+
+def test_resizable_limiter_blocks_and_resizes():
+    import threading
+    limiter = script.ResizableLimiter(1, 1, 4)
+    entered = threading.Event()
+
+    def worker():
+        with limiter:
+            entered.set()
+    with limiter:
+        t = threading.Thread(target=worker)
+        t.start()
+        assert not entered.wait(0.05)  # 超出上限时排队
+        limiter.resize(2)
+        assert entered.wait(1)
+    t.join()
+    assert limiter.contended == 1 and limiter.peak == 2
+    assert limiter.resize(10) == 4
+
+
+def test_classify_trial_from_url_entry():
+    full = script.TrackRecord.from_song({'id': 1, 'name': 'n', 'ar': [], 'al': {}, 'dt': 240000})
+    short = script.TrackRecord.from_song({'id': 1, 'name': 'n', 'ar': [], 'al': {}, 'dt': 20000})
+    assert script.classify_trial({'freeTrialInfo': {'start': 30, 'end': 60}}, full) == '仅提供试听片段(30-60s)'
+    assert '30.0s' in script.classify_trial({'time': 30000, 'size': 9600000, 'br': 320000}, full)
+    assert '24.0s' in script.classify_trial({'size': 960000, 'br': 320000})
+    assert script.classify_trial({'time': 240000, 'size': 9600000, 'br': 320000}, full) is None
+    # 曲目本身就很短时不算试听
+    assert script.classify_trial({'time': 20000, 'size': 800000, 'br': 320000}, short) is None
+
+
+def _flac_head(seconds, rate=44100):
+    samples = seconds * rate
+    info = bytearray(34)
+    info[10:13] = bytes([rate >> 12 & 0xFF, rate >> 4 & 0xFF, (rate & 0x0F) << 4 | 0x02])
+    info[13] = 0xF0 | samples >> 32 & 0x0F
+    info[14:18] = (samples & 0xFFFFFFFF).to_bytes(4, 'big')
+    return b'fLaC' + bytes([0x80, 0, 0, 34]) + bytes(info)
+
+
+def test_estimate_stream_duration_reads_flac_and_mp3_headers():
+    assert script.estimate_stream_duration(_flac_head(30)) == 30
+    # MPEG1 Layer III 128kbps 44.1kHz 立体声，带 Xing 帧数
+    frame = bytearray(b'\xff\xfb\x90\x00' + bytes(32) + b'Xing' + b'\x00\x00\x00\x01' + (1000).to_bytes(4, 'big'))
+    tag = b'ID3\x04\x00\x00' + script._syncsafe(20) + bytes(20)
+    assert abs(script.estimate_stream_duration(tag + bytes(frame)) - 1000 * 1152 / 44100) < 1e-6
+    plain = b'\xff\xfb\x90\x00' + bytes(60)
+    assert script.estimate_stream_duration(plain, 128000 // 8 * 20) == 20
+    assert script.estimate_stream_duration(b'\x00' * 64) is None
+
+
+def test_fetch_track_audio_aborts_on_trial_stream_header(monkeypatch, tmp_path):
+    import io
+    data = _flac_head(30) + os.urandom(64 * 1024)
+    failed = []
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=lambda url, **kw: types.SimpleNamespace(
+        status_code=200, headers={'content-length': str(len(data))}, raw=io.BytesIO(data), close=lambda: None)))
+    monkeypatch.setattr(script, 'write_to_failed_list', lambda *a: failed.append(a))
+    job = script.new_track_job(3, 'r', 'a', 'lossless', str(tmp_path))
+    job['url'] = 'http://x/3.flac'
+    job['url_entry'] = {'id': 3, 'url': job['url'], 'type': 'flac', 'size': len(data)}
+    assert script.fetch_track_audio(job) is False
+    assert '30.0s' in failed[0][3]
+    assert not os.listdir(tmp_path)
+
+
+def test_fetch_track_audio_resumes_after_raw_stream_error(monkeypatch, tmp_path):
+    import io
+    data = os.urandom(64 * 1024)
+    ranges = []
+
+    class BrokenRaw(io.BytesIO):
+        def readinto(self, b):
+            if self.tell() >= 20 * 1024:
+                raise OSError('connection reset')  # urllib3 的 ProtocolError 等同样被转换
+            return super().readinto(memoryview(b)[:4 * 1024])
+
+    def fake_get(url, **kw):
+        rng = kw.get('headers', {}).get('Range')
+        ranges.append(rng)
+        if rng is None:
+            return types.SimpleNamespace(status_code=200, headers={'content-length': str(len(data))}, raw=BrokenRaw(data), close=lambda: None)
+        offset = int(rng[len('bytes='):-1])
+        rest = data[offset:]
+        return types.SimpleNamespace(status_code=206, headers={'content-length': str(len(rest)), 'content-range': f'bytes {offset}-{len(data) - 1}/{len(data)}'}, raw=io.BytesIO(rest), close=lambda: None)
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=fake_get))
+    job = script.new_track_job(2, 'r', 'a', 'exhigh', str(tmp_path))
+    job['url'] = 'http://x/2.flac'
+    job['url_entry'] = {'id': 2, 'url': job['url'], 'type': 'flac', 'size': len(data)}
+    assert script.fetch_track_audio(job)
+    assert ranges == [None, f'bytes={20 * 1024}-']
+    with open(job['filepath'], 'rb') as f:
+        assert f.read() == data
+
+
+def test_fetch_track_audio_closes_response_on_cancel_and_http_error(monkeypatch, tmp_path):
+    import io
+    data = os.urandom(256 * 1024)
+    closed = []
+
+    class CancellingRaw(io.BytesIO):
+        def readinto(self, b):
+            script.DOWNLOAD_CANCEL.set()
+            return super().readinto(memoryview(b)[:4096])
+
+    def fake_get(url, **kw):
+        status = 500 if url.endswith('500') else 200
+        return types.SimpleNamespace(status_code=status, text='err', headers={'content-length': str(len(data))},
+                                     raw=CancellingRaw(data), close=lambda: closed.append(url))
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=fake_get))
+    job = script.new_track_job(4, 'r', 'a', 'exhigh', str(tmp_path))
+    job['url'] = 'http://x/4.mp3'
+    job['url_entry'] = {'id': 4, 'url': job['url'], 'type': 'mp3', 'size': len(data)}
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            script.fetch_track_audio(job)
+    finally:
+        script.DOWNLOAD_CANCEL.clear()
+    assert closed == ['http://x/4.mp3']
+    job = script.new_track_job(5, 'r', 'b', 'exhigh', str(tmp_path))
+    job['url'] = 'http://x/500'
+    job['url_entry'] = {'id': 5, 'url': job['url'], 'type': 'mp3', 'size': len(data)}
+    assert script.fetch_track_audio(job) is False
+    assert closed[-1] == 'http://x/500'
+
+
+def test_tag_task_is_importable_when_run_as_main(monkeypatch):
+    import pickle
+    monkeypatch.setattr(script, '__name__', '__main__')
+    task = script._tag_task()
+    assert task.__module__ == 'script'
+    assert pickle.loads(pickle.dumps(task)) is script.tag_and_verify
+
+
+def test_track_record_is_picklable_when_run_as_main():
+    import importlib.util
+    import pickle
+    # 模拟 ncmdl 入口：模块以 __main__ 运行，类所在模块无法按名称导入
+    spec = importlib.util.spec_from_file_location('ncmdl_main', script.__file__)
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+    main.__name__ = '__main__'
+    record = main.TrackRecord(7, 'n', ('a', 'b'), 3, 'al', 'http://p', 2, 1000, 5)
+    with pytest.raises(Exception):
+        pickle.dumps(main.TrackRecord)
+    restored = pickle.loads(pickle.dumps(record))
+    assert type(restored) is script.TrackRecord
+    assert restored.to_song() == record.to_song()
+
+
+def test_segmented_download_keeps_progress_on_cancel_and_resumes(monkeypatch, tmp_path):
+    data = bytes(range(200))
+    ranges = []
+    cancel_after = [60]
+
+    class RangeResponse:
+        def __init__(self, start, end):
+            self.status_code, self.start, self.end = 206, start, end
+
+        def iter_content(self, chunk_size=1024):
+            for pos in range(self.start, self.end + 1, 10):
+                if cancel_after[0] is not None:
+                    if cancel_after[0] <= 0:
+                        script.DOWNLOAD_CANCEL.set()
+                    cancel_after[0] -= 10
+                yield data[pos:min(pos + 10, self.end + 1)]
+
+        def close(self):
+            pass
+
+    def fake_get(url, **kw):
+        start, end = kw['headers']['Range'][len('bytes='):].split('-')
+        ranges.append((int(start), int(end)))
+        return RangeResponse(int(start), int(end))
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=fake_get))
+    monkeypatch.setattr(script, 'SEGMENTED_MIN_SIZE', 100)
+    monkeypatch.setattr(script, 'SEGMENT_CONNECTIONS', 2)
+    monkeypatch.setattr(script, 'SEGMENT_MIN_SPLIT', 1000)
+    job = script.new_track_job(1, 'n', 'a', 'exhigh', str(tmp_path))
+    job['url'] = 'http://x/1.flac'
+    job['url_entry'] = {'id': 1, 'url': job['url'], 'type': 'flac', 'size': len(data), 'md5': 'm'}
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            script.fetch_track_audio(dict(job))
+    finally:
+        script.DOWNLOAD_CANCEL.clear()
+    part = tmp_path / 'n - a.flac.1.part'
+    with open(str(part) + '.json', encoding='utf-8') as f:
+        state = json.load(f)
+    left = sum(e - s for s, e in state['segments'])
+    assert 0 < left < len(data) and state['received'] == len(data) - left
+    ranges.clear()
+    cancel_after[0] = None
+    assert script.fetch_track_audio(job)
+    with open(job['filepath'], 'rb') as f:
+        assert f.read() == data
+    assert sum(e + 1 - s for s, e in ranges) == left
+    assert sorted(os.listdir(tmp_path)) == ['n - a.flac']
+
+
+def test_get_track_lyrics_sends_cached_versions_and_merges(monkeypatch, tmp_path):
+    cache = script.ApiCache(str(tmp_path), ttls={'lyrics': 0})
+    monkeypatch.setattr(script, '_api_cache', cache)
+    calls = []
+
+    def fake_lyrics(tid, **kw):
+        calls.append({k: v for k, v in kw.items() if k in ('lv', 'tv')})
+        if not calls[-1]:
+            return {'code': 200, 'lrc': {'version': 3, 'lyric': '[00:01.00]a'}, 'tlyric': {'version': 1, 'lyric': '[00:01.00]x'}}
+        return {'code': 200, 'lrc': {'version': 3}, 'tlyric': {'version': 2, 'lyric': '[00:01.00]y'}}
+    monkeypatch.setattr(script.track, 'GetTrackLyrics', fake_lyrics)
+    first, err = script.get_track_lyrics(7)
+    script.time.sleep(0.01)
+    second, err = script.get_track_lyrics(7)
+    assert calls == [{}, {'lv': 3, 'tv': 1}]
+    assert second['lrc'] == first['lrc']
+    assert second['tlyric'] == {'version': 2, 'lyric': '[00:01.00]y'}
+    assert cache.get('lyrics', 7, allow_stale=True)['tlyric']['version'] == 2
+
+
+def test_playlist_preview_meta_and_snapshot_reuse_tracks(monkeypatch, tmp_path):
+    cache = script.ApiCache(str(tmp_path), ttls={'playlist': 0, 'track_detail': 0})
+    monkeypatch.setattr(script, '_api_cache', cache)
+    state = {'ids': [1, 2], 'meta': 0, 'detail': 0}
+
+    def fake_info(pid, **kw):
+        state['meta'] += 1
+        return {'code': 200, 'playlist': {'name': 'p', 'trackCount': len(state['ids']), 'updateTime': 5,
+                                          'trackIds': [{'id': i} for i in state['ids']], 'tracks': [{'name': 's1'}]}}
+
+    def fake_detail(ids):
+        state['detail'] += 1
+        return {'code': 200, 'songs': [{'id': i, 'name': f's{i}'} for i in ids]}
+    monkeypatch.setattr(script, 'playlist', types.SimpleNamespace(GetPlaylistInfo=fake_info))
+    monkeypatch.setattr(script.track, 'GetTrackDetail', fake_detail)
+    monkeypatch.setattr(script, 'run_download_pipeline', lambda songs, *a, **kw: [s.id for s in songs] and None)
+    meta, err = script.get_playlist_meta(9)
+    assert (meta['count'], meta['first']) == (2, 's1')
+    script.download_batch(['9'], [], 'exhigh', str(tmp_path))
+    assert (state['meta'], state['detail']) == (1, 1)  # 下载复用预览取到的元数据
+    monkeypatch.setattr(script, '_playlist_meta', {})
+    assert [s.id for s in script.iter_playlist_tracks(script.get_playlist_meta(9)[0])] == [1, 2]
+    assert (state['meta'], state['detail']) == (2, 1)  # 缓存已过期，但快照未变仍复用
+    state['ids'].append(3)
+    assert [s.id for s in script.iter_playlist_tracks(script.get_playlist_meta(9)[0])] == [1, 2, 3]
+    assert state['detail'] == 2
+
+
+def test_stage_messages_go_through_progress_log(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(script, 'get_track_lyrics', lambda tid: (None, '超时'))
+    logged = []
+    board = types.SimpleNamespace(log=logged.append)
+    job = script.new_track_job(3, 'n', 'a', 'exhigh', str(tmp_path))
+    resolver = types.SimpleNamespace(get=lambda tid: (None, '超时'))
+    assert not script.resolve_track_url(job, board, resolver)
+    assert script.process_lyrics(3, 'n', 'a', 'lrc', str(tmp_path), progress=board) == (False, None)
+    assert len(logged) == 2 and '超时' in logged[0] and '无法获取歌词' in logged[1]
+    assert capsys.readouterr().out == ''
+
+
+def test_retry_engine_backoff_budget_and_circuit(monkeypatch):
+    monkeypatch.setattr(script, 'RETRY_BASE_DELAY', 0.001)
+    monkeypatch.setattr(script, 'CIRCUIT_THRESHOLD', 3)
+    monkeypatch.setattr(script, 'CIRCUIT_COOLDOWN', 0.05)
+    logged = []
+    engine = script.reset_retry_engine(logged.append)
+    calls = []
+
+    @script.retry_with_timeout(timeout=7, retry_times=3, operation_name='测试')
+    def flaky(codes):
+        calls.append(script._worker_local.timeout)
+        return {'code': codes.pop(0)}
+    assert flaky([-447, 200]) == ({'code': 200}, None)
+    assert calls == [7, 7] and script._worker_local.timeout is None
+    result, error = flaky([404])  # 非限流的返回码不重试，交给调用方
+    assert result == {'code': 404} and error is None
+    result, error = flaky([503, 503, 503, 503])
+    assert result is None and error.code == 503
+    assert engine.open_until > script.time.monotonic()  # 连续被拒绝后熔断
+    start = script.time.monotonic()
+    assert flaky([200]) == ({'code': 200}, None)
+    assert script.time.monotonic() - start >= 0.03  # 等待冷却结束才发出请求
+    engine.budget = 0
+    assert flaky([429, 200])[0] is None  # 预算用完后不再重试
+    assert any('重试次数已用完' in line for line in logged)
+    for attempt in range(1, 8):
+        assert script.RETRY_BASE_DELAY * 2 ** (attempt - 1) / 2 <= engine.backoff(attempt) <= script.RETRY_MAX_DELAY
+    script.reset_retry_engine()
+
+
+def test_download_batch_dedupes_shared_tracks(monkeypatch, tmp_path):
+    lists = {'1': [1, 2, 3], '2': [3, 4]}
+    song = lambda i: script.TrackRecord(i, f's{i}', ['x'])
+    monkeypatch.setattr(script, 'terminal_width', 80)
+    monkeypatch.setattr(script, 'get_playlist_meta', lambda pid: ({'count': len(lists[pid]), 'snapshot': {}, 'track_ids': lists[pid]}, None) if pid in lists else (None, '不存在'))
+    monkeypatch.setattr(script, 'get_track_detail', lambda ids: ({'songs': [song(int(i)) for i in ids if str(i) != '9']}, None))
+    queued = []
+
+    def fake_pipeline(songs, level, download_path, workers, total=None):
+        assert total == 8  # 按元数据预估
+        queued.extend(s.id for s in songs)
+        script.write_to_failed_list(4, 's4', 'x', '测试', download_path)
+    monkeypatch.setattr(script, 'run_download_pipeline', fake_pipeline)
+    stats = script.download_batch(['1', '2', '1', '7'], ['2', '5', '9'], 'exhigh', str(tmp_path))
+    assert queued == [1, 2, 3, 4, 5]
+    assert stats['tracks'] == 5 and stats['failed'] == 1 and stats['downloaded'] == 4
+    assert len(stats['errors']) == 2  # 歌单 7 与曲目 9
+    assert script.get_sync_manifest(str(tmp_path)).tracks == {}
+    assert script.read_failed_list(str(tmp_path)) == ['4']
+    assert (tmp_path / '!#_playlist_2_info.txt').read_text(encoding='utf-8') == '3 - s3 - x\n4 - s4 - x\n'
+
+
+def test_playlist_tracks_stream_in_pages(monkeypatch):
+    pages = []
+
+    def fake_detail(page):
+        pages.append(list(page))
+        if page[0] == 5:
+            return None, '超时'
+        return {'songs': [script.TrackRecord(i) for i in page if i != 2]}, None
+    monkeypatch.setattr(script, 'get_track_detail', fake_detail)
+    errors = []
+    stream = script.iter_playlist_tracks({'track_ids': [1, 2, 3, 4, 5, 6, 7]}, errors, page_size=2)
+    assert next(stream).id == 1 and pages == [[1, 2]]  # 第一页到达即可开始下载
+    assert [s.id for s in stream] == [3, 4, 7]
+    assert pages == [[1, 2], [3, 4], [5, 6], [7]]
+    assert errors == [(2, '获取曲目信息失败'), (5, '超时'), (6, '超时')]
+
+
+def test_headless_cli_parses_targets_and_exit_codes(monkeypatch, tmp_path):
+    from ncm_playlist_downloader import cli
+    job = tmp_path / 'jobs.txt'
+    job.write_text('# 每周同步\nhttps://music.163.com/#/playlist?id=111  # 注释\ntrack:222, 333\n', encoding='utf-8')
+    calls = []
+    monkeypatch.setattr(script, 'load_session_from_file', lambda path: object())
+    monkeypatch.setattr(script, 'download_batch', lambda *a, **kw: calls.append((a, kw)) or {'tracks': 3, 'downloaded': 2, 'skipped': 0, 'failed': 1, 'errors': []})
+    code = cli.main(['sync', '-f', str(job), '444', 'https://music.163.com/song?id=555', '-o', str(tmp_path / 'out'), '--prune'])
+    assert code == cli.EXIT_PARTIAL
+    (playlists, tracks, level, path, workers), kw = calls[0]
+    assert playlists == ['444', '111', '333'] and tracks == ['555', '222']
+    assert kw == {'sync': True, 'prune': True} and path == str(tmp_path / 'out')
+    with pytest.raises(SystemExit) as exc:
+        cli.main(['download', 'not-an-id'])
+    assert exc.value.code == cli.EXIT_USAGE
+    monkeypatch.setattr(script, 'load_session_from_file', lambda path: None)
+    assert cli.main(['download', '444']) == cli.EXIT_AUTH
+
+
+def test_import_skips_heavy_modules_and_starts_fast():
+    import subprocess
+    import textwrap
+    code = textwrap.dedent('''
+        import sys, time, types, importlib.abc
+        class Block(importlib.abc.MetaPathFinder):
+            def find_spec(self, name, path, target=None):
+                if name.split('.')[0] in ('qrcode', 'PIL', 'mutagen', 'selenium'):
+                    raise ImportError('启动时不应导入 ' + name)
+        sys.meta_path.insert(0, Block())
+        for name in ('pyncm', 'pyncm.apis', 'requests', 'requests.exceptions', 'requests.adapters'):
+            sys.modules[name] = types.ModuleType(name)
+        sys.modules['pyncm.apis'].playlist = sys.modules['pyncm.apis'].track = sys.modules['pyncm.apis'].login = None
+        for cls in ('Timeout', 'ConnectionError', 'RequestException'):
+            setattr(sys.modules['requests.exceptions'], cls, type(cls, (Exception,), {}))
+        start = time.perf_counter()
+        import script
+        print(time.perf_counter() - start)
+    ''')
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=repo_root, capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    assert float(out.stdout.strip().splitlines()[-1]) < 0.5
+
+
+def test_login_status_cached_next_to_session_file(monkeypatch, tmp_path):
+    session_file = tmp_path / 'session.json'
+    session_file.write_text('{}', encoding='utf-8')
+    monkeypatch.setattr(script, 'SESSION_FILE', str(session_file))
+    calls = []
+    monkeypatch.setattr(script.login, 'GetCurrentLoginStatus', lambda: calls.append(1) or {'code': 200, 'profile': {'nickname': 'n'}}, raising=False)
+    assert script.get_current_nickname() == 'n'
+    assert script.get_current_nickname() == 'n'
+    assert calls == [1] and (tmp_path / 'session.status.json').exists()
+    os.utime(session_file, (1, 1))  # 重新登录后会话文件改变，缓存失效
+    script.get_login_status()
+    monkeypatch.setattr(script, 'LOGIN_STATUS_TTL', 0)
+    script.get_login_status()
+    assert calls == [1, 1, 1]
+
+
+def test_cover_header_and_single_open_tagging(monkeypatch, tmp_path):
+    import struct
+    png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', 640, 480) + b'\x08\x02\x00\x00\x00'
+    jpeg = (b'\xff\xd8\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9
+            + b'\xff\xff\xc0' + struct.pack('>HBHH', 17, 8, 300, 500) + b'\x00' * 12)
+    assert script.read_image_header(png) == ('image/png', 640, 480)
+    assert script.read_image_header(jpeg) == ('image/jpeg', 500, 300)
+    assert script.read_image_header(b'????') is None
+    assert script.read_image_header(b'RIFF\x00\x00\x00\x00WEBPVP8 ') is None
+    assert script.read_image_header(jpeg[:20]) is None  # 截断/损坏的 JPEG
+    monkeypatch.setitem(sys.modules, 'PIL', None)  # 读取封面尺寸不应导入 PIL
+    response = types.SimpleNamespace(status_code=200, content=jpeg)
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a: types.SimpleNamespace(get=lambda url, **kw: response))
+    cover = script.CoverCache(str(tmp_path / 'covers'))._download('http://p/1.jpg')
+    assert (cover['width'], cover['height'], cover['mime']) == (500, 300, 'image/jpeg')
+    response.content = b'RIFF\x00\x00\x00\x00WEBPVP8 '
+    assert script.CoverCache(str(tmp_path / 'covers'))._download('http://p/2.webp') is None
+
+    handles = []
+
+    class FakeAudio:
+        info = types.SimpleNamespace(length=200.0)
+        tags = None
+
+        def add_tags(self):
+            self.tags = SavingTags()
+
+    class SavingTags(dict):
+        def save(self, target, padding=None):
+            handles.append(target)
+            target.seek(0, 2)
+            target.write(b'TAG')
+
+    def fake_file(f):
+        handles.append(f)
+        return FakeAudio()
+    monkeypatch.setattr(sys.modules['mutagen'], 'File', fake_file)
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(b'audio')
+    result = script.tag_and_verify(str(path), script.TrackRecord(1, 'n', ['a']), None, {})
+    assert result['duration'] == 200.0 and result['tagged']
+    assert len(handles) == 2 and handles[0] is handles[1]  # 读取时长与写入标签共用一个句柄
+    assert path.read_bytes() == b'audioTAG' and result['md5'] == script.file_checksum(str(path))
+
+
+def test_tag_space_layout_and_shifted_writes(tmp_path):
+    def write_through(layout, data, pieces):
+        path = tmp_path / 'out'
+        with open(path, 'wb') as raw:
+            f = script.TagSpaceFile(raw, layout)
+            f.seek(0)
+            for start in range(0, len(data), pieces):
+                f.write(data[start:start + pieces])
+        return path.read_bytes()
+
+    streaminfo = b'\x00\x00\x00\x22' + b'S' * 34
+    comment = b'\x84\x00\x00\x03abc'
+    flac = b'fLaC' + streaminfo + comment + b'AUDIO' * 20
+    layout = script.plan_tag_space('flac', lambda s, e: flac[s:e], padding=64)
+    assert layout['at'] == 4 + len(streaminfo) + len(comment)
+    out = write_through(layout, flac, 7)
+    expected = b'fLaC' + streaminfo + b'\x04\x00\x00\x03abc' + b'\x81\x00\x00\x3c' + b'\x00' * 60 + b'AUDIO' * 20
+    assert out == expected
+
+    id3 = b'ID3\x04\x00\x00\x00\x00\x01\x00' + b'F' * 128 + b'\xff\xfb' + b'M' * 50
+    layout = script.plan_tag_space('mp3', lambda s, e: id3[s:e], padding=200)
+    assert layout['at'] == 138
+    out = write_through(layout, id3, 9)
+    assert out == b'ID3\x04\x00\x00\x00\x00\x02\x48' + b'F' * 128 + b'\x00' * 200 + b'\xff\xfb' + b'M' * 50
+    bare = b'\xff\xfb' + b'M' * 30
+    out = write_through(script.plan_tag_space('mp3', lambda s, e: bare[s:e], padding=100), bare, 4)
+    assert out == b'ID3\x04\x00\x00\x00\x00\x00\x5a' + b'\x00' * 90 + bare
+    assert script.plan_tag_space('mp3', lambda s, e: b'RIFF'[s:e], padding=100) is None
+
+
+def test_fetch_track_audio_reserves_tag_space_and_resumes_by_remote_offset(monkeypatch, tmp_path):
+    flac = b'fLaC' + b'\x80\x00\x00\x22' + b'S' * 34 + bytes(range(200))
+    ranges = []
+
+    class FakeResponse:
+        def __init__(self, start, end, fail_after=None):
+            self.status_code = 206
+            self.body = flac[start:end]
+            self.content = self.body
+            self.headers = {'content-length': str(len(self.body)), 'content-range': f'bytes {start}-{end - 1}/{len(flac)}'}
+            self.fail_after, self.text = fail_after, ''
+
+        def iter_content(self, chunk_size=1024):
+            for i in range(0, len(self.body), 16):
+                if self.fail_after is not None and i >= self.fail_after:
+                    raise script.ConnectionError('reset')
+                yield self.body[i:i + 16]
+
+        def close(self):
+            pass
+
+    def fake_get(url, **kw):
+        spec = kw.get('headers', {}).get('Range', 'bytes=0-')[6:]
+        start, _, end = spec.partition('-')
+        ranges.append(spec)
+        start, end = int(start), int(end) + 1 if end else len(flac)
+        return FakeResponse(start, end, fail_after=64 if len(ranges) == 2 else None)
+    monkeypatch.setattr(script, 'get_http_transport', lambda *a, **k: types.SimpleNamespace(get=fake_get))
+    monkeypatch.setattr(script, 'TAG_SPACE', 32)
+    monkeypatch.setattr(script, 'TAG_SPACE_MIN_SIZE', 1)
+    monkeypatch.setattr(script, 'SEGMENT_CONNECTIONS', 1)
+    job = script.new_track_job(1, 'n', 'a', 'exhigh', str(tmp_path))
+    job['url'] = 'http://x/1.flac'
+    job['url_entry'] = {'id': 1, 'url': job['url'], 'type': 'flac', 'size': len(flac), 'md5': 'm'}
+    assert script.fetch_track_audio(job)
+    assert ranges[0] == f'0-{script.TAG_PROBE_BYTES - 1}' and ranges[1:] == ['0-', '64-']  # 续传按远端偏移
+    with open(job['filepath'], 'rb') as f:
+        assert f.read() == b'fLaC\x00\x00\x00\x22' + b'S' * 34 + b'\x81\x00\x00\x1c' + b'\x00' * 28 + bytes(range(200))